@@ -0,0 +1,1043 @@
+"""Array-based topology of surface water networks.
+
+These functions work with integer positions of segments, rather than segment
+numbers. The downstream connection of each segment is stored in a ``to_idx``
+array (with -1 for outlets), and the upstream connections are stored in a
+compressed sparse row (CSR) structure of ``indptr`` and ``indices`` arrays.
+"""
+
+__all__ = [
+    "line_end_coords", "line_coords", "lines_from_coords", "line_chainage",
+    "project_coords", "match_coords",
+    "to_index", "group_csr", "upstream_csr", "csr_sets", "csr_gather",
+    "outlet_levels", "headwater_levels", "network_attributes",
+    "accumulate_downstream", "downstream_mask", "upstream_mask",
+    "update_attributes", "upstream_intervals",
+    "outlet_depth", "ancestor_table", "lift", "lowest_common_ancestor",
+    "adjust_profiles", "next_reach",
+]
+
+import numpy as np
+import pandas as pd
+
+from swn.compat import SHAPELY_GE_20
+
+
+def line_end_coords(lines):
+    """Return arrays of start and end coordinates of lines.
+
+    Parameters
+    ----------
+    lines : geopandas.GeoSeries or array_like
+        LineString geometries.
+
+    Returns
+    -------
+    start, end : numpy.ndarray
+        2D arrays with shape ``(len(lines), 3)`` for X, Y and Z coordinates.
+        Z values are NaN for 2D geometries.
+
+    """
+    geoms = np.asarray(lines, dtype=object)
+    if SHAPELY_GE_20:
+        import shapely
+        start = shapely.get_coordinates(
+            shapely.get_point(geoms, 0), include_z=True)
+        end = shapely.get_coordinates(
+            shapely.get_point(geoms, -1), include_z=True)
+        return start, end
+    start = np.full((len(geoms), 3), np.nan)
+    end = np.full((len(geoms), 3), np.nan)
+    for idx, geom in enumerate(geoms):
+        coords = geom.coords
+        first = coords[0]
+        last = coords[-1]
+        start[idx, :len(first)] = first
+        end[idx, :len(last)] = last
+    return start, end
+
+
+def _geom_coords(geom):
+    """Return 2D array of coordinates for a geometry with Shapely < 2."""
+    if geom.is_empty:
+        return np.empty((0, 2))
+    elif hasattr(geom, "geoms"):
+        parts = [_geom_coords(part) for part in geom.geoms]
+        coords = np.full(
+            (sum(len(part) for part in parts),
+             max(part.shape[1] for part in parts)), np.nan)
+        start = 0
+        for part in parts:
+            coords[start:start + len(part), :part.shape[1]] = part
+            start += len(part)
+        return coords
+    return np.asarray(geom.coords)
+
+
+def line_coords(lines):
+    """Return all coordinates of lines, with offsets for each line.
+
+    Parameters
+    ----------
+    lines : geopandas.GeoSeries or array_like
+        LineString geometries. Coordinates of other geometries, such as
+        points or multi-part geometries, are also found in order.
+
+    Returns
+    -------
+    coords : numpy.ndarray
+        2D array with shape ``(num_coords, 3)`` for X, Y and Z coordinates.
+        Z values are NaN for 2D geometries.
+    indptr : numpy.ndarray
+        Coordinates of line ``i`` are ``coords[indptr[i]:indptr[i + 1]]``.
+
+    """
+    geoms = np.asarray(lines, dtype=object)
+    indptr = np.zeros(len(geoms) + 1, dtype=np.intp)
+    if SHAPELY_GE_20:
+        import shapely
+        np.cumsum(shapely.get_num_coordinates(geoms), out=indptr[1:])
+        return shapely.get_coordinates(geoms, include_z=True), indptr
+    parts = [_geom_coords(geom) for geom in geoms]
+    np.cumsum([len(part) for part in parts], out=indptr[1:])
+    coords = np.full((indptr[-1], 3), np.nan)
+    for idx, part in enumerate(parts):
+        coords[indptr[idx]:indptr[idx + 1], :part.shape[1]] = part
+    return coords, indptr
+
+
+def lines_from_coords(coords, indptr):
+    """Return LineString geometries from coordinates and offsets.
+
+    Parameters
+    ----------
+    coords : numpy.ndarray
+        2D array of coordinates, with 2 or 3 columns.
+    indptr : numpy.ndarray
+        Coordinates of line ``i`` are ``coords[indptr[i]:indptr[i + 1]]``.
+
+    Returns
+    -------
+    numpy.ndarray
+        LineString geometries.
+
+    """
+    if SHAPELY_GE_20:
+        import shapely
+        counts = np.diff(indptr)
+        return shapely.linestrings(
+            coords, indices=np.repeat(np.arange(len(counts)), counts))
+    from shapely.geometry import LineString
+    coords = np.asarray(coords).tolist()  # faster than arrays
+    bounds = np.asarray(indptr).tolist()
+    lines = np.empty(len(bounds) - 1, dtype=object)
+    for idx, (b0, b1) in enumerate(zip(bounds[:-1], bounds[1:])):
+        lines[idx] = LineString(coords[b0:b1])
+    return lines
+
+
+def line_chainage(xy):
+    """Return cumulative 2D distance along line coordinates.
+
+    Parameters
+    ----------
+    xy : numpy.ndarray
+        2D array of coordinates for a line, where only the first two columns
+        are used.
+
+    Returns
+    -------
+    numpy.ndarray
+        Distance of each coordinate from the start of the line.
+
+    """
+    xy = np.asarray(xy, dtype=float)
+    chainage = np.zeros(len(xy))
+    np.cumsum(np.hypot(*np.diff(xy[:, :2], axis=0).T), out=chainage[1:])
+    return chainage
+
+
+def project_coords(line_xy, xy, chainage=None, chunk_size=1000000):
+    """Return distances along a line to points nearest to coordinates.
+
+    This is similar to ``line.project(Point(x, y))`` for each coordinate,
+    where the first of any equally near line segments is used.
+
+    Parameters
+    ----------
+    line_xy : numpy.ndarray
+        2D array of coordinates for a line, where only the first two columns
+        are used.
+    xy : numpy.ndarray
+        2D array of coordinates to project, where only the first two columns
+        are used.
+    chainage : numpy.ndarray, optional
+        Result from :func:`line_chainage` for ``line_xy``.
+    chunk_size : int, default 1000000
+        Approximate number of point and line segment pairs evaluated at once.
+
+    Returns
+    -------
+    numpy.ndarray
+
+    Examples
+    --------
+    >>> line_xy = np.array([[0.0, 0.0], [10.0, 0.0], [10.0, 10.0]])
+    >>> project_coords(line_xy, np.array([[4.0, 1.0], [12.0, 5.0]]))
+    array([ 4., 15.])
+    """
+    line_xy = np.asarray(line_xy, dtype=float)[:, :2]
+    xy = np.asarray(xy, dtype=float)[:, :2]
+    if chainage is None:
+        chainage = line_chainage(line_xy)
+    start = line_xy[:-1]
+    delta = line_xy[1:] - start
+    delta_sq = (delta ** 2).sum(1)
+    delta_sq[delta_sq == 0.0] = np.inf  # zero-length segments use start
+    seg_length = np.diff(chainage)
+    dist = np.zeros(len(xy))
+    if len(start) == 0:
+        return dist
+    step = max(1, chunk_size // len(start))
+    for b0 in range(0, len(xy), step):
+        pt = xy[b0:b0 + step, np.newaxis, :]
+        frac = np.clip(((pt - start) * delta).sum(2) / delta_sq, 0.0, 1.0)
+        dist_sq = ((start + frac[..., np.newaxis] * delta - pt) ** 2).sum(2)
+        near = dist_sq.argmin(1)
+        rows = np.arange(len(near))
+        dist[b0:b0 + step] = \
+            chainage[near] + frac[rows, near] * seg_length[near]
+    return dist
+
+
+def match_coords(xy1, xy2=None, tolerance=None):
+    """Return pairs of positions of matching 2D coordinates.
+
+    Parameters
+    ----------
+    xy1 : numpy.ndarray
+        2D array of coordinates, where only the first two columns are used.
+    xy2 : numpy.ndarray, optional
+        Other 2D array of coordinates. If None, ``xy1`` is matched with
+        itself, excluding pairs to the same position.
+    tolerance : float, optional
+        If None (default), coordinates must be exactly equal, and are
+        matched with a hash table. Otherwise coordinates are matched within
+        a distance using a KD-tree, which requires scipy.
+
+    Returns
+    -------
+    idx1, idx2 : numpy.ndarray
+        Positions in ``xy1`` and ``xy2``, sorted by ``idx1``, then by
+        distance, then by ``idx2``.
+    dist : numpy.ndarray
+        Distance between coordinates.
+
+    """
+    is_self = xy2 is None
+    xy1 = np.asarray(xy1, dtype=float)[:, :2]
+    xy2 = xy1 if is_self else np.asarray(xy2, dtype=float)[:, :2]
+    if tolerance is None:
+        df1 = pd.DataFrame({"x": xy1[:, 0], "y": xy1[:, 1]})
+        df2 = pd.DataFrame({"x": xy2[:, 0], "y": xy2[:, 1]})
+        df1["idx1"] = np.arange(len(df1))
+        df2["idx2"] = np.arange(len(df2))
+        pairs = df1.merge(df2, on=["x", "y"])
+        idx1 = pairs["idx1"].values.astype(np.intp)
+        idx2 = pairs["idx2"].values.astype(np.intp)
+        dist = np.zeros(len(idx1))
+    else:
+        from scipy.spatial import cKDTree
+
+        found = cKDTree(xy2).query_ball_point(xy1, r=tolerance)
+        counts = np.fromiter((len(x) for x in found), np.intp, len(found))
+        idx1 = np.repeat(np.arange(len(xy1), dtype=np.intp), counts)
+        idx2 = np.fromiter(
+            (i for x in found for i in x), np.intp, int(counts.sum()))
+        dist = np.hypot(*(xy1[idx1] - xy2[idx2]).T)
+    if is_self:
+        sel = idx1 != idx2
+        idx1, idx2, dist = idx1[sel], idx2[sel], dist[sel]
+    order = np.lexsort((idx2, dist, idx1))
+    return idx1[order], idx2[order], dist[order]
+
+
+def to_index(to_segnums, segnums):
+    """Return positional index of downstream segments.
+
+    Parameters
+    ----------
+    to_segnums : array_like
+        Downstream segment number for each segment.
+    segnums : array_like or pandas.Index
+        Unique segment numbers.
+
+    Returns
+    -------
+    numpy.ndarray
+        Position of each downstream segment, or -1 if not found (e.g.
+        ``END_SEGNUM`` for outlets).
+
+    """
+    return pd.Index(segnums).get_indexer(to_segnums).astype(np.intp)
+
+
+def group_csr(keys, num):
+    """Return compressed sparse row (CSR) arrays of positions grouped by key.
+
+    Positions with key ``i`` are ``indices[indptr[i]:indptr[i + 1]]``,
+    which are in ascending order. Negative keys are ignored.
+
+    Parameters
+    ----------
+    keys : numpy.ndarray
+        Row for each position, or -1 to ignore.
+    num : int
+        Number of rows.
+
+    Returns
+    -------
+    indptr, indices : numpy.ndarray
+
+    """
+    keys = np.asarray(keys)
+    is_key = keys >= 0
+    counts = np.bincount(keys[is_key], minlength=num)
+    indptr = np.zeros(num + 1, dtype=np.intp)
+    np.cumsum(counts, out=indptr[1:])
+    # stable sort keeps positions in ascending order
+    pos = np.flatnonzero(is_key)
+    indices = pos[np.argsort(keys[pos], kind="stable")]
+    return indptr, indices
+
+
+def upstream_csr(to_idx):
+    """Return compressed sparse row (CSR) arrays of upstream segments.
+
+    Upstream positions for segment position ``i`` are
+    ``indices[indptr[i]:indptr[i + 1]]``, which are in ascending order.
+
+    Parameters
+    ----------
+    to_idx : numpy.ndarray
+        Position of each downstream segment, or -1 for outlets.
+
+    Returns
+    -------
+    indptr, indices : numpy.ndarray
+
+    """
+    return group_csr(to_idx, len(to_idx))
+
+
+def csr_sets(indptr, labels):
+    """Return list with a set of labels for each row of CSR arrays.
+
+    Parameters
+    ----------
+    indptr : numpy.ndarray
+        Compressed sparse row offsets.
+    labels : array_like
+        Labels for each value, e.g. ``segnums[indices]``.
+
+    Returns
+    -------
+    list
+
+    """
+    labels = labels.tolist() if hasattr(labels, "tolist") else list(labels)
+    indptr = np.asarray(indptr)
+    counts = np.diff(indptr)
+    result = [set() for _ in range(len(counts))]
+    bounds = indptr.tolist()
+    for row in np.flatnonzero(counts == 1).tolist():
+        result[row].add(labels[bounds[row]])
+    for row in np.flatnonzero(counts > 1).tolist():
+        result[row].update(labels[bounds[row]:bounds[row + 1]])
+    return result
+
+
+def csr_gather(indptr, indices, rows):
+    """Gather CSR values for several rows.
+
+    Parameters
+    ----------
+    indptr, indices : numpy.ndarray
+        Compressed sparse row arrays.
+    rows : numpy.ndarray
+        Row positions to gather.
+
+    Returns
+    -------
+    values : numpy.ndarray
+        Concatenated values from each row.
+    starts : numpy.ndarray
+        Offsets to the start of each row in ``values``, suitable for
+        ``numpy.ufunc.reduceat`` for rows that are not empty.
+    counts : numpy.ndarray
+        Number of values for each row.
+
+    """
+    rows = np.asarray(rows, dtype=np.intp)
+    first = indptr[rows]
+    counts = indptr[rows + 1] - first
+    starts = np.cumsum(counts) - counts
+    total = int(counts.sum())
+    offsets = np.arange(total, dtype=np.intp) - np.repeat(starts, counts)
+    values = indices[np.repeat(first, counts) + offsets]
+    return values, starts, counts
+
+
+def outlet_levels(to_idx, indptr, indices):
+    """Return list of segment positions at each level from the outlets.
+
+    The first level has outlets, the next level has segments that connect
+    to the outlets, and so on. Segments that cannot reach an outlet (e.g.
+    circular connections) are not found in any level.
+    """
+    levels = []
+    level = np.flatnonzero(np.asarray(to_idx) < 0)
+    while level.size > 0:
+        levels.append(level)
+        level = csr_gather(indptr, indices, level)[0]
+    return levels
+
+
+def headwater_levels(to_idx, indptr):
+    """Return list of segment positions in topological levels (Kahn).
+
+    The first level has headwater segments, and each following level has
+    segments where all upstream segments are found in previous levels.
+    Segments that are part of circular connections are not found in any level.
+    """
+    to_idx = np.asarray(to_idx)
+    remaining = np.diff(indptr)
+    levels = []
+    level = np.flatnonzero(remaining == 0)
+    while level.size > 0:
+        levels.append(level)
+        down = to_idx[level]
+        down, counts = np.unique(down[down >= 0], return_counts=True)
+        remaining[down] -= counts
+        level = down[remaining[down] == 0]
+    return levels
+
+
+def network_attributes(to_idx, length):
+    """Evaluate network attributes from downstream connections.
+
+    Parameters
+    ----------
+    to_idx : numpy.ndarray
+        Position of each downstream segment, or -1 for outlets.
+    length : numpy.ndarray
+        Length of each segment.
+
+    Returns
+    -------
+    dict
+        With the following keys with an array for each segment:
+
+          - ``cat_group``: position of outlet, or -1 if not connected.
+          - ``num_to_outlet``: number of segments to the outlet.
+          - ``dist_to_outlet``: distance to the outlet.
+          - ``sequence``: unique downstream sequence, starting from 1, or
+            0 if not evaluated.
+          - ``stream_order``: Strahler number, or 0 if not evaluated.
+
+    """
+    to_idx = np.asarray(to_idx, dtype=np.intp)
+    length = np.asarray(length, dtype=float)
+    num = len(to_idx)
+    indptr, indices = upstream_csr(to_idx)
+
+    # Work upstream from outlets
+    cat_group = np.full(num, -1, dtype=np.intp)
+    num_to_outlet = np.zeros(num, dtype=np.int64)
+    dist_to_outlet = np.zeros(num, dtype=float)
+    levels = outlet_levels(to_idx, indptr, indices)
+    if levels:
+        outlets = levels[0]
+        cat_group[outlets] = outlets
+        num_to_outlet[outlets] = 1
+        dist_to_outlet[outlets] = length[outlets]
+    for level in levels[1:]:
+        down = to_idx[level]
+        cat_group[level] = cat_group[down]
+        num_to_outlet[level] = num_to_outlet[down] + 1
+        dist_to_outlet[level] = dist_to_outlet[down] + length[level]
+
+    # Work downstream from headwater
+    # Each segment is evaluated in a "pass", which is the number of
+    # iterations needed to reach the segment, where each pass starts from
+    # segments with at least one upstream segment evaluated in a previous pass
+    stream_order = np.zeros(num, dtype=np.int64)
+    passes = np.full(num, -1, dtype=np.int64)
+    levels = headwater_levels(to_idx, indptr)
+    if levels:
+        headwater = levels[0]
+        stream_order[headwater] = 1
+        passes[headwater] = 0
+    for level in levels[1:]:
+        up, starts, counts = csr_gather(indptr, indices, level)
+        up_order = stream_order[up]
+        max_order = np.maximum.reduceat(up_order, starts)
+        is_max = up_order == np.repeat(max_order, counts)
+        num_max = np.add.reduceat(is_max.astype(np.int64), starts)
+        stream_order[level] = max_order + (num_max > 1)
+        up_passes = passes[up]
+        passes[level] = np.maximum(
+            np.maximum.reduceat(up_passes, starts),
+            np.minimum.reduceat(up_passes, starts) + 1)
+
+    # Within each pass, sort segments furthest from the outlet first
+    sequence = np.zeros(num, dtype=np.int64)
+    evaluated = np.flatnonzero(passes >= 0)
+    order = evaluated[np.lexsort((
+        -dist_to_outlet[evaluated],
+        -num_to_outlet[evaluated],
+        passes[evaluated]))]
+    sequence[order] = np.arange(1, len(order) + 1)
+
+    return {
+        "cat_group": cat_group,
+        "num_to_outlet": num_to_outlet,
+        "dist_to_outlet": dist_to_outlet,
+        "sequence": sequence,
+        "stream_order": stream_order,
+    }
+
+
+def accumulate_downstream(to_idx, values, levels=None):
+    """Accumulate values down the network.
+
+    Parameters
+    ----------
+    to_idx : numpy.ndarray
+        Position of each downstream segment, or -1 for outlets.
+    values : numpy.ndarray
+        1D or 2D array, where the first dimension is along segments.
+    levels : list, optional
+        From :py:func:`headwater_levels`, which is evaluated if not provided.
+
+    Returns
+    -------
+    numpy.ndarray
+        Accumulated values, with the same shape as ``values``.
+
+    """
+    to_idx = np.asarray(to_idx, dtype=np.intp)
+    values = np.asarray(values)
+    if levels is None:
+        levels = headwater_levels(to_idx, upstream_csr(to_idx)[0])
+    accum = values.copy()
+    upstream = np.zeros_like(values)
+    for num, level in enumerate(levels):
+        if num > 0:
+            accum[level] = values[level] + upstream[level]
+        down = to_idx[level]
+        is_down = down >= 0
+        np.add.at(upstream, down[is_down], accum[level[is_down]])
+    return accum
+
+
+def downstream_mask(to_idx, idx):
+    """Return mask of positions, and all segments downstream of these."""
+    to_idx = np.asarray(to_idx, dtype=np.intp)
+    mask = np.zeros(len(to_idx), dtype=bool)
+    level = np.unique(np.asarray(idx, dtype=np.intp))
+    while level.size > 0:
+        mask[level] = True
+        level = to_idx[level]
+        level = np.unique(level[level >= 0])
+        level = level[~mask[level]]
+    return mask
+
+
+def upstream_mask(indptr, indices, idx):
+    """Return mask of positions, and all segments upstream of these."""
+    mask = np.zeros(len(indptr) - 1, dtype=bool)
+    level = np.unique(np.asarray(idx, dtype=np.intp))
+    while level.size > 0:
+        mask[level] = True
+        level = csr_gather(indptr, indices, level)[0]
+        level = level[~mask[level]]
+    return mask
+
+
+def update_attributes(to_idx, length, attrs, idx, area=None):
+    """Update network attributes for segments affected by changes.
+
+    Segments upstream of changed positions are updated with new
+    ``cat_group``, ``num_to_outlet`` and ``dist_to_outlet``. Segments
+    downstream of changed positions are updated with new ``stream_order``,
+    ``upstream_length`` and ``upstream_area``. The ``sequence`` is
+    re-numbered, keeping the previous order where possible.
+
+    Parameters
+    ----------
+    to_idx : numpy.ndarray
+        Position of each downstream segment, or -1 for outlets.
+    length : numpy.ndarray
+        Length of each segment.
+    attrs : dict
+        Arrays for each segment that are modified in place, with keys
+        from :py:func:`network_attributes` and ``upstream_length``, and
+        ``upstream_area`` if ``area`` is provided. New segments should have
+        a sequence of -1.
+    idx : numpy.ndarray
+        Positions of segments that have changed.
+    area : numpy.ndarray, optional
+        Catchment area of each segment.
+
+    Returns
+    -------
+    numpy.ndarray
+        Mask of segments that were updated.
+
+    """
+    to_idx = np.asarray(to_idx, dtype=np.intp)
+    indptr, indices = upstream_csr(to_idx)
+
+    # Work upstream from changed segments, starting where the segment
+    # downstream is unchanged
+    up = upstream_mask(indptr, indices, idx)
+    cat_group = attrs["cat_group"]
+    num_to_outlet = attrs["num_to_outlet"]
+    dist_to_outlet = attrs["dist_to_outlet"]
+    cat_group[up] = -1
+    num_to_outlet[up] = 0
+    dist_to_outlet[up] = 0.0
+    up_idx = np.flatnonzero(up)
+    down = to_idx[up_idx]
+    level = up_idx[down < 0]
+    cat_group[level] = level
+    num_to_outlet[level] = 1
+    dist_to_outlet[level] = length[level]
+    is_root = (down >= 0) & ~up[np.maximum(down, 0)]
+    is_root[is_root] = cat_group[down[is_root]] >= 0
+    level = np.concatenate([level, up_idx[is_root]])
+    down = to_idx[up_idx[is_root]]
+    cat_group[up_idx[is_root]] = cat_group[down]
+    num_to_outlet[up_idx[is_root]] = num_to_outlet[down] + 1
+    dist_to_outlet[up_idx[is_root]] = \
+        dist_to_outlet[down] + length[up_idx[is_root]]
+    while level.size > 0:
+        level = csr_gather(indptr, indices, level)[0]
+        down = to_idx[level]
+        cat_group[level] = cat_group[down]
+        num_to_outlet[level] = num_to_outlet[down] + 1
+        dist_to_outlet[level] = dist_to_outlet[down] + length[level]
+
+    # Work downstream from changed segments, ordered furthest from outlet;
+    # the sequence key is the largest previous sequence upstream (inclusive)
+    # then the number of segments downstream from it
+    changed = downstream_mask(to_idx, idx) & (cat_group >= 0)
+    stream_order = attrs["stream_order"]
+    upstream_length = attrs["upstream_length"]
+    upstream_area = attrs.get("upstream_area")
+    sequence = attrs["sequence"]
+    key = sequence.astype(float)
+    key[sequence < 0] = -np.inf
+    hop = np.zeros(len(to_idx), dtype=np.int64)
+    changed_idx = np.flatnonzero(changed)
+    num_changed = num_to_outlet[changed_idx]
+    for num in np.unique(num_changed)[::-1]:
+        level = changed_idx[num_changed == num]
+        counts = indptr[level + 1] - indptr[level]
+        stream_order[level] = 1
+        upstream_length[level] = length[level]
+        if upstream_area is not None:
+            upstream_area[level] = area[level]
+        level = level[counts > 0]
+        if level.size == 0:
+            continue
+        from_idx, starts, counts = csr_gather(indptr, indices, level)
+        up_order = stream_order[from_idx]
+        max_order = np.maximum.reduceat(up_order, starts)
+        is_max = up_order == np.repeat(max_order, counts)
+        num_max = np.add.reduceat(is_max.astype(np.int64), starts)
+        stream_order[level] = max_order + (num_max > 1)
+        upstream_length[level] += np.add.reduceat(
+            upstream_length[from_idx], starts)
+        if upstream_area is not None:
+            upstream_area[level] += np.add.reduceat(
+                upstream_area[from_idx], starts)
+        up_key = key[from_idx]
+        max_key = np.maximum.reduceat(up_key, starts)
+        is_max = up_key == np.repeat(max_key, counts)
+        max_hop = np.maximum.reduceat(
+            np.where(is_max, hop[from_idx], -1), starts)
+        sel = max_key >= key[level]
+        key[level[sel]] = max_key[sel]
+        hop[level[sel]] = max_hop[sel] + 1
+
+    # Re-number sequence from keys
+    evaluated = np.flatnonzero((sequence > 0) | changed)
+    order = evaluated[np.lexsort((hop[evaluated], key[evaluated]))]
+    sequence[:] = 0
+    sequence[order] = np.arange(1, len(order) + 1)
+    return up | changed
+
+
+def upstream_intervals(to_idx, indptr, indices):
+    """Return pre-order intervals of upstream segments (Euler tour).
+
+    Segments upstream of position ``i`` (inclusive) are found in
+    ``order[start[i]:stop[i]]``, which are ordered depth-first from ``i``.
+    Segment ``j`` is upstream of ``i`` where
+    ``start[i] <= start[j] < stop[i]``.
+
+    Parameters
+    ----------
+    to_idx : numpy.ndarray
+        Position of each downstream segment, or -1 for outlets.
+    indptr, indices : numpy.ndarray
+        Compressed sparse row arrays of upstream segments.
+
+    Returns
+    -------
+    order, start, stop : numpy.ndarray
+        Segments that are not connected to an outlet (e.g. circular
+        connections) are put at the end of ``order``, and only include
+        themselves.
+
+    """
+    to_idx = np.asarray(to_idx, dtype=np.intp)
+    num = len(to_idx)
+    size = accumulate_downstream(to_idx, np.ones(num, dtype=np.intp))
+    # offset of each upstream segment after preceding segments in each row
+    up_size = size[indices]
+    excl = np.cumsum(up_size) - up_size
+    rows = np.repeat(np.arange(num), np.diff(indptr))
+    offset = np.zeros(num, dtype=np.intp)
+    offset[indices] = excl - excl[indptr[rows]]
+    start = np.full(num, -1, dtype=np.intp)
+    levels = outlet_levels(to_idx, indptr, indices)
+    if levels:
+        outlets = levels[0]
+        start[outlets] = np.cumsum(size[outlets]) - size[outlets]
+    for level in levels[1:]:
+        start[level] = start[to_idx[level]] + 1 + offset[level]
+    stop = start + size
+    unreached = np.flatnonzero(start < 0)
+    if unreached.size > 0:
+        start[unreached] = num - len(unreached) + np.arange(len(unreached))
+        stop[unreached] = start[unreached] + 1
+    order = np.empty(num, dtype=np.intp)
+    order[start] = np.arange(num)
+    return order, start, stop
+
+
+def outlet_depth(to_idx, levels):
+    """Return number of segments downstream to the outlet (exclusive).
+
+    Parameters
+    ----------
+    to_idx : numpy.ndarray
+        Position of each downstream segment, or -1 for outlets.
+    levels : list
+        From :py:func:`outlet_levels`.
+
+    Returns
+    -------
+    numpy.ndarray
+        Zero for outlets, or -1 for segments not connected to an outlet.
+
+    """
+    depth = np.full(len(to_idx), -1, dtype=np.intp)
+    for num, level in enumerate(levels):
+        depth[level] = num
+    return depth
+
+
+def ancestor_table(to_idx, depth):
+    """Return binary lifting table of downstream segments.
+
+    Row ``k`` has the position of the segment ``2 ** k`` segments downstream,
+    or -1 if it is past the outlet.
+
+    Parameters
+    ----------
+    to_idx : numpy.ndarray
+        Position of each downstream segment, or -1 for outlets.
+    depth : numpy.ndarray
+        From :py:func:`outlet_depth`.
+
+    Returns
+    -------
+    numpy.ndarray
+        2D array with shape ``(nrows, len(to_idx))``.
+
+    """
+    to_idx = np.asarray(to_idx, dtype=np.intp)
+    max_depth = int(depth.max()) if len(depth) > 0 else 0
+    nrows = max(1, max_depth.bit_length())
+    table = np.empty((nrows, len(to_idx)), dtype=np.intp)
+    # only follow segments connected to outlets
+    table[0] = np.where(depth > 0, to_idx, -1)
+    for k in range(1, nrows):
+        prev = table[k - 1]
+        table[k] = np.where(prev >= 0, prev[prev], -1)
+    return table
+
+
+def lift(table, idx, steps):
+    """Return position of segments a number of steps downstream.
+
+    Parameters
+    ----------
+    table : numpy.ndarray
+        From :py:func:`ancestor_table`.
+    idx : numpy.ndarray
+        Segment positions.
+    steps : numpy.ndarray
+        Number of segments downstream, which must not be more than the
+        depth of each segment.
+
+    Returns
+    -------
+    numpy.ndarray
+
+    """
+    idx = np.array(idx, dtype=np.intp)
+    steps = np.broadcast_to(steps, idx.shape)
+    for k in range(table.shape[0]):
+        sel = ((steps >> k) & 1).astype(bool) & (idx >= 0)
+        idx[sel] = table[k][idx[sel]]
+    return idx
+
+
+def lowest_common_ancestor(table, depth, idx1, idx2):
+    """Return position of the first segment downstream of both segments.
+
+    This is the confluence of two segments, which may be either segment
+    if one is downstream of the other.
+
+    Parameters
+    ----------
+    table : numpy.ndarray
+        From :py:func:`ancestor_table`.
+    depth : numpy.ndarray
+        From :py:func:`outlet_depth`.
+    idx1, idx2 : numpy.ndarray
+        Segment positions, with the same shape.
+
+    Returns
+    -------
+    numpy.ndarray
+        Position of the confluence, or -1 if the segments do not share
+        an outlet.
+
+    """
+    idx1 = np.asarray(idx1, dtype=np.intp)
+    idx2 = np.asarray(idx2, dtype=np.intp)
+    valid = (depth[idx1] >= 0) & (depth[idx2] >= 0)
+    # swap so that the first is deeper or the same depth as the second
+    swap = depth[idx1] < depth[idx2]
+    a = np.where(swap, idx2, idx1)
+    b = np.where(swap, idx1, idx2)
+    a = lift(table, a, np.where(valid, depth[a] - depth[b], 0))
+    same = a == b
+    for k in range(table.shape[0] - 1, -1, -1):
+        up_a = table[k][a]
+        up_b = table[k][b]
+        sel = ~same & (up_a != up_b)
+        a[sel] = up_a[sel]
+        b[sel] = up_b[sel]
+    res = np.where(same, a, table[0][a])
+    res[~valid] = -1
+    return res
+
+
+def adjust_profiles(coords, indptr, to_idx, sequence, min_slope):
+    """Adjust Z coordinates of lines to enforce a minimum downwards slope.
+
+    The result is the same as processing each coordinate in flow sequence:
+    the first coordinate of each segment is lowered to the lowest end of
+    upstream segments, each following coordinate is lowered to enforce
+    ``min_slope``, and last coordinates of segments that join are lowered
+    to the lowest of these. Each lowering is recorded as an adjustment.
+
+    Parameters
+    ----------
+    coords : numpy.ndarray
+        XYZ coordinates from :py:func:`line_coords`.
+    indptr : numpy.ndarray
+        Offsets of coordinates from :py:func:`line_coords`.
+    to_idx : numpy.ndarray
+        Position of each downstream segment, or -1 for outlets.
+    sequence : numpy.ndarray
+        Flow sequence, used to order segments that join.
+    min_slope : numpy.ndarray
+        Minimum downwards slope for each segment.
+
+    Returns
+    -------
+    dict
+        With ``z`` and ``dist`` for each coordinate, where ``dist`` is the
+        2D distance from the start of each segment, and ``num_adjusted``,
+        ``min_adjusted`` and ``max_adjusted`` for each segment.
+
+    """
+    to_idx = np.asarray(to_idx, dtype=np.intp)
+    sequence = np.asarray(sequence)
+    num = len(to_idx)
+    seg = np.repeat(np.arange(num), np.diff(indptr))
+    first = indptr[:-1]
+    last = indptr[1:] - 1
+    prev = last - 1
+    z = coords[:, 2]
+    dx = np.zeros(len(z))
+    dx[1:] = np.sqrt(
+        np.diff(coords[:, 0]) ** 2 + np.diff(coords[:, 1]) ** 2)
+    dx[first] = 0.0
+    dist = pd.Series(dx).groupby(seg).cumsum().values
+    slope = np.asarray(min_slope, dtype=float)
+    # lowering a coordinate to enforce min_slope from an upstream coordinate
+    # is a cumulative minimum of z + slope * dist along each segment
+    zc = z + slope[seg] * dist
+    is_interior = np.ones(len(z), dtype=bool)
+    is_interior[first] = False
+    is_interior[last] = False
+    cummin = pd.Series(np.where(is_interior, zc, np.inf)).groupby(
+        seg).cummin().values
+    last_z = z[last]
+
+    def lowest_end(idx, start):
+        """Return adjusted second-last Z and lowest possible last Z."""
+        pos = prev[idx]
+        zcmin = np.minimum(start, cummin[pos])
+        prev_z = np.where(
+            zcmin < zc[pos], zcmin - slope[idx] * dist[pos], z[pos])
+        return prev_z, prev_z - slope[idx] * dx[last[idx]]
+
+    # first coordinates are evaluated in topological order
+    start = z[first].copy()
+    has_up = np.zeros(num, dtype=bool)
+    has_up[to_idx[to_idx >= 0]] = True
+    up_end = np.full(num, np.inf)
+    for level in headwater_levels(to_idx, upstream_csr(to_idx)[0]):
+        sel = level[has_up[level]]
+        if (up_end[sel] > start[sel]).any():
+            raise NotImplementedError("unexpected scenario")
+        start[sel] = up_end[sel]
+        end_z = np.minimum(last_z[level], lowest_end(level, start[level])[1])
+        down = to_idx[level]
+        is_down = down >= 0
+        np.minimum.at(up_end, down[is_down], end_z[is_down])
+
+    # adjust remaining coordinates
+    new_z = z.copy()
+    adjusted = np.zeros(len(z))
+    adjusted[first] = z[first] - start
+    new_z[first] = start
+    zcmin = np.minimum(start[seg], cummin)
+    sel = is_interior & (zcmin < zc)
+    new_z[sel] = zcmin[sel] - slope[seg[sel]] * dist[sel]
+    adjusted[sel] = z[sel] - new_z[sel]
+    end_z = lowest_end(np.arange(num), start)[1]
+
+    # last coordinates of joining segments are processed in sequence, and
+    # each are lowered to the lowest last coordinate after processing
+    cur_z = last_z.copy()  # last Z before processing segment
+    is_down = to_idx >= 0
+    order = np.flatnonzero(is_down)
+    order = order[np.lexsort((sequence[order], to_idx[order]))]
+    down = to_idx[order]
+    lowest_raw = np.full(num, np.inf)
+    np.minimum.at(lowest_raw, down, last_z[order])
+    lowest = np.minimum(
+        lowest_raw[down],
+        pd.Series(end_z[order]).groupby(down).cummin().values)
+    is_first = np.ones(len(order), dtype=bool)
+    is_first[1:] = down[1:] != down[:-1]
+    cur_z[order[~is_first]] = lowest[np.flatnonzero(~is_first) - 1]
+    pre_adjusted = last_z - cur_z
+    proc_z = np.minimum(cur_z, end_z)
+    adjusted[last] = np.where(cur_z > end_z, cur_z - end_z, 0.0)
+    new_z[last] = np.where(is_down, up_end[to_idx], proc_z)
+    post_adjusted = proc_z - new_z[last]
+
+    # later adjustments of last coordinates are added to the last record
+    is_adjusted = adjusted > 0.0
+    last_pos = np.maximum.reduceat(
+        np.where(is_adjusted, np.arange(len(z)), -1), first)
+    sel = (post_adjusted > 0.0) & (last_pos >= 0)
+    adjusted[last_pos[sel]] += post_adjusted[sel]
+    sel = (post_adjusted > 0.0) & (last_pos < 0) & (pre_adjusted > 0.0)
+    pre_adjusted[sel] += post_adjusted[sel]
+    post_adjusted[(last_pos >= 0) | (pre_adjusted > 0.0)] = 0.0
+    num_adjusted = (
+        np.add.reduceat(is_adjusted.astype(np.intp), first) +
+        (pre_adjusted > 0.0) + (post_adjusted > 0.0))
+    extra = [np.where(vals > 0.0, vals, np.nan)
+             for vals in (pre_adjusted, post_adjusted)]
+    min_adjusted = np.fmin.reduce([
+        np.minimum.reduceat(np.where(is_adjusted, adjusted, np.inf), first),
+        *extra])
+    max_adjusted = np.fmax.reduce([
+        np.maximum.reduceat(np.where(is_adjusted, adjusted, -np.inf), first),
+        *extra])
+    return {
+        "z": new_z,
+        "dist": dist,
+        "num_adjusted": num_adjusted,
+        "min_adjusted": min_adjusted,
+        "max_adjusted": max_adjusted,
+    }
+
+
+def next_reach(line, to_idx):
+    """Return position of the next downstream reach for each reach.
+
+    Reaches are ordered along each segment. The last reach of a segment
+    connects to the first reach of the nearest downstream segment that has
+    reaches.
+
+    Parameters
+    ----------
+    line : numpy.ndarray
+        Position of the segment for each reach, or -1 for other reaches
+        that are not connected, such as diversions.
+    to_idx : numpy.ndarray
+        Position of each downstream segment, or -1 for outlets.
+
+    Returns
+    -------
+    numpy.ndarray
+        Position of the next reach, or -1 if not connected.
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> next_reach(np.array([2, 2, 0, 0]), np.array([-1, 0, 1]))
+    array([ 1,  2,  3, -1])
+
+    """
+    line = np.asarray(line, dtype=np.intp)
+    to_idx = np.asarray(to_idx, dtype=np.intp)
+    num = len(line)
+    # first reach of each segment, where reaches are grouped by segment
+    first = np.full(len(to_idx), -1, dtype=np.intp)
+    is_reach = np.flatnonzero(line >= 0)
+    first[line[is_reach[::-1]]] = is_reach[::-1]
+    # find nearest downstream segment with reaches, by pointer jumping
+    target = to_idx.copy()
+    todo = np.flatnonzero(target >= 0)
+    todo = todo[first[target[todo]] < 0]
+    while todo.size > 0:
+        target[todo] = target[target[todo]]
+        todo = todo[target[todo] >= 0]
+        todo = todo[first[target[todo]] < 0]
+    next_pos = np.full(num, -1, dtype=np.intp)
+    is_last = np.ones(num, dtype=bool)
+    is_last[:-1] = line[:-1] != line[1:]
+    is_last &= line >= 0
+    sel = np.flatnonzero(~is_last & (line >= 0))
+    next_pos[sel] = sel + 1
+    sel = np.flatnonzero(is_last)
+    down = target[line[sel]]
+    sel, down = sel[down >= 0], down[down >= 0]
+    next_pos[sel] = first[down]
+    return next_pos
@@ -2,17 +2,23 @@
 
 __all__ = ["SurfaceWaterNetwork"]
 
+import logging
 import pickle
 from itertools import zip_longest
-from math import sqrt
 from textwrap import dedent
 
 import geopandas
 import numpy as np
 import pandas as pd
 from shapely.geometry import LineString, Point
-from shapely.ops import cascaded_union, linemerge
-
+from shapely.ops import linemerge
+
+from swn._topology import (
+    accumulate_downstream, adjust_profiles, ancestor_table, csr_gather,
+    csr_sets, downstream_mask, group_csr, lift, line_coords, line_end_coords,
+    lines_from_coords, lowest_common_ancestor, match_coords,
+    network_attributes, outlet_depth, outlet_levels, to_index,
+    update_attributes, upstream_csr, upstream_intervals)
 from swn.compat import ignore_shapely_warnings_for_object_array
 from swn.spatial import get_sindex
 from swn.util import abbr_str
@@ -64,6 +70,7 @@ class SurfaceWaterNetwork:
             raise ValueError(
                 f'segments must be a GeoDataFrame; found {type(segments)!r}')
         self._segments = segments
+        self.topology_changed()
         self.END_SEGNUM = END_SEGNUM
         if self.END_SEGNUM in self.segments.index:
             self.logger.error(
@@ -75,6 +82,7 @@ class SurfaceWaterNetwork:
                 "correcting %d to_segnum not found in segments.index",
                 notin.sum())
             self.segments.loc[notin, "to_segnum"] = self.END_SEGNUM
+            self.topology_changed()
         # all other properties added afterwards
 
     def __len__(self):
@@ -143,8 +151,30 @@ class SurfaceWaterNetwork:
         yield "diversions", self.diversions
 
     def __getstate__(self):
-        """Serialize object attributes for pickle dumps."""
-        return dict(self)
+        """Serialize object attributes for pickle dumps.
+
+        Columns of sets in segments are serialized as compressed sparse row
+        (CSR) arrays of their labels, which may include segnums that are not
+        in the index, e.g. after :py:meth:`remove`.
+        """
+        state = dict(self)
+        segments = state["segments"]
+        set_columns = {}
+        for name in ("from_segnums", "diversions"):
+            if name not in segments.columns:
+                continue
+            values = segments[name]
+            if not all(isinstance(value, set) for value in values):
+                continue
+            indptr = np.zeros(len(values) + 1, dtype=np.intp)
+            np.cumsum([len(value) for value in values], out=indptr[1:])
+            labels = pd.Index([item for value in values for item in value])
+            set_columns[name] = (
+                segments.columns.get_loc(name), indptr, labels)
+        if set_columns:
+            state["segments"] = segments.drop(columns=list(set_columns))
+            state["set_columns"] = set_columns
+        return state
 
     def __setstate__(self, state):
         """Set object attributes from pickle loads."""
@@ -162,9 +192,15 @@ class SurfaceWaterNetwork:
         diversions = state["diversions"]
         if diversions is not None:
             self.set_diversions(diversions)
+        set_columns = state.get("set_columns", {})
+        for name, (loc, indptr, labels) in sorted(
+                set_columns.items(), key=lambda x: x[1][0]):
+            if name in self.segments.columns:
+                del self.segments[name]
+            self.segments.insert(loc, name, csr_sets(indptr, labels.values))
 
     @classmethod
-    def from_lines(cls, lines, polygons=None):
+    def from_lines(cls, lines, polygons=None, snap_tolerance=None):
         """
         Create and evaluate a new SurfaceWaterNetwork from lines for segments.
 
@@ -177,6 +213,10 @@ class SurfaceWaterNetwork:
         polygons : geopandas.GeoSeries, optional
             Optional input polygons of surface water catchments. Geometries
             must be ``POLYGON``. Index must be the same as ``segments.index``.
+        snap_tolerance : float, optional
+            If None (default), line ends must exactly match in 2D to be
+            connected. Otherwise line ends are connected if they are within
+            this distance, preferring the closest. This option requires scipy.
 
         Examples
         --------
@@ -220,21 +260,23 @@ class SurfaceWaterNetwork:
         del segments, END_SEGNUM  # dereference local copies
         obj.errors = []
         obj.warnings = []
-        obj.logger.debug("creating start/end points and spatial join objets")
-        start_pts = obj.segments.interpolate(0.0, normalized=True)
-        end_pts = obj.segments.interpolate(1.0, normalized=True)
-        start_df = start_pts.to_frame("start").set_geometry("start")
-        end_df = end_pts.to_frame("end").set_geometry("end")
-        segidxname = obj.segments.index.name or "index"
+        obj.logger.debug("evaluating start/end coordinates of lines")
+        segments_index = obj.segments.index
+        start_coords, end_coords = line_end_coords(obj.segments.geometry)
         # This is the main component of the algorithm
-        jxn = pd.DataFrame(
-            geopandas.sjoin(end_df, start_df, "inner", "intersects")
-            .drop(columns="end").reset_index()
-            .rename(columns={segidxname: "end", "index_right": "start"}))
+        end_idx, start_idx, _ = match_coords(
+            end_coords, start_coords, snap_tolerance)
+        sel = end_idx != start_idx  # ignore lines that join to themselves
+        end_idx, start_idx = end_idx[sel], start_idx[sel]
+        jxn = pd.DataFrame({
+            "end": segments_index[end_idx],
+            "start": segments_index[start_idx]})
         # Group end points to start points, list should only have 1 item
         to_segnum_l = jxn.groupby("end")["start"].agg(list)
         to_segnum = to_segnum_l.apply(lambda x: x[0])
         obj.segments.loc[to_segnum.index, "to_segnum"] = to_segnum.values
+        obj.topology_changed()
+        obj._set_topology("line_ends", (start_coords, end_coords))
         headwater = obj.headwater
         outlets = obj.outlets
 
@@ -247,9 +289,8 @@ class SurfaceWaterNetwork:
             obj.errors.append(m[0] % m[1:])
         if obj.has_z:
             # Check if match is in 2D but not 3D
-            jxn["start_z"] = start_pts.loc[jxn.start].z.values
-            jxn["end_z"] = end_pts.loc[jxn.end].z.values
-            for r in jxn.query("start_z != end_z").itertuples():
+            sel = start_coords[start_idx, 2] != end_coords[end_idx, 2]
+            for r in jxn.loc[sel].itertuples():
                 m = ('end of segment %s matches start of segment %s in '
                      '2D, but not in Z dimension', r.end, r.start)
                 obj.logger.warning(*m)
@@ -258,29 +299,41 @@ class SurfaceWaterNetwork:
         obj.logger.debug(
             'checking %d headwater segments and %d outlet segments',
             len(headwater), len(outlets))
+
+        def coord_sets(coords, xy_idx, seg_idx):
+            # Group sets of segnums for each 2D coordinate
+            xy = pd.Series(list(map(tuple, coords[xy_idx, :2].tolist())))
+            return pd.Series(segments_index[seg_idx]).groupby(xy).agg(set)
+
         # Find outlets that join to a single coodinate
         multi_outlets = set()
-        out_pts = end_pts.loc[outlets].to_frame("out").set_geometry("out")
-        jout = pd.DataFrame(
-            geopandas.sjoin(out_pts, out_pts, "inner").reset_index()
-            .rename(columns={segidxname: "out1", "index_right": "out2"}))\
-            .query("out1 != out2")
-        if jout.size > 0:
-            # Just evaluate 2D tuple to find segnums with same location
-            outsets = jout.assign(xy=jout.out.map(lambda g: (g.x, g.y)))\
-                .drop(columns="out").groupby("xy").agg(set)
-            for r in outsets.itertuples():
-                v = r.out1
+        out_idx = segments_index.get_indexer(outlets)
+        out1, out2, _ = match_coords(
+            end_coords[out_idx], tolerance=snap_tolerance)
+        if len(out1) > 0:
+            outsets = coord_sets(
+                end_coords, out_idx[np.append(out1, out1)],
+                out_idx[np.append(out1, out2)])
+            for xy, v in outsets.items():
                 m = ("ending coordinate %s matches end segment%s: %s",
-                     r.Index, "s" if len(v) != 1 else "", v)
+                     xy, "s" if len(v) != 1 else "", v)
                 obj.logger.warning(*m)
                 obj.warnings.append(m[0] % m[1:])
                 multi_outlets |= v
         # Find outlets that join to middle of other segments
+        out_pts = geopandas.GeoSeries(
+            [Point(xy) for xy in end_coords[out_idx, :2]],
+            index=outlets, crs=obj.segments.crs)
+        if snap_tolerance is not None:
+            out_pts = out_pts.buffer(snap_tolerance)
         joutseg = pd.DataFrame(
-            geopandas.sjoin(out_pts, obj.segments[["geometry"]], "inner")
+            geopandas.sjoin(
+                out_pts.to_frame("out").set_geometry("out"),
+                obj.segments[["geometry"]], "inner")
             .drop(columns="out").reset_index()
-            .rename(columns={segidxname: "out", "index_right": "segnum"}))
+            .rename(columns={
+                out_pts.index.name or "index": "out",
+                "index_right": "segnum"}))
         for r in joutseg.query("out != segnum").itertuples():
             if r.out in multi_outlets:
                 continue
@@ -289,89 +342,32 @@ class SurfaceWaterNetwork:
             obj.logger.error(*m)
             obj.errors.append(m[0] % m[1:])
         # Find headwater that join to a single coodinate
-        hw_pts = start_pts.loc[headwater].to_frame("hw").set_geometry("hw")
-        jhw = pd.DataFrame(
-            geopandas.sjoin(hw_pts, start_df, "inner").reset_index()
-            .rename(columns={segidxname: "hw1", "index_right": "start"}))\
-            .query("hw1 != start")
-        obj.jhw = jhw
-        if jhw.size > 0:
-            hwsets = jhw.assign(xy=jhw.hw.map(lambda g: (g.x, g.y)))\
-                .drop(columns="hw").groupby("xy").agg(set)
-            for r in hwsets.itertuples():
-                v = r.start
+        hw_idx = segments_index.get_indexer(headwater)
+        hw1, start2, _ = match_coords(
+            start_coords[hw_idx], start_coords, snap_tolerance)
+        sel = hw_idx[hw1] != start2
+        hw1, start2 = hw1[sel], start2[sel]
+        if len(hw1) > 0:
+            hwsets = coord_sets(start_coords, hw_idx[hw1], start2)
+            for xy, v in hwsets.items():
                 m = ("starting coordinate %s matches start segment%s: %s",
-                     r.Index, "s" if len(v) != 1 else "", v)
+                     xy, "s" if len(v) != 1 else "", v)
                 obj.logger.warning(*m)
                 obj.errors.append(m[0] % m[1:])
 
         # Store from_segnums set to segments GeoDataFrame
-        from_segnums = obj.from_segnums
-        obj.segments["from_segnums"] = from_segnums
-        sel = obj.segments.from_segnums.isna()
-        if sel.any():
-            obj.segments.loc[sel, "from_segnums"] = \
-                [set() for _ in range(sel.sum())]
+        obj.segments["from_segnums"] = obj._set_column(
+            "upstream_csr", segments_index)
         obj.logger.debug('evaluating segments upstream from %d outlet%s',
                          len(outlets), 's' if len(outlets) != 1 else '')
-        obj.segments['cat_group'] = obj.END_SEGNUM
-        obj.segments['num_to_outlet'] = 0
-        obj.segments['dist_to_outlet'] = 0.0
-
-        # Recursive function that accumulates information upstream
-        def resurse_upstream(segnum, cat_group, num, dist):
-            obj.segments.at[segnum, 'cat_group'] = cat_group
-            num += 1
-            obj.segments.at[segnum, 'num_to_outlet'] = num
-            dist += obj.segments.geometry[segnum].length
-            obj.segments.at[segnum, 'dist_to_outlet'] = dist
-            # Branch to zero or more upstream segments
-            for from_segnum in from_segnums.get(segnum, []):
-                resurse_upstream(from_segnum, cat_group, num, dist)
-
-        for segnum in obj.segments.loc[outlets].index:
-            resurse_upstream(segnum, segnum, 0, 0.0)
-
+        to_idx = obj._get_topology("to_idx")
+        attrs = network_attributes(to_idx, obj._get_topology("length"))
+        cat_group = attrs.pop("cat_group")
+        obj.segments["cat_group"] = np.where(
+            cat_group >= 0, segments_index.values[cat_group], obj.END_SEGNUM)
         obj.logger.debug('evaluating downstream sequence')
-        obj.segments['sequence'] = 0
-        obj.segments['stream_order'] = 0
-        # obj.segments['numiter'] = 0  # should be same as stream_order
-        # Sort headwater segments from the furthest from outlet to closest
-        search_order = ['num_to_outlet', 'dist_to_outlet']
-        furthest_upstream = obj.segments.loc[headwater]\
-            .sort_values(search_order, ascending=False).index
-        sequence = pd.Series(
-            np.arange(len(furthest_upstream)) + 1, index=furthest_upstream)
-        obj.segments.loc[sequence.index, 'sequence'] = sequence
-        obj.segments.loc[sequence.index, 'stream_order'] = 1
-        completed = set(headwater)
-        sequence = int(sequence.max())
-        for numiter in range(1, obj.segments['num_to_outlet'].max() + 1):
-            # Gather segments downstream from completed upstream set
-            downstream = set(
-                obj.segments.loc[completed, 'to_segnum'])\
-                .difference(completed.union([obj.END_SEGNUM]))
-            # Sort them to evaluate the furthest first
-            downstream_sorted = obj.segments.loc[downstream]\
-                .sort_values(search_order, ascending=False).index
-            for segnum in downstream_sorted:
-                if from_segnums[segnum].issubset(completed):
-                    sequence += 1
-                    obj.segments.at[segnum, 'sequence'] = sequence
-                    # self.segments.at[segnum, 'numiter'] = numiter
-                    # See Strahler stream order definition
-                    up_ord = list(
-                        obj.segments.loc[
-                            list(from_segnums[segnum]), 'stream_order'])
-                    max_ord = max(up_ord)
-                    if up_ord.count(max_ord) > 1:
-                        obj.segments.at[segnum, 'stream_order'] = max_ord + 1
-                    else:
-                        obj.segments.at[segnum, 'stream_order'] = max_ord
-                    completed.add(segnum)
-            if obj.segments['sequence'].min() > 0:
-                break
-        obj.logger.debug('sequence evaluated with %d iterations', numiter)
+        for name, values in attrs.items():
+            obj.segments[name] = values
         # Don't do this: self.segments.sort_values('sequence', inplace=True)
         obj.evaluate_upstream_length()
         if polygons is not None:
@@ -492,6 +488,7 @@ class SurfaceWaterNetwork:
         if value is None:
             if hasattr(self, '_catchments'):
                 delattr(self, '_catchments')
+                self.topology_changed()
             return
         elif not isinstance(value, geopandas.GeoSeries):
             raise ValueError(
@@ -504,6 +501,7 @@ class SurfaceWaterNetwork:
         # TODO: check extent overlaps
         setting_new = self.catchments is None
         self._catchments = value
+        self.topology_changed()
         if setting_new:
             self.evaluate_upstream_area()
             self.estimate_width()
@@ -566,6 +564,7 @@ class SurfaceWaterNetwork:
             self._diversions = None
             if 'diversions' in self.segments:
                 self.segments.drop('diversions', axis=1, inplace=True)
+            self.topology_changed()
             return
 
         if not isinstance(diversions, (geopandas.GeoDataFrame, pd.DataFrame)):
@@ -596,16 +595,15 @@ class SurfaceWaterNetwork:
                     f"segments.index: {abbr_str(diff)}")
             self._diversions = diversions.copy()
             if is_spatial:
-                cols = ["dist_end", "dist_line"]
-                self._diversions[cols] = np.nan
-                geom_name = self._diversions.geometry.name
-                for item in self._diversions.itertuples():
-                    div_geom = getattr(item, geom_name)
-                    seg_geom = self.segments.geometry[item.from_segnum]
-                    dist_end = div_geom.distance(Point(seg_geom.coords[-1]))
-                    dist_line = div_geom.distance(seg_geom)
-                    self._diversions.loc[item.Index, cols] = \
-                        [dist_end, dist_line]
+                div_geoms = self._diversions.geometry.values
+                seg_idx = self.segments.index.get_indexer(
+                    self._diversions["from_segnum"])
+                end_coords = self._get_topology("line_ends")[1][seg_idx]
+                seg_ends = geopandas.points_from_xy(
+                    end_coords[:, 0], end_coords[:, 1])
+                self._diversions["dist_end"] = seg_ends.distance(div_geoms)
+                self._diversions["dist_line"] = \
+                    self.segments.geometry.values[seg_idx].distance(div_geoms)
         elif is_spatial:
             self.logger.debug(
                 'assigning columns for diversions based on spatial distances')
@@ -619,67 +617,99 @@ class SurfaceWaterNetwork:
                     raise ValueError(
                         "'from_segnum' value too high (nothing selected)")
                 seg_lines = self.segments.loc[sel, 'geometry']
+                end_coords = self._get_topology("line_ends")[1][sel.values]
             else:
                 seg_lines = self.segments.geometry
-            seg_lines_sindex = get_sindex(seg_lines)
-            seg_ends = seg_lines.apply(lambda g: Point(g.coords[-1]))
-            # a point that is 0.1 m upstream from end
-            seg_near_ends = seg_lines.interpolate(-0.1, False)
-            for idx, geom in self._diversions.geometry.iteritems():
-                # build table of distances to nearest lines and end points
-
-                if seg_lines_sindex:
-                    sel = list(seg_lines_sindex.nearest(
-                                geom.coords[0], num_results=8))
-                    dists = pd.DataFrame(
-                        {
-                            'dist_end': seg_ends.iloc[sel].distance(geom),
-                            'dist_line': seg_lines.iloc[sel].distance(geom),
-                            'seg_near_ends':
-                                seg_near_ends.iloc[sel].distance(geom),
-                        },
-                        index=seg_lines.iloc[sel].index).sort_values(
-                            ['dist_end', 'dist_line', 'seg_near_ends'])
-                else:  # slower processing with of all seg_lines
-                    dists = pd.DataFrame(
-                        {
-                            'dist_end': seg_ends.distance(geom),
-                            'dist_line': seg_lines.distance(geom),
-                            'seg_near_ends': seg_near_ends.distance(geom),
-                        },
-                        index=seg_lines.index).sort_values(
-                            ['dist_end', 'dist_line', 'seg_near_ends'])
-
-                # assign closest segnum
-                self._diversions.loc[
-                    idx, ['from_segnum', 'dist_end', 'dist_line']] = \
-                    [dists.index[0]] + \
-                    list(dists.iloc[0][['dist_end', 'dist_line']])
+                end_coords = self._get_topology("line_ends")[1]
+            seg_ends = geopandas.GeoSeries(
+                geopandas.points_from_xy(end_coords[:, 0], end_coords[:, 1]),
+                index=seg_lines.index)
+            try:
+                from scipy.spatial import cKDTree
+            except ImportError:
+                cKDTree = None
+            div_geoms = self._diversions.geometry
+            if cKDTree is not None and (div_geoms.geom_type == "Point").all():
+                self.logger.debug(
+                    'finding nearest segment ends for %d diversions',
+                    len(div_geoms))
+                tree = cKDTree(end_coords[:, :2])
+                div_xy = np.array([div_geoms.x, div_geoms.y]).T
+                dist, _ = tree.query(div_xy)
+                # candidates have the nearest segment end, including ties
+                cand = tree.query_ball_point(div_xy, dist * (1 + 1e-9) + 1e-9)
+                div_idx = np.repeat(
+                    np.arange(len(div_xy)), [len(c) for c in cand])
+                seg_idx = np.concatenate(cand).astype(np.intp)
+                cand_geoms = div_geoms.values[div_idx]
+                dist_end = seg_ends.values[seg_idx].distance(cand_geoms)
+                dist_line = seg_lines.values[seg_idx].distance(cand_geoms)
+                # a point that is 0.1 m upstream from end
+                seg_near_ends = geopandas.GeoSeries(
+                    seg_lines.values[seg_idx]).interpolate(-0.1, False)
+                dist_near_end = seg_near_ends.values.distance(cand_geoms)
+                order = np.lexsort(
+                    (seg_idx, dist_near_end, dist_line, dist_end, div_idx))
+                _, first = np.unique(div_idx[order], return_index=True)
+                first = order[first]
+                self._diversions['from_segnum'] = \
+                    seg_lines.index[seg_idx[first]]
+                self._diversions['dist_end'] = dist_end[first]
+                self._diversions['dist_line'] = dist_line[first]
+            else:
+                seg_lines_sindex = get_sindex(seg_lines)
+                # a point that is 0.1 m upstream from end
+                seg_near_ends = seg_lines.interpolate(-0.1, False)
+                for idx, geom in div_geoms.iteritems():
+                    # build table of distances to nearest lines and end points
+
+                    if seg_lines_sindex:
+                        sel = list(seg_lines_sindex.nearest(
+                                    geom.coords[0], num_results=8))
+                        dists = pd.DataFrame(
+                            {
+                                'dist_end':
+                                    seg_ends.iloc[sel].distance(geom),
+                                'dist_line':
+                                    seg_lines.iloc[sel].distance(geom),
+                                'seg_near_ends':
+                                    seg_near_ends.iloc[sel].distance(geom),
+                            },
+                            index=seg_lines.iloc[sel].index).sort_values(
+                                ['dist_end', 'dist_line', 'seg_near_ends'])
+                    else:  # slower processing with of all seg_lines
+                        dists = pd.DataFrame(
+                            {
+                                'dist_end': seg_ends.distance(geom),
+                                'dist_line': seg_lines.distance(geom),
+                                'seg_near_ends': seg_near_ends.distance(geom),
+                            },
+                            index=seg_lines.index).sort_values(
+                                ['dist_end', 'dist_line', 'seg_near_ends'])
+
+                    # assign closest segnum
+                    self._diversions.loc[
+                        idx, ['from_segnum', 'dist_end', 'dist_line']] = \
+                        [dists.index[0]] + \
+                        list(dists.iloc[0][['dist_end', 'dist_line']])
         else:
             raise ValueError(
                 "'gdf' does not appear to be spatial or have a 'from_segnum' "
                 "column")
         # Update segments column to mirror this information
-        self.segments['diversions'] = None
-        for segnum in self._diversions['from_segnum'].unique():
-            sel = self._diversions['from_segnum'] == segnum
-            self.segments.at[segnum, 'diversions'] = \
-                set(self._diversions.loc[sel].index)
-        sel = self.segments.diversions.isna()
-        if sel.any():
-            self.segments.loc[sel, "diversions"] = \
-                [set() for _ in range(sel.sum())]
+        self.topology_changed()
+        self.segments["diversions"] = self._set_column(
+            "diversions_csr", self._diversions.index)
 
     @property
     def has_z(self):
         """Return True if all segment lines have Z dimension."""
-        return bool(self.segments.geometry.apply(lambda x: x.has_z).all())
+        return self._get_topology("has_z")
 
     @property
     def headwater(self):
         """Return index of headwater segments."""
-        return self.segments.index[
-                ~self.segments.index.isin(self.segments['to_segnum'])]
+        return self._get_topology("headwater")
 
     @property
     def outlets(self):
@@ -687,8 +717,7 @@ class SurfaceWaterNetwork:
 
         Determined where ``n.segments.to_segnum == n.END_SEGNUM`
         """
-        return self.segments.index[
-                self.segments['to_segnum'] == self.END_SEGNUM]
+        return self._get_topology("outlets")
 
     @property
     def to_segnums(self):
@@ -696,17 +725,206 @@ class SurfaceWaterNetwork:
 
         Determined from ``n.segments.to_segnum``.
         """
-        return self.segments.loc[
-            self.segments['to_segnum'] != self.END_SEGNUM, 'to_segnum']
+        return self._get_topology("to_segnums").copy()
 
     @property
     def from_segnums(self):
-        """Return partial Series of a set of segnums to connect upstream."""
-        series = self.to_segnums.to_frame(0).reset_index()\
-            .groupby(0).aggregate(set).iloc[:, 0]
-        series.index.name = self.segments.index.name
-        series.name = "from_segnums"
-        return series
+        """Return partial Series of a set of segnums to connect upstream.
+
+        This is determined from ``n.segments.to_segnum``, so it only has
+        segnums in the index. This can differ from ``segments.from_segnums``
+        after :py:meth:`remove`, which may keep removed segnums.
+        """
+        return self._get_topology("from_segnums").copy()
+
+    @property
+    def from_segnums_csr(self):
+        """Return compressed sparse row (CSR) arrays of upstream segnums.
+
+        This is a compact form of the :py:attr:`from_segnums` property,
+        where upstream segnums for the segment at position ``i`` are
+        ``segnums[indptr[i]:indptr[i + 1]]``. Like the property, it is
+        determined from ``n.segments.to_segnum``, so it only has segnums in
+        the index, and can differ from ``segments.from_segnums`` after
+        :py:meth:`remove`, which may keep removed segnums.
+
+        Returns
+        -------
+        indptr, segnums : numpy.ndarray
+
+        Examples
+        --------
+        >>> import swn
+        >>> from swn.spatial import wkt_to_geoseries
+        >>> lines = wkt_to_geoseries([
+        ...    "LINESTRING (60 100, 60  80)",
+        ...    "LINESTRING (40 130, 60 100)",
+        ...    "LINESTRING (70 130, 60 100)"])
+        >>> lines.index += 100
+        >>> n = swn.SurfaceWaterNetwork.from_lines(lines)
+        >>> indptr, segnums = n.from_segnums_csr
+        >>> indptr
+        array([0, 2, 2, 2])
+        >>> segnums
+        array([101, 102])
+        """
+        indptr, indices = self._get_topology("upstream_csr")
+        return indptr, self.segments.index.values[indices]
+
+    @property
+    def diversions_csr(self):
+        """Return compressed sparse row (CSR) arrays of diversion indexes.
+
+        This is a compact form of ``segments.diversions``, where diversion
+        indexes for the segment at position ``i`` are
+        ``divids[indptr[i]:indptr[i + 1]]``.
+
+        Returns
+        -------
+        indptr, divids : numpy.ndarray or None
+            None is returned if diversions are not set.
+
+        """
+        if self.diversions is None:
+            return None
+        indptr, indices = self._get_topology("diversions_csr")
+        return indptr, self.diversions.index.values[indices]
+
+    def _set_column(self, name, labels):
+        """Return list of sets for each segment from CSR topology."""
+        indptr, indices = self._get_topology(name)
+        return csr_sets(indptr, labels[indices])
+
+    def topology_changed(self):
+        """Reset cached topology after segments are modified in place.
+
+        Properties such as ``headwater``, ``outlets`` and ``from_segnums``
+        and the connections and line lengths used by other methods are
+        cached. These are reset by methods that modify the network, but
+        this method must be called after editing ``to_segnum`` or
+        ``geometry`` of segments in place.
+
+        Returns
+        -------
+        None
+
+        Examples
+        --------
+        >>> import swn
+        >>> from swn.spatial import wkt_to_geoseries
+        >>> lines = wkt_to_geoseries([
+        ...    "LINESTRING (60 100, 60  80)",
+        ...    "LINESTRING (40 130, 60 100)",
+        ...    "LINESTRING (70 130, 60 100)"])
+        >>> lines.index += 100
+        >>> n = swn.SurfaceWaterNetwork.from_lines(lines)
+        >>> n.segments.loc[102, "to_segnum"] = 0
+        >>> n.topology_changed()
+        >>> n.outlets
+        Int64Index([100, 102], dtype='int64')
+        """
+        self._topology_version = getattr(self, "_topology_version", 0) + 1
+        self._topology = {
+            "segments": self._segments, "version": self._topology_version}
+
+    def _topology_cache(self):
+        """Return dict of cached topology, which is reset if outdated."""
+        version = getattr(self, "_topology_version", 0)
+        cache = getattr(self, "_topology", None)
+        if (cache is None or cache["segments"] is not self._segments or
+                cache["version"] != version):
+            cache = self._topology = {
+                "segments": self._segments, "version": version}
+        return cache
+
+    def _set_topology(self, name, value):
+        """Set cached topology, e.g. after modifying geometries in place.
+
+        The topology version is not changed, so other cached topology is
+        kept.
+        """
+        self._topology_cache()[name] = value
+
+    def _get_topology(self, name):
+        """Return cached topology, evaluated if needed.
+
+        The cache is reset if the segments object is replaced, or if the
+        topology version is changed with :py:meth:`topology_changed`.
+
+        Parameters
+        ----------
+        name : str
+            One of ``has_z``, ``headwater``, ``outlets``, ``to_segnums``,
+            ``from_segnums``, ``line_ends``, ``length``, ``to_idx``,
+            ``upstream_csr``,
+            ``diversions_csr``, ``upstream_intervals``, ``depth`` or
+            ``ancestors``.
+
+        """
+        cache = self._topology_cache()
+        if name not in cache:
+            segments = self._segments
+            if name == "has_z":
+                cache[name] = bool(
+                    segments.geometry.apply(lambda x: x.has_z).all())
+            elif name == "headwater":
+                cache[name] = segments.index[
+                    ~segments.index.isin(segments["to_segnum"])]
+            elif name == "outlets":
+                cache[name] = segments.index[
+                    segments["to_segnum"] == self.END_SEGNUM]
+            elif name == "to_segnums":
+                cache[name] = segments.loc[
+                    segments["to_segnum"] != self.END_SEGNUM, "to_segnum"]
+            elif name == "from_segnums":
+                indptr, indices = self._get_topology("upstream_csr")
+                series = pd.Series(
+                    csr_sets(indptr, segments.index[indices]),
+                    index=segments.index, name="from_segnums", dtype=object)
+                series = series[np.diff(indptr) > 0].sort_index()
+                cache[name] = series
+            elif name == "line_ends":
+                cache[name] = line_end_coords(segments.geometry)
+            elif name == "length":
+                cache[name] = segments.length.values
+            elif name == "diversions_csr":
+                cache[name] = group_csr(
+                    segments.index.get_indexer(
+                        self.diversions["from_segnum"]), len(segments))
+            elif name == "to_idx":
+                cache[name] = to_index(
+                    self.segments["to_segnum"], self.segments.index)
+            elif name == "upstream_csr":
+                cache[name] = upstream_csr(self._get_topology("to_idx"))
+            elif name == "upstream_intervals":
+                self.logger.debug("evaluating upstream intervals")
+                cache[name] = upstream_intervals(
+                    self._get_topology("to_idx"),
+                    *self._get_topology("upstream_csr"))
+            elif name == "depth":
+                to_idx = self._get_topology("to_idx")
+                levels = outlet_levels(
+                    to_idx, *self._get_topology("upstream_csr"))
+                cache[name] = outlet_depth(to_idx, levels)
+            elif name == "ancestors":
+                self.logger.debug("evaluating ancestor table")
+                cache[name] = ancestor_table(
+                    self._get_topology("to_idx"), self._get_topology("depth"))
+            else:
+                raise KeyError(name)
+        return cache[name]
+
+    def _segnums_to_idx(self, segnums, name):
+        """Return array of positions for segnums, or raise IndexError."""
+        segnums = np.asarray(segnums)
+        idx = self.segments.index.get_indexer(segnums.ravel())
+        if (idx < 0).any():
+            diff = sorted(set(segnums.ravel()[idx < 0].tolist()))
+            raise IndexError(
+                f"{len(diff)} {name} "
+                f"segment{'' if len(diff) == 1 else 's'} "
+                f"not found in segments.index: {abbr_str(diff)}")
+        return idx.reshape(segnums.shape)
 
     def query(self, upstream=[], downstream=[], barrier=[],
               gather_upstream=False):
@@ -725,6 +943,12 @@ class SurfaceWaterNetwork:
         -------
         list
 
+        See also
+        --------
+        SurfaceWaterNetwork.is_upstream : Check several pairs of segnums.
+        SurfaceWaterNetwork.is_downstream : Check several pairs of segnums.
+        SurfaceWaterNetwork.upstream_segnums : Upstream of several segnums.
+
         """
         segments_index = self.segments.index
         segments_set = set(segments_index)
@@ -744,40 +968,278 @@ class SurfaceWaterNetwork:
                         f'{name} segnum {var} not found in segments.index')
                 return [var]
 
-        def go_upstream(segnum):
-            yield segnum
-            for from_segnum in from_segnums.get(segnum, []):
-                yield from go_upstream(from_segnum)
+        order, start, stop = self._get_topology("upstream_intervals")
+        indptr, indices = self._get_topology("upstream_csr")
+        barrier_idx = segments_index.get_indexer(
+            check_and_return_list(barrier, 'barrier'))
+        barrier_set = set(barrier_idx)
+        # headwater barriers are removed, otherwise only upstream is removed
+        barrier_hw = (stop - start)[barrier_idx] == 1
+        barrier_hw_set = set(barrier_idx[barrier_hw])
+
+        def go_upstream(idx):
+            idx0, idx1 = start[idx], stop[idx]
+            keep = np.ones(idx1 - idx0, dtype=bool)
+            barrier_start = start[barrier_idx]
+            sel = (barrier_start >= idx0) & (barrier_start < idx1)
+            for bidx, is_hw in zip(barrier_idx[sel], barrier_hw[sel]):
+                if is_hw and bidx != idx:
+                    keep[start[bidx] - idx0] = False
+                else:
+                    keep[start[bidx] + 1 - idx0:stop[bidx] - idx0] = False
+            return list(segments_index[order[idx0:idx1][keep]])
 
-        def go_downstream(segnum):
-            yield segnum
-            if segnum in to_segnums:
-                yield from go_downstream(to_segnums[segnum])
+        to_idx = self._get_topology("to_idx")
 
-        to_segnums = dict(self.to_segnums)
-        from_segnums = self.from_segnums
-        for barrier in check_and_return_list(barrier, 'barrier'):
-            try:
-                del from_segnums[barrier]
-            except KeyError:  # this is a tributary, remove value
-                from_segnums[to_segnums[barrier]].remove(barrier)
-            del to_segnums[barrier]
+        def go_downstream(idx):
+            while idx >= 0:
+                yield idx
+                if idx in barrier_set:
+                    break
+                idx = to_idx[idx]
 
         segnums = []
         for segnum in check_and_return_list(upstream, 'upstream'):
-            upsegnums = list(go_upstream(segnum))
+            upsegnums = go_upstream(segments_index.get_loc(segnum))
             segnums += upsegnums  # segnum inclusive
         for segnum in check_and_return_list(downstream, 'downstream'):
-            downsegnums = list(go_downstream(segnum))
-            segnums += downsegnums[1:]  # segnum exclusive
+            down_idx = list(go_downstream(segments_index.get_loc(segnum)))
+            segnums += list(segments_index[down_idx[1:]])  # segnum exclusive
             if gather_upstream:
-                for segnum in downsegnums[1:]:
-                    for from_segnum in from_segnums.get(segnum, []):
-                        if from_segnum not in downsegnums:
-                            upsegnums = list(go_upstream(from_segnum))
-                            segnums += upsegnums
+                down_set = set(down_idx)
+                for idx in down_idx[1:]:
+                    if idx in barrier_set:
+                        continue
+                    for from_idx in indices[indptr[idx]:indptr[idx + 1]]:
+                        if from_idx in down_set or from_idx in barrier_hw_set:
+                            continue
+                        segnums += go_upstream(from_idx)
         return segnums
 
+    def is_upstream(self, upstream, downstream):
+        """Return True where segnums are upstream of other segnums.
+
+        Segment numbers are inclusive, so a segnum is upstream of itself.
+        Several pairs of segnums are evaluated together, using interval
+        (pre-order) positions of upstream segments that are evaluated once
+        for the network.
+
+        Parameters
+        ----------
+        upstream, downstream : int or array_like
+            Segment number(s) from segments.index, which are broadcast
+            together.
+
+        Returns
+        -------
+        bool or numpy.ndarray
+
+        Examples
+        --------
+        >>> import swn
+        >>> from swn.spatial import wkt_to_geoseries
+        >>> lines = wkt_to_geoseries([
+        ...    "LINESTRING (60 100, 60  80)",
+        ...    "LINESTRING (40 130, 60 100)",
+        ...    "LINESTRING (70 130, 60 100)"])
+        >>> n = swn.SurfaceWaterNetwork.from_lines(lines)
+        >>> n.is_upstream(1, 0)
+        True
+        >>> n.is_upstream([1, 2, 0, 1], [0, 0, 1, 2])
+        array([ True,  True, False, False])
+        """
+        up_idx = self._segnums_to_idx(upstream, "upstream")
+        down_idx = self._segnums_to_idx(downstream, "downstream")
+        _, start, stop = self._get_topology("upstream_intervals")
+        up_start = start[up_idx]
+        res = (start[down_idx] <= up_start) & (up_start < stop[down_idx])
+        if res.ndim == 0:
+            return bool(res)
+        return res
+
+    def is_downstream(self, downstream, upstream):
+        """Return True where segnums are downstream of other segnums.
+
+        Segment numbers are inclusive, so a segnum is downstream of itself.
+        Several pairs of segnums are evaluated together, using a table of
+        downstream segments that is evaluated once for the network.
+
+        Parameters
+        ----------
+        downstream, upstream : int or array_like
+            Segment number(s) from segments.index, which are broadcast
+            together.
+
+        Returns
+        -------
+        bool or numpy.ndarray
+
+        Examples
+        --------
+        >>> import swn
+        >>> from swn.spatial import wkt_to_geoseries
+        >>> lines = wkt_to_geoseries([
+        ...    "LINESTRING (60 100, 60  80)",
+        ...    "LINESTRING (40 130, 60 100)",
+        ...    "LINESTRING (70 130, 60 100)"])
+        >>> n = swn.SurfaceWaterNetwork.from_lines(lines)
+        >>> n.is_downstream(0, 1)
+        True
+        >>> n.is_downstream([0, 0, 1, 2], [1, 2, 0, 1])
+        array([ True,  True, False, False])
+        """
+        down_idx, up_idx = np.broadcast_arrays(
+            self._segnums_to_idx(downstream, "downstream"),
+            self._segnums_to_idx(upstream, "upstream"))
+        depth = self._get_topology("depth")
+        steps = depth[up_idx] - depth[down_idx]
+        valid = (steps >= 0) & (depth[down_idx] >= 0)
+        lifted = lift(self._get_topology("ancestors"), up_idx,
+                      np.where(valid, steps, 0))
+        res = valid & (lifted == down_idx)
+        if res.ndim == 0:
+            return bool(res)
+        return res
+
+    def confluence(self, segnums1, segnums2):
+        """Return the first segnum downstream of both segnums.
+
+        This is also known as the lowest common ancestor. If one segnum is
+        downstream of the other, then it is returned. Several pairs of
+        segnums are evaluated together, using a table of downstream segments
+        that is evaluated once for the network.
+
+        Parameters
+        ----------
+        segnums1, segnums2 : int or array_like
+            Segment number(s) from segments.index, which are broadcast
+            together.
+
+        Returns
+        -------
+        scalar or numpy.ndarray
+            Segnum of confluence, or ``END_SEGNUM`` if the segnums do not
+            share an outlet.
+
+        Examples
+        --------
+        >>> import swn
+        >>> from swn.spatial import wkt_to_geoseries
+        >>> lines = wkt_to_geoseries([
+        ...    "LINESTRING (60 100, 60  80)",
+        ...    "LINESTRING (40 130, 60 100)",
+        ...    "LINESTRING (70 130, 60 100)"])
+        >>> n = swn.SurfaceWaterNetwork.from_lines(lines)
+        >>> n.confluence(1, 2)
+        0
+        >>> n.confluence([1, 1, 2], [2, 1, 0])
+        array([0, 1, 0])
+        """
+        idx = self._confluence_idx(segnums1, segnums2)[2]
+        res = np.where(
+            idx >= 0, self.segments.index.values[idx], self.END_SEGNUM)
+        if res.ndim == 0:
+            return res.item()
+        return res
+
+    def _confluence_idx(self, segnums1, segnums2):
+        """Return positions of segnums and their confluence."""
+        idx1, idx2 = np.broadcast_arrays(
+            self._segnums_to_idx(segnums1, "segnums1"),
+            self._segnums_to_idx(segnums2, "segnums2"))
+        idx = lowest_common_ancestor(
+            self._get_topology("ancestors"), self._get_topology("depth"),
+            idx1, idx2)
+        return idx1, idx2, idx
+
+    def path_length(self, segnums1, segnums2):
+        """Return distance along the network between segnums.
+
+        Distance is evaluated between the upstream ends of each segment
+        via their confluence, using the ``dist_to_outlet`` column in segments.
+        If one segnum is downstream of the other, this is the distance
+        between the upstream ends of the segments along the flow path.
+
+        Parameters
+        ----------
+        segnums1, segnums2 : int or array_like
+            Segment number(s) from segments.index, which are broadcast
+            together.
+
+        Returns
+        -------
+        float or numpy.ndarray
+            Distance, or NaN if the segnums do not share an outlet.
+
+        Examples
+        --------
+        >>> import swn
+        >>> from swn.spatial import wkt_to_geoseries
+        >>> lines = wkt_to_geoseries([
+        ...    "LINESTRING (60 100, 60  80)",
+        ...    "LINESTRING (40 130, 60 100)",
+        ...    "LINESTRING (70 130, 60 100)"])
+        >>> n = swn.SurfaceWaterNetwork.from_lines(lines)
+        >>> n.path_length(1, 0)
+        36.05551275463989
+        >>> n.path_length([1, 1], [2, 1])
+        array([67.67828936,  0.        ])
+        """
+        if "dist_to_outlet" not in self.segments.columns:
+            raise ValueError("'dist_to_outlet' not found in segments.columns")
+        idx1, idx2, idx = self._confluence_idx(segnums1, segnums2)
+        dist = self.segments["dist_to_outlet"].values
+        valid = idx >= 0
+        res = np.where(
+            valid,
+            dist[idx1] + dist[idx2] - 2.0 * dist[np.where(valid, idx, 0)],
+            np.nan)
+        if res.ndim == 0:
+            return float(res)
+        return res
+
+    def upstream_segnums(self, segnums):
+        """Return segnums upstream (inclusive) for several segnums.
+
+        This is similar to :py:meth:`SurfaceWaterNetwork.query` with
+        ``upstream``, but returns a result for each segnum. Each upstream
+        list is a slice of interval (pre-order) positions of upstream segments
+        that are evaluated once for the network.
+
+        Parameters
+        ----------
+        segnums : int or array_like
+            Segment number(s) from segments.index.
+
+        Returns
+        -------
+        pandas.Series
+            List of upstream segnums, indexed by ``segnums``.
+
+        Examples
+        --------
+        >>> import swn
+        >>> from swn.spatial import wkt_to_geoseries
+        >>> lines = wkt_to_geoseries([
+        ...    "LINESTRING (60 100, 60  80)",
+        ...    "LINESTRING (40 130, 60 100)",
+        ...    "LINESTRING (70 130, 60 100)"])
+        >>> n = swn.SurfaceWaterNetwork.from_lines(lines)
+        >>> n.upstream_segnums([0, 2])
+        0    [0, 1, 2]
+        2          [2]
+        Name: upstream_segnums, dtype: object
+        """
+        segnums = np.atleast_1d(segnums)
+        idx = self._segnums_to_idx(segnums, "upstream")
+        order, start, stop = self._get_topology("upstream_intervals")
+        upstream = self.segments.index.values[order]
+        values = [
+            upstream[i0:i1].tolist() for i0, i1 in zip(start[idx], stop[idx])]
+        index = pd.Index(segnums, name=self.segments.index.name)
+        return pd.Series(values, index=index, name="upstream_segnums",
+                         dtype=object)
+
     def aggregate(self, segnums, follow_up='upstream_length'):
         """Aggregate segments (and catchments) to a coarser network of segnums.
 
@@ -796,9 +1258,11 @@ class SurfaceWaterNetwork:
         SurfaceWaterNetwork
             Columns 'agg_patch' and 'agg_path' are added to segments to
             provide a segnum list from the original surface water network
-            to the aggregated object. Column 'agg_unpath' lists other
-            segnums that flow into 'agg_path'. Also 'from_segnums' is updated
-            to reflect the uppermost segment.
+            to the aggregated object. Segnums in 'agg_patch' are ordered
+            depth-first from the junction upstream, where tributaries are
+            visited in the order of ``segments.index``. Column 'agg_unpath'
+            lists other segnums that flow into 'agg_path'. Also
+            'from_segnums' is updated to reflect the uppermost segment.
 
         """
         if (isinstance(follow_up, str) and follow_up in self.segments.columns):
@@ -818,61 +1282,61 @@ class SurfaceWaterNetwork:
                 f"segments.index: {abbr_str(diff)}")
         self.logger.debug(
             'aggregating at least %d segnums (junctions)', len(junctions))
-        from_segnums = self.from_segnums
-        to_segnums = dict(self.to_segnums)
-
-        # trace down from each segnum to the outlet - keep this step simple
-        traced_segnums = list()
-
-        def trace_down(segnum):
-            if segnum is not None and segnum not in traced_segnums:
-                traced_segnums.append(segnum)
-                trace_down(to_segnums.get(segnum, None))
-
-        for segnum in junctions:
-            trace_down(segnum)
-
+        segments_index = self.segments.index
+        segnums = segments_index.values
+        to_idx = self._get_topology("to_idx")
+        indptr, indices = self._get_topology("upstream_csr")
+        num_segments = len(to_idx)
+
+        def upstream(idx):
+            return indices[indptr[idx]:indptr[idx + 1]]
+
+        def sorted_idx(idx):
+            return sorted(idx, key=segnums.__getitem__)
+
+        # trace down from each segnum to the outlet
+        junctions_idx = list(segments_index.get_indexer(junctions))
+        is_junction = np.zeros(num_segments, dtype=bool)
+        is_junction[junctions_idx] = True
+        is_traced = downstream_mask(to_idx, junctions_idx)
         self.logger.debug(
             'traced down initial junctions to assemble %d traced segnums: %s',
-            len(traced_segnums), abbr_str(traced_segnums))
+            is_traced.sum(), abbr_str(list(segments_index[is_traced])))
 
         # trace up from each junction, add extra junctions as needed
-        traset = set(traced_segnums)
-        extra_junctions = []
-
-        def trace_up(segnum):
-            if segnum not in from_segnums:
-                return
-            up_segnums = from_segnums[segnum]
-            segsij = up_segnums.intersection(junctions_set)
-            segsit = up_segnums.intersection(traset)
-            if len(segsij) > 0:
-                segsdj = up_segnums.difference(junctions_set)
-                segsdjdt = segsdj.difference(segsit)
-                for up_segnum in sorted(segsdjdt):
+        extra_junctions_idx = []
+        stack = [(idx, None) for idx in reversed(junctions_idx)]
+        while stack:
+            idx, fork_idx = stack.pop()
+            if fork_idx is not None:
+                self.logger.debug(
+                    'adding extra junction %s above fork at segnum %s',
+                    segnums[idx], segnums[fork_idx])
+                extra_junctions_idx.append(idx)
+            up = upstream(idx)
+            up_traced = up[is_traced[up]]
+            if is_junction[up].any():
+                untraced = up[~is_junction[up] & ~is_traced[up]]
+                for up_idx in sorted_idx(untraced):
                     self.logger.debug(
                         'adding extra junction %s above segnum %s',
-                        up_segnum, segnum)
-                    extra_junctions.append(up_segnum)
+                        segnums[up_idx], segnums[idx])
+                    extra_junctions_idx.append(up_idx)
                     # but don't follow up these, as it's untraced
-            elif len(segsit) > 1:
-                for up_segnum in sorted(segsit):
-                    self.logger.debug(
-                        'adding extra junction %s above fork at segnum %s',
-                        up_segnum, segnum)
-                    extra_junctions.append(up_segnum)
-                    trace_up(up_segnum)
-            elif len(segsit) == 1:
-                trace_up(segsit.pop())
-
-        for segnum in junctions:
-            trace_up(segnum)
-
-        if len(extra_junctions) == 0:
+            elif len(up_traced) > 1:
+                stack.extend(
+                    (up_idx, idx)
+                    for up_idx in reversed(sorted_idx(up_traced)))
+            elif len(up_traced) == 1:
+                stack.append((up_traced[0], None))
+
+        if len(extra_junctions_idx) == 0:
             self.logger.debug('traced up; no extra junctions added')
         else:
+            extra_junctions = list(segnums[extra_junctions_idx])
             junctions += extra_junctions
-            junctions_set = set(junctions)
+            junctions_idx += extra_junctions_idx
+            is_junction[extra_junctions_idx] = True
             if len(extra_junctions) == 1:
                 self.logger.debug(
                     'traced up; added 1 extra junction: %s', extra_junctions)
@@ -881,74 +1345,79 @@ class SurfaceWaterNetwork:
                     'traced up; added %d extra junctions: %s',
                     len(extra_junctions), abbr_str(extra_junctions))
 
-        # aggregate segnums above each junction, build larger polygons
-        def up_patch_segnums(segnum):
-            yield segnum
-            for up_segnum in from_segnums.get(segnum, []):
-                if up_segnum not in junctions_set:
-                    yield from up_patch_segnums(up_segnum)
-
-        trbset = traset.difference(junctions_set)
-
-        # aggregate segnums in a path across an internal subcatchment
-        def up_path_internal_segnums(segnum):
-            yield segnum
-            up_segnums = from_segnums.get(segnum, set()).intersection(trbset)
-            if len(up_segnums) == 1:
-                yield from up_path_internal_segnums(up_segnums.pop())
-
-        # aggregate segnums in a path up a headwater, choosing untraced path
-        def up_path_headwater_segnums(segnum):
-            yield segnum
-            up_segnums = from_segnums.get(segnum, set())
-            if len(up_segnums) == 1:
-                yield from up_path_headwater_segnums(up_segnums.pop())
-            elif len(up_segnums) > 1:
-                up_segnum = self.segments.loc[up_segnums].sort_values(
-                    follow_up, ascending=False).index[0]
-                # self.logger.debug('untraced path %s: %s -> %s',
-                #                   segnum, up_segnums, up_segnum)
-                yield from up_path_headwater_segnums(up_segnum)
-
-        junctions_goto = {s: to_segnums.get(s, None) for s in junctions}
-        agg_patch = pd.Series(dtype=object)
-        agg_path = pd.Series(dtype=object)
-        agg_unpath = pd.Series(dtype=object)
+        # label segments with the first junction at or downstream
+        patch = np.full(num_segments, -1, dtype=np.intp)
+        for level in outlet_levels(to_idx, indptr, indices):
+            down = to_idx[level]
+            down_patch = np.where(down >= 0, patch[np.maximum(down, 0)], -1)
+            patch[level] = np.where(is_junction[level], level, down_patch)
+        # aggregate segnums above each junction, ordered depth-first
+        _, start, _ = self._get_topology("upstream_intervals")
+        in_patch = np.flatnonzero(patch >= 0)
+        in_patch = in_patch[np.lexsort((start[in_patch], patch[in_patch]))]
+        patch_indptr = np.zeros(num_segments + 1, dtype=np.intp)
+        np.cumsum(
+            np.bincount(patch[in_patch], minlength=num_segments),
+            out=patch_indptr[1:])
+        # junctions are headwater if no other junctions flow to the patch
+        junctions_to_idx = to_idx[junctions_idx]
+        junctions_to_idx = junctions_to_idx[junctions_to_idx >= 0]
+        down_patch = patch[junctions_to_idx]
+        has_up_junction = np.zeros(num_segments, dtype=bool)
+        has_up_junction[down_patch[down_patch >= 0]] = True
+        is_trb = is_traced & ~is_junction
+        follow_up_values = self.segments[follow_up].values
+
+        agg_patch = []
+        agg_path = []
+        agg_unpath = []
+        lines = []
+        geometry = self.segments.geometry.values
+        for idx in junctions_idx:
+            agg_patch.append(list(segnums[
+                in_patch[patch_indptr[idx]:patch_indptr[idx + 1]]]))
+            path_idx = [idx]
+            if has_up_junction[idx]:
+                # aggregate segnums in a path across an internal subcatchment
+                up = upstream(idx)
+                up = up[is_trb[up]]
+                while len(up) == 1:
+                    path_idx.append(up[0])
+                    up = upstream(up[0])
+                    up = up[is_trb[up]]
+            else:
+                # aggregate segnums in a path up a headwater, choosing path
+                # with largest follow_up value
+                up = upstream(idx)
+                while len(up) > 0:
+                    up_next = up[np.argmax(follow_up_values[up])]
+                    path_idx.append(up_next)
+                    up = upstream(up_next)
+            agg_path.append(list(segnums[path_idx]))
+            # gather unfollowed paths, e.g. to accumulate flow
+            path_set = set(path_idx)
+            agg_unpath_l = []
+            for aidx in path_idx:
+                agg_unpath_l += list(segnums[sorted_idx(
+                    [i for i in upstream(aidx) if i not in path_set])])
+            agg_unpath.append(agg_unpath_l)
+            lines.append(linemerge(list(geometry[path_idx[::-1]])))
+
+        with ignore_shapely_warnings_for_object_array():
+            lines = pd.Series(lines, index=junctions, dtype=object)
+        agg_patch = pd.Series(agg_patch, index=junctions, dtype=object)
+        agg_path = pd.Series(agg_path, index=junctions, dtype=object)
+        agg_unpath = pd.Series(agg_unpath, index=junctions, dtype=object)
         if self.catchments is not None:
-            polygons = pd.Series(dtype=object)
+            # dissolve all patches with a grouped union
+            patches = geopandas.GeoDataFrame(
+                {"junction": segnums[patch[in_patch]]},
+                geometry=self.catchments.values[in_patch],
+                crs=self.catchments.crs)
+            polygons = patches.dissolve(by="junction").geometry
+            polygons = polygons.reindex(junctions)
         else:
             polygons = None
-        lines = pd.Series(dtype=object)
-
-        for segnum in junctions:
-            catchment_segnums = list(up_patch_segnums(segnum))
-            agg_patch.at[segnum] = catchment_segnums
-            if polygons is not None:
-                polygons.at[segnum] = cascaded_union(
-                        list(self.catchments.loc[catchment_segnums]))
-            # determine if headwater or not, if any other junctions go to it
-            is_headwater = True
-            for key, value in junctions_goto.items():
-                if value in catchment_segnums:
-                    is_headwater = False
-                    break
-            if is_headwater:
-                agg_path_l = list(up_path_headwater_segnums(segnum))
-            else:  # internal
-                agg_path_l = list(up_path_internal_segnums(segnum))
-            agg_path.at[segnum] = agg_path_l
-            # gather unfollowed paths, e.g. to accumulate flow
-            agg_path_s = set(agg_path_l)
-            agg_unpath_l = []
-            for aseg in agg_path_l:
-                agg_unpath_l += sorted(
-                        from_segnums.get(aseg, set()).difference(agg_path_s))
-            agg_unpath.at[segnum] = agg_unpath_l
-            # agg_path_l.reverse()
-            seg_geom = linemerge(list(
-                self.segments.loc[reversed(agg_path_l), 'geometry']))
-            with ignore_shapely_warnings_for_object_array():
-                lines.at[segnum] = seg_geom
 
         # Create GeoSeries and copy a few other properties
         lines = geopandas.GeoSeries(lines, crs=self.segments.crs)
@@ -975,37 +1444,69 @@ class SurfaceWaterNetwork:
 
         Parameters
         ----------
-        values : pandas.Series
-            Series of values that align with the index.
+        values : pandas.Series, pandas.DataFrame or numpy.ndarray
+            Series of values that align with the index. Several columns
+            of values (e.g. time steps) can be accumulated together with a
+            DataFrame, which also must align with the index, or a 1D or 2D
+            array with the first dimension along segments.
 
         Returns
         -------
-        pandas.Series
-            Accumulated values.
+        pandas.Series, pandas.DataFrame or numpy.ndarray
+            Accumulated values, with the same type as ``values``.
 
+        Examples
+        --------
+        >>> import pandas as pd
+        >>> import swn
+        >>> from swn.spatial import wkt_to_geoseries
+        >>> lines = wkt_to_geoseries([
+        ...    "LINESTRING (60 100, 60  80)",
+        ...    "LINESTRING (40 130, 60 100)",
+        ...    "LINESTRING (70 130, 60 100)"])
+        >>> n = swn.SurfaceWaterNetwork.from_lines(lines)
+        >>> n.accumulate_values(pd.Series([2.0, 3.0, 4.0], name="runoff"))
+        0    9.0
+        1    3.0
+        2    4.0
+        Name: accumulated_runoff, dtype: float64
+        >>> n.accumulate_values(
+        ...     pd.DataFrame({"a": [2.0, 3.0, 4.0], "b": [1.0, 0.0, 1.0]}))
+             a    b
+        0  9.0  2.0
+        1  3.0  0.0
+        2  4.0  1.0
         """
-        if not isinstance(values, pd.Series):
-            raise ValueError('values must be a pandas Series')
-        elif (len(values.index) != len(self.segments.index) or
-                not (values.index == self.segments.index).all()):
-            raise ValueError('index is different')
+        segments_index = self.segments.index
+        if isinstance(values, (pd.Series, pd.DataFrame)):
+            if (len(values.index) != len(segments_index) or
+                    not (values.index == segments_index).all()):
+                raise ValueError('index is different')
+        elif isinstance(values, np.ndarray):
+            if values.ndim not in (1, 2):
+                raise ValueError('values array must be 1D or 2D')
+            elif values.shape[0] != len(segments_index):
+                raise ValueError(
+                    'first dimension of values array is different than the '
+                    'number of segments')
+        else:
+            raise ValueError(
+                'values must be a pandas Series, DataFrame or numpy array')
+        to_idx = self._get_topology("to_idx")
+        if isinstance(values, np.ndarray):
+            return accumulate_downstream(to_idx, values)
         accum = values.copy()
-        if accum.name is not None:
+        accum.iloc[:] = accumulate_downstream(to_idx, values.values)
+        if isinstance(accum, pd.Series) and accum.name is not None:
             accum.name = f"accumulated_{accum.name}"
-        segnumset = set(self.segments.index)
-        for segnum in self.segments.sort_values('sequence').index:
-            from_segnums = self.segments.at[segnum, 'from_segnums']
-            if from_segnums:
-                from_segnums = from_segnums.intersection(segnumset)
-                if from_segnums:
-                    accum[segnum] += sum(accum[s] for s in from_segnums)
         return accum
 
     def evaluate_upstream_length(self):
         """Evaluate upstream length of segments, adds to segments."""
         self.logger.debug('evaluating upstream length')
-        self.segments['upstream_length'] = \
-            self.accumulate_values(self.segments.length)
+        length = self.segments.length.values
+        self._set_topology("length", length)
+        self.segments['upstream_length'] = self.accumulate_values(length)
 
     def evaluate_upstream_area(self):
         """Evaluate upstream area from catchments, adds to segments."""
@@ -1193,15 +1694,19 @@ class SurfaceWaterNetwork:
             to_segnums = self.to_segnums
             df.loc[to_segnums.index, c2] = df.loc[to_segnums, c1].values
         elif method == "additive":
-            for segnum, from_segnums in self.from_segnums.iteritems():
-                if len(from_segnums) <= 1:
-                    continue
+            to_idx = self._get_topology("to_idx")
+            is_down = to_idx >= 0
+            num_from = np.bincount(to_idx[is_down], minlength=len(df))
+            # segments that join with other tributaries
+            sel = np.flatnonzero(is_down)
+            sel = sel[num_from[to_idx[sel]] > 1]
+            if len(sel) > 0:
                 # get proportions of upstream values
-                from_value1 = df.loc[sorted(from_segnums), c1]
-                from_value1_prop = from_value1 / from_value1.sum()
-                from_value2 = df.loc[segnum, c1] * from_value1_prop
-                for from_segnum, v2 in from_value2.iteritems():
-                    df.loc[from_segnum, c2] = v2
+                value1 = df[c1].values
+                down = to_idx[sel]
+                from_sum = pd.Series(value1[sel]).groupby(down).sum()
+                from_prop = value1[sel] / from_sum[down].values
+                df.loc[df.index[sel], c2] = value1[down] * from_prop
         elif method == "constant":
             pass
         if value_out is not None:
@@ -1238,106 +1743,52 @@ class SurfaceWaterNetwork:
         elif not self.has_z:
             raise AttributeError('line geometry does not have Z dimension')
 
-        geom_name = self.segments.geometry.name
-        from_segnums = self.from_segnums
-        to_segnums = dict(self.to_segnums)
-        modified_d = {}  # key is segnum, value is drop amount (+ve is down)
+        segments = self.segments
+        geom_name = segments.geometry.name
+        coords, indptr = line_coords(segments.geometry)
+        # elevations are adjusted along each segment in flow sequence
+        profile = adjust_profiles(
+            coords, indptr, self._get_topology("to_idx"),
+            segments["sequence"].values, min_slope.values)
+        num_adjusted = profile["num_adjusted"]
         self.messages = []
-
-        # Build elevation profile list storing three values per coordinate:
-        #   [dx, elev], where dx is 2D distance from upstream coord
-        #   elev is the adjusted elevation
-        profile_d = {}  # key is segnum, value is list of profile tuples
-        for segnum, geom in self.segments.geometry.iteritems():
-            coords = geom.coords[:]  # coordinates
-            x0, y0, z0 = coords[0]  # upstream coordinate
-            profile = [[0.0, z0]]
-            for idx, (x1, y1, z1) in enumerate(coords[1:], 1):
-                dx = sqrt((x0 - x1) ** 2 + (y0 - y1) ** 2)
-                profile.append([dx, z1])
-                x0, y0, z0 = x1, y1, z1
-            profile_d[segnum] = profile
-        # Process elevation adjustments in flow sequence
-        for segnum in self.segments.sort_values('sequence').index:
-            if segnum not in modified_d:
-                modified_d[segnum] = []
-            profile = profile_d[segnum]
-            # Get upstream last coordinates, and check if drop0 needs updating
-            dx, z0 = profile[0]
-            if segnum in from_segnums:
-                last_zs = [profile_d[n][-1][1] for n in from_segnums[segnum]]
-                if last_zs:
-                    last_zs_min = min(last_zs)
-                    if last_zs_min < z0:
-                        drop = z0 - last_zs_min
-                        z0 -= drop
-                        profile[0][1] = z0
-                        modified_d[segnum].append(drop)
-                    elif min(last_zs) > z0:
-                        raise NotImplementedError('unexpected scenario')
-            # Check and enforce minimum slope for remaining coords
-            for idx, (dx, z1) in enumerate(profile[1:], 1):
-                dz = z0 - z1
-                slope = dz / dx
-                if slope < min_slope[segnum]:
-                    drop = z1 - z0 + dx * min_slope[segnum]
-                    z1 -= drop
-                    profile[idx][1] = z1
-                    modified_d[segnum].append(drop)
-                    # print('adj', z0 + drop0, dx * min_slope[segnum], drop)
-                z0 = z1
-            # Ensure last coordinate matches other segments that end here
-            if segnum in to_segnums:
-                beside_segnums = from_segnums[to_segnums[segnum]]
-                if beside_segnums:
-                    last_zs = [profile_d[n][-1][1] for n in beside_segnums]
-                    last_zs_min = min(last_zs)
-                    if max(last_zs) != last_zs_min:
-                        for bsegnum in beside_segnums:
-                            if profile_d[bsegnum][-1][1] != last_zs_min:
-                                drop = profile_d[bsegnum][-1][1] - last_zs_min
-                                profile_d[bsegnum][-1][1] -= drop
-                                if bsegnum not in modified_d:
-                                    modified_d[bsegnum] = [drop]
-                                elif len(modified_d[bsegnum]) == 0:
-                                    modified_d[bsegnum].append(drop)
-                                else:
-                                    modified_d[bsegnum][-1] += drop
-        # Adjust geometries and report some information on adjustments
-        profiles = []
-        for segnum in self.segments.index:
-            profile = profile_d[segnum]
-            modified = modified_d[segnum]
-            if modified:
-                if len(modified) == 1:
-                    msg = (
-                        'segment %s: adjusted 1 coordinate elevation by %.3f',
-                        segnum, modified[0])
-                else:
-                    msg = (
-                        'segment %s: adjusted %d coordinate elevations between'
-                        ' %.3f and %.3f', segnum, len(modified),
-                        min(modified), max(modified))
-                self.logger.debug(*msg)
-                self.messages.append(msg[0] % msg[1:])
-                coords = self.segments.geometry[segnum].coords[:]
-                dist = 0.0
-                for idx in range(len(profile)):
-                    dist += profile[idx][0]
-                    profile[idx][0] = dist
-                    coords[idx] = coords[idx][0:2] + (profile[idx][1],)
-                self.segments.at[segnum, geom_name] = LineString(coords)
+        for idx in np.flatnonzero(num_adjusted > 0):
+            segnum = segments.index[idx]
+            if num_adjusted[idx] == 1:
+                msg = (
+                    'segment %s: adjusted 1 coordinate elevation by %.3f',
+                    segnum, profile["max_adjusted"][idx])
             else:
+                msg = (
+                    'segment %s: adjusted %d coordinate elevations between'
+                    ' %.3f and %.3f', segnum, num_adjusted[idx],
+                    profile["min_adjusted"][idx], profile["max_adjusted"][idx])
+            self.logger.debug(*msg)
+            self.messages.append(msg[0] % msg[1:])
+        if self.logger.isEnabledFor(logging.DEBUG):
+            for segnum in segments.index[num_adjusted == 0]:
                 self.logger.debug('segment %s: not adjusted', segnum)
-                dist = 0.0
-                for idx in range(len(profile)):
-                    dist += profile[idx][0]
-                    profile[idx][0] = dist
-            profiles.append(LineString(profile))
-        self.profiles = geopandas.GeoSeries(
-                profiles, index=self.segments.index)
-
-    def remove(self, condition=False, segnums=[]):
+        # Adjust geometries of modified segments
+        coords[:, 2] = profile["z"]
+        modified = np.flatnonzero(num_adjusted > 0)
+        if len(modified) > 0:
+            pos, _, counts = csr_gather(
+                indptr, np.arange(len(coords)), modified)
+            sub_indptr = np.zeros(len(modified) + 1, dtype=np.intp)
+            np.cumsum(counts, out=sub_indptr[1:])
+            geoms = segments.geometry.values.copy()
+            with ignore_shapely_warnings_for_object_array():
+                geoms[modified] = lines_from_coords(coords[pos], sub_indptr)
+            segments[geom_name] = geoms
+            self._set_topology(
+                "line_ends", (coords[indptr[:-1]], coords[indptr[1:] - 1]))
+        with ignore_shapely_warnings_for_object_array():
+            self.profiles = geopandas.GeoSeries(
+                lines_from_coords(
+                    np.column_stack([profile["dist"], profile["z"]]), indptr),
+                index=segments.index)
+
+    def remove(self, condition=False, segnums=[], update=False):
         """Remove segments (and catchments).
 
         Parameters
@@ -1347,12 +1798,34 @@ class SurfaceWaterNetwork:
             Combined with 'segnums'. Defaut False (keep all).
         segnums : list
             List of segnums to remove. Combined with 'condition'. Default [].
+        update : bool, default False
+            If False (default), attributes of the remaining segments are not
+            modified, so ``from_segnums`` can refer to removed segments, e.g.
+            to specify inflow from outside of the network. If True, segments
+            upstream of removed segments become outlets, and ``from_segnums``
+            and network attributes are updated for the affected segments.
 
         Returns
         -------
         None
 
-        """
+        Examples
+        --------
+        >>> import swn
+        >>> from swn.spatial import wkt_to_geoseries
+        >>> lines = wkt_to_geoseries([
+        ...    "LINESTRING (60 100, 60  80)",
+        ...    "LINESTRING (40 130, 60 100)",
+        ...    "LINESTRING (70 130, 60 100)"])
+        >>> lines.index += 100
+        >>> n = swn.SurfaceWaterNetwork.from_lines(lines)
+        >>> n.remove(segnums=[101], update=True)
+        >>> n.segments[["to_segnum", "from_segnums", "sequence", "stream_order"]]
+             to_segnum from_segnums  sequence  stream_order
+        100          0        {102}         2             1
+        102        100           {}         1             1
+
+        """  # noqa
         condition = self.segments_series(condition, "condition").astype(bool)
         if condition.any():
             self.logger.debug(
@@ -1380,11 +1853,268 @@ class SurfaceWaterNetwork:
             self.logger.info(
                 'removing %d of %d segments (%.2f%%)', sel.sum(),
                 len(segments_index), sel.sum() * 100.0 / len(segments_index))
-            self._segments = self.segments.loc[~sel]
+            cache = self._topology_cache()
+            geom_cache = {
+                name: cache[name] for name in ("line_ends", "length")
+                if name in cache}
+            if update:
+                segments = self.segments
+                removed = segments.index[sel]
+                down_segnums = segments.loc[sel, "to_segnum"]
+                down_segnums = down_segnums[
+                    ~down_segnums.isin(removed) &
+                    (down_segnums != self.END_SEGNUM)].unique()
+                self._segments = segments.loc[~sel].copy()
+                is_cut = self._segments["to_segnum"].isin(removed)
+                self._segments.loc[is_cut, "to_segnum"] = self.END_SEGNUM
+            else:
+                self._segments = self.segments.loc[~sel]
+            self.topology_changed()
+            keep = ~sel.values
+            if "line_ends" in geom_cache:
+                self._set_topology("line_ends", tuple(
+                    coords[keep] for coords in geom_cache["line_ends"]))
+            if "length" in geom_cache:
+                self._set_topology("length", geom_cache["length"][keep])
             if self.catchments is not None:
                 self.catchments = self.catchments.loc[~sel]
+            if update:
+                idx = self._segments.index.get_indexer(
+                    list(is_cut.index[is_cut]) + list(down_segnums))
+                self._update_attributes(idx)
         return
 
+    def add_segments(self, lines, polygons=None, snap_tolerance=None):
+        """Add segments (and catchments) and connect these to the network.
+
+        Line ends of new segments are connected to new or existing segments,
+        and existing outlets are connected to new segments. Network
+        attributes are updated for the affected segments.
+
+        Parameters
+        ----------
+        lines : geopandas.GeoSeries
+            New lines with ``LINESTRING`` or ``LINESTRING Z`` geometries.
+            Index is used for segment numbers, which must not be found in
+            ``segments.index``.
+        polygons : geopandas.GeoSeries, optional
+            Catchment polygons for new lines, required if catchments are set.
+        snap_tolerance : float, optional
+            If None (default), line ends must exactly match in 2D to be
+            connected. Otherwise line ends are connected if they are within
+            this distance, preferring the closest. This option requires scipy.
+
+        Returns
+        -------
+        None
+
+        Examples
+        --------
+        >>> import swn
+        >>> from swn.spatial import wkt_to_geoseries
+        >>> lines = wkt_to_geoseries([
+        ...    "LINESTRING (60 100, 60  80)",
+        ...    "LINESTRING (40 130, 60 100)"])
+        >>> lines.index += 100
+        >>> n = swn.SurfaceWaterNetwork.from_lines(lines)
+        >>> new_lines = wkt_to_geoseries(["LINESTRING (70 130, 60 100)"])
+        >>> new_lines.index += 102
+        >>> n.add_segments(new_lines)
+        >>> n.segments[["to_segnum", "from_segnums", "sequence", "stream_order"]]
+             to_segnum from_segnums  sequence  stream_order
+        100          0   {101, 102}         3             2
+        101        100           {}         2             1
+        102        100           {}         1             1
+
+        """  # noqa
+        if not isinstance(lines, geopandas.GeoSeries):
+            raise ValueError('lines must be a GeoSeries')
+        elif len(lines) == 0:
+            raise ValueError('one or more lines are required')
+        elif not (lines.geom_type == 'LineString').all():
+            raise ValueError('lines must all be LineString types')
+        segments = self.segments
+        found = lines.index[
+            lines.index.isin(segments.index) |
+            (lines.index == self.END_SEGNUM)]
+        if len(found) > 0:
+            raise IndexError(
+                f"{len(found)} segnums already found in segments.index or "
+                f"is END_SEGNUM: {abbr_str(list(found))}")
+        if self.catchments is not None:
+            if not isinstance(polygons, geopandas.GeoSeries):
+                raise ValueError(
+                    "polygons must be a GeoSeries, since catchments are set")
+            elif (len(polygons.index) != len(lines.index) or
+                    not (polygons.index == lines.index).all()):
+                raise ValueError("polygons.index is different than for lines")
+        elif polygons is not None:
+            raise ValueError("polygons can't be added without catchments")
+        num_segments = len(segments)
+        new_idx = np.arange(num_segments, num_segments + len(lines))
+        start_coords, end_coords = self._get_topology("line_ends")
+        length = self._get_topology("length")
+        new_start_coords, new_end_coords = line_end_coords(lines)
+        all_start_coords = np.concatenate([start_coords, new_start_coords])
+
+        # Connect ends of new segments to start of new or existing segments
+        new = geopandas.GeoDataFrame(geometry=lines)
+        new["to_segnum"] = self.END_SEGNUM
+        end1, start2, _ = match_coords(
+            new_end_coords[:, :2], all_start_coords[:, :2], snap_tolerance)
+        sel = new_idx[end1] != start2
+        end1, start2 = end1[sel], start2[sel]
+        end1, first = np.unique(end1, return_index=True)
+        all_index = segments.index.append(lines.index)
+        new.iloc[end1, new.columns.get_loc("to_segnum")] = \
+            all_index[start2[first]]
+
+        # Connect existing outlets to start of new segments
+        outlets_idx = np.flatnonzero(
+            segments["to_segnum"].values == self.END_SEGNUM)
+        end1, start2, _ = match_coords(
+            end_coords[outlets_idx, :2], new_start_coords[:, :2],
+            snap_tolerance)
+        end1, first = np.unique(end1, return_index=True)
+        connected_idx = outlets_idx[end1]
+        if len(connected_idx) > 0:
+            segments = segments.copy()
+            segments.iloc[
+                connected_idx, segments.columns.get_loc("to_segnum")] = \
+                lines.index[start2[first]]
+        self.logger.info(
+            "adding %d segments, connecting to %d existing outlets",
+            len(lines), len(connected_idx))
+
+        # Default values for columns, which are updated afterwards
+        defaults = {
+            "from_segnums": None, "cat_group": self.END_SEGNUM,
+            "num_to_outlet": 0, "dist_to_outlet": 0.0, "sequence": -1,
+            "stream_order": 0, "upstream_length": 0.0, "upstream_area": 0.0,
+            "diversions": None}
+        for name in segments.columns:
+            if name in defaults:
+                if defaults[name] is None:
+                    new[name] = [set() for _ in range(len(new))]
+                else:
+                    new[name] = defaults[name]
+        self._segments = pd.concat([segments, new])
+        if self.catchments is not None:
+            self._catchments = pd.concat([self.catchments, polygons])
+        self.topology_changed()
+        self._set_topology("line_ends", (
+            all_start_coords, np.concatenate([end_coords, new_end_coords])))
+        self._set_topology("length", np.concatenate(
+            [length, lines.length.values]))
+        self._update_attributes(np.concatenate([new_idx, connected_idx]))
+
+    def replace_geometry(self, geometry):
+        """Replace geometry of segments, and update network attributes.
+
+        Connections between segments are not modified, but a warning is
+        shown if a new line end is not connected to the downstream segment.
+        Distance-based attributes (``dist_to_outlet``, ``upstream_length``)
+        are updated for the affected segments.
+
+        Parameters
+        ----------
+        geometry : geopandas.GeoSeries
+            New ``LINESTRING`` or ``LINESTRING Z`` geometries, with an index
+            found in ``segments.index``.
+
+        Returns
+        -------
+        None
+
+        """
+        if not isinstance(geometry, geopandas.GeoSeries):
+            raise ValueError('geometry must be a GeoSeries')
+        elif not (geometry.geom_type == 'LineString').all():
+            raise ValueError('geometry must all be LineString types')
+        idx = self._segnums_to_idx(geometry.index, "geometry")
+        start_coords, end_coords = self._get_topology("line_ends")
+        length = self._get_topology("length").copy()
+        length[idx] = geometry.length.values
+        new_start_coords, new_end_coords = line_end_coords(geometry)
+        start_coords = start_coords.copy()
+        end_coords = end_coords.copy()
+        start_coords[idx] = new_start_coords
+        end_coords[idx] = new_end_coords
+        # check connections to and from the replaced segments
+        to_idx = self._get_topology("to_idx")
+        indptr, indices = self._get_topology("upstream_csr")
+        check = np.concatenate([idx, csr_gather(indptr, indices, idx)[0]])
+        check = np.unique(check[to_idx[check] >= 0])
+        is_disconnected = (
+            end_coords[check, :2] != start_coords[to_idx[check], :2]
+        ).any(axis=1)
+        for segnum in self.segments.index[check[is_disconnected]]:
+            self.logger.warning(
+                "segment %s end is not connected to downstream segment %s",
+                segnum, self.segments.at[segnum, "to_segnum"])
+        geom_name = self.segments.geometry.name
+        values = self.segments[geom_name].copy()
+        values.iloc[idx] = geometry.values
+        self.segments[geom_name] = values
+        self.topology_changed()
+        self._set_topology("line_ends", (start_coords, end_coords))
+        self._set_topology("length", length)
+        self._update_attributes(idx)
+
+    def _update_attributes(self, idx):
+        """Update segments for network attributes affected by changes.
+
+        Parameters
+        ----------
+        idx : array_like
+            Positions of segments that were added or modified.
+
+        """
+        segments = self.segments
+        segments_index = segments.index
+        idx = np.unique(np.asarray(idx, dtype=np.intp))
+        to_idx = self._get_topology("to_idx")
+        # update from_segnums for modified and next downstream segments
+        if "from_segnums" in segments.columns:
+            indptr, indices = self._get_topology("upstream_csr")
+            rows = np.union1d(idx, to_idx[idx][to_idx[idx] >= 0])
+            values, _, counts = csr_gather(indptr, indices, rows)
+            from_segnums = segments["from_segnums"].copy()
+            for row, value in zip(rows, csr_sets(
+                    np.append(0, np.cumsum(counts)), segments_index[values])):
+                from_segnums.iat[row] = value
+            segments["from_segnums"] = from_segnums
+        names = ["num_to_outlet", "dist_to_outlet", "sequence",
+                 "stream_order", "upstream_length"]
+        if not set(["cat_group"] + names).issubset(segments.columns):
+            self.logger.debug("segments do not have network attributes")
+            return
+        attrs = {"cat_group": segments_index.get_indexer(
+            segments["cat_group"]).astype(np.intp)}
+        for name in names:
+            attrs[name] = segments[name].values.copy()
+        area = None
+        if self.catchments is not None and "upstream_area" in segments:
+            area = self.catchments.area.values
+            prev_area = segments["upstream_area"].values
+            attrs["upstream_area"] = prev_area.copy()
+            names.append("upstream_area")
+        updated = update_attributes(
+            to_idx, self._get_topology("length"), attrs, idx, area)
+        self.logger.debug(
+            "updated network attributes for %d segments", updated.sum())
+        cat_group = attrs["cat_group"]
+        segments["cat_group"] = np.where(
+            cat_group >= 0, segments_index.values[cat_group], self.END_SEGNUM)
+        for name in names:
+            segments[name] = attrs[name]
+        if area is not None and "width" in segments.columns:
+            # re-estimate width with default parameters from estimate_width
+            sel = attrs["upstream_area"] != prev_area
+            width = segments["width"].values.copy()
+            width[sel] = 1.42 + (attrs["upstream_area"][sel] / 1e6) ** 0.52
+            segments["width"] = width
+
     def plot(self, column='stream_order', sort_column='sequence',
              cmap='viridis_r', legend=False, ax=None):
         """Plot map of surface water network.
@@ -6,15 +6,22 @@ import geopandas
 import numpy as np
 import pandas as pd
 from shapely import wkt
-from shapely.geometry import LineString, Point, Polygon, box
-from shapely.ops import linemerge
+from shapely.geometry import Point, box
 
-from swn.compat import ignore_shapely_warnings_for_object_array
+from swn._topology import csr_sets, group_csr, line_coords
+from swn.compat import (
+    SHAPELY_GE_20, ignore_shapely_warnings_for_object_array
+)
 from swn.core import SurfaceWaterNetwork
+from swn.modflow._grid import (
+    cell_polygons, grid_pieces, nearest_cells, piece_lines
+)
 from swn.modflow._misc import (
     tile_series_as_frame, transform_data_to_series_or_frame
 )
-from swn.spatial import compare_crs, get_sindex, visible_wkt
+from swn.modflow._reaches import ReachRules
+from swn.spatial import compare_crs
+from swn.util import abbr_str
 
 
 class SwnModflowBase:
@@ -161,7 +168,7 @@ class SwnModflowBase:
 
         This propery can be set more than once, but time and most grid
         properties must match. Setting this method also generates
-        ``time_index`` and ``grid_cells`` attributes from the model.
+        ``time_index`` from the model, and enables ``grid_cells``.
 
         See Also
         --------
@@ -217,11 +224,9 @@ class SwnModflowBase:
         modelgrid = model.modelgrid
         modeltime = model.modeltime
         if this_class == "SwnModflow":
-            domain_label = "ibound"
             domain = model.bas6.ibound[0].array.copy()
             perlen = pd.Series(model.dis.perlen.array)
         elif this_class == "SwnMf6":
-            domain_label = "idomain"
             domain = dis.idomain.array[0].copy()
             nper = sim.tdis.nper.data
             perlen = pd.Series(sim.tdis.perioddata.array.perlen)
@@ -292,35 +297,48 @@ class SwnModflowBase:
             if model_bbox.disjoint(segments_bbox):
                 raise ValueError(
                     "modelgrid extent does not cover segments extent")
-        # More careful check of overlap of lines with grid polygons
-        self.logger.debug("building model grid cell geometries")
-        nrow, ncol = domain.shape
-        cols, rows = np.meshgrid(np.arange(ncol), np.arange(nrow))
-        grid_df = pd.DataFrame({"i": rows.flatten(), "j": cols.flatten()})
-        grid_df.set_index(["i", "j"], inplace=True)
-        grid_df[domain_label] = domain.flatten()
-        # Note: modelgrid.get_cell_vertices(i, j) is slow!
-        xv = modelgrid.xvertices
-        yv = modelgrid.yvertices
-        i, j = (np.array(s[1])
-                for s in grid_df.reset_index()[["i", "j"]].iteritems())
-        cell_verts = zip(
-            zip(xv[i, j], yv[i, j]),
-            zip(xv[i, j + 1], yv[i, j + 1]),
-            zip(xv[i + 1, j + 1], yv[i + 1, j + 1]),
-            zip(xv[i + 1, j], yv[i + 1, j])
-        )
-        # Add dataframe of model grid cells to object
-        self.grid_cells = geopandas.GeoDataFrame(
-            grid_df, geometry=[Polygon(r) for r in cell_verts], crs=crs)
+        # Grid cell geometries are built when needed, see grid_cells
+        self._grid_crs = crs
+        self._grid_domain = domain
+        self._grid_modelgrid = modelgrid
+        self._grid_cells = None
 
         # Keep the for next time
         self._modelcache = modelcache
 
+    @property
+    def grid_cells(self):
+        """GeoDataFrame of model grid cells, indexed by row and column.
+
+        Cell polygons and the domain (IBOUND or IDOMAIN) of the top layer
+        are evaluated from the model the first time this is accessed.
+        """
+        if getattr(self, "_grid_domain", None) is None:
+            raise AttributeError("grid_cells requires model to be set")
+        if self._grid_cells is None:
+            self.logger.debug("building model grid cell geometries")
+            nrow, ncol = self._grid_domain.shape
+            self._grid_cells = self._cells_frame(
+                np.arange(nrow).repeat(ncol), np.tile(np.arange(ncol), nrow))
+        return self._grid_cells
+
+    def _cells_frame(self, i, j):
+        """Return GeoDataFrame of some model grid cells."""
+        domain_label = {
+            "SwnModflow": "ibound",
+            "SwnMf6": "idomain",
+        }[self.__class__.__name__]
+        index = pd.MultiIndex.from_arrays([i, j], names=["i", "j"])
+        with ignore_shapely_warnings_for_object_array():
+            return geopandas.GeoDataFrame(
+                {domain_label: self._grid_domain[i, j]}, index=index,
+                geometry=cell_polygons(self._grid_modelgrid, i, j),
+                crs=self._grid_crs)
+
     @classmethod
     def from_swn_flopy(
             cls, swn, model, domain_action="freeze",
-            reach_include_fraction=0.2):
+            reach_include_fraction=0.2, workers=None, cache_dir=None):
         """Create a MODFLOW structure from a surface water network.
 
         Parameters
@@ -338,17 +356,22 @@ class SwnModflowBase:
             reaches outside the active grid should be included to a cell.
             Based on the furthest distance of the line and cell geometries.
             Default 0.2 (e.g. for a 100 m grid cell, this is 20 m).
+        workers : int, optional
+            If more than 1, segments that need rules for short or remaining
+            reaches are evaluated in a pool of processes, or threads with
+            Shapely 2.0 or later.
+        cache_dir : str or pathlib.Path, optional
+            Directory to cache reaches evaluated from segments on the model
+            grid. Files are named with a hash of the segment geometries,
+            ``reach_include_fraction``, the domain action and model grid
+            properties, so repeated calls with the same inputs skip the
+            intersection. Default None does not use a cache.
 
         Returns
         -------
         obj
         """
-        this_class = cls.__name__
-        if this_class == "SwnModflow":
-            domain_label = "ibound"
-        elif this_class == "SwnMf6":
-            domain_label = "idomain"
-        else:
+        if cls.__name__ not in ("SwnModflow", "SwnMf6"):
             raise TypeError(f"unsupported subclass {cls!r}")
         if not isinstance(swn, SurfaceWaterNetwork):
             raise ValueError("swn must be a SurfaceWaterNetwork object")
@@ -362,362 +385,40 @@ class SwnModflowBase:
         obj.segments = swn.segments.copy()
         obj.model = model
         obj._swn = swn
-        # Copy grid_cells generated from 'model' setter
-        dis = model.dis
-        grid_cells = obj.grid_cells.copy()
-        if domain_action == "freeze":
-            sel = grid_cells[domain_label] != 0
-            if sel.any():
-                # Remove any inactive grid cells from analysis
-                grid_cells = grid_cells.loc[sel]
-        num_domain_modified = 0
-        if this_class == "SwnModflow":
-            domain_label = "ibound"
-            domain = model.bas6.ibound[0].array.copy()
-        elif this_class == "SwnMf6":
-            domain_label = "idomain"
-            domain = dis.idomain.array[0].copy()
-        else:
-            raise TypeError(f"unsupported subclass {cls!r}")
-
-        # Determine grid cell size
-        col_size = np.median(dis.delr.array)
-        if dis.delr.array.min() != dis.delr.array.max():
-            obj.logger.warning(
-                "assuming constant column spacing %s", col_size)
-        row_size = np.median(dis.delc.array)
-        if dis.delc.array.min() != dis.delc.array.max():
-            obj.logger.warning(
-                "assuming constant row spacing %s", row_size)
-        cell_size = (row_size + col_size) / 2.0
 
         # Break up source segments according to the model grid definition
         obj.logger.debug("evaluating reach data on model grid")
-        grid_sindex = get_sindex(grid_cells)
-        reach_include = swn.segments_series(reach_include_fraction) * cell_size
-        # Make an empty DataFrame for reaches
-        obj.reaches = pd.DataFrame(columns=["geometry"])
-        obj.reaches.insert(1, column="i", value=pd.Series(dtype=int))
-        obj.reaches.insert(2, column="j", value=pd.Series(dtype=int))
-        empty_reach_df = obj.reaches.copy()  # take this before more added
-        obj.reaches.insert(
-            1, column="segnum",
-            value=pd.Series(dtype=obj.segments.index.dtype))
-        obj.reaches.insert(2, column="segndist", value=pd.Series(dtype=float))
-        empty_reach_df.insert(3, column="length", value=pd.Series(dtype=float))
-        empty_reach_df.insert(4, column="moved", value=pd.Series(dtype=bool))
-
-        # recursive helper function
-        def append_reach_df(df, i, j, reach_geom, moved=False):
-            if reach_geom.geom_type == "LineString":
-                reach_d = {
-                    "geometry": reach_geom,
-                    "i": i,
-                    "j": j,
-                    "length": reach_geom.length,
-                    "moved": moved,
-                }
-                with ignore_shapely_warnings_for_object_array():
-                    df.loc[len(df.index)] = reach_d
-            elif reach_geom.geom_type.startswith("Multi"):
-                for sub_reach_geom in reach_geom.geoms:  # recurse
-                    append_reach_df(df, i, j, sub_reach_geom, moved)
-            else:
-                raise NotImplementedError(reach_geom.geom_type)
-
-        # helper function that returns early, if necessary
-        def assign_short_reach(reach_df, idx, segnum):
-            reach = reach_df.loc[idx]
-            reach_geom = reach["geometry"]
-            threshold = reach_include[segnum]
-            if reach_geom.length > threshold:
-                return
-            cell_lengths = reach_df.groupby(["i", "j"])["length"].sum()
-            this_ij = reach["i"], reach["j"]
-            this_cell_length = cell_lengths[this_ij]
-            if this_cell_length > threshold:
-                return
-            grid_geom = grid_cells.at[this_ij, "geometry"]
-            # determine if it is crossing the grid once or twice
-            grid_points = reach_geom.intersection(grid_geom.exterior)
-            split_short = (
-                grid_points.geom_type == "Point" or
-                (grid_points.geom_type == "MultiPoint" and
-                 len(grid_points.geoms) == 2))
-            if not split_short:
-                return
-            matches = []
-            # sequence scan on reach_df
-            for item in reach_df.itertuples():
-                if item[0] == idx or item.moved:
-                    continue
-                other_cell_length = cell_lengths[item.i, item.j]
-                if (item.geometry.distance(reach_geom) < 1e-6 and
-                        this_cell_length < other_cell_length):
-                    matches.append((item[0], item.geometry))
-            if len(matches) == 0:
-                # don't merge, e.g. reach does not connect to adjacent cell
-                pass
-            elif len(matches) == 1:
-                # short segment is in one other cell only
-                # update new i and j values, keep geometry as it is
-                ij1 = tuple(reach_df.loc[matches[0][0], ["i", "j"]])
-                reach_df.loc[idx, ["i", "j", "moved"]] = ij1 + (True,)
-                # self.logger.debug(
-                #    "moved short segment of %s from %s to %s",
-                #    segnum, this_ij, ij1)
-            elif len(matches) == 2:
-                assert grid_points.geom_type == "MultiPoint", grid_points.wkt
-                if len(grid_points.geoms) != 2:
-                    obj.logger.critical(
-                        "expected 2 points, found %s", len(grid_points.geoms))
-                # Build a tiny DataFrame of coordinates for this reach
-                pts = [Point(c) for c in reach_geom.coords[:]]
-                with ignore_shapely_warnings_for_object_array():
-                    reach_c = pd.DataFrame({"pt": pts}, dtype=object)
-                if len(reach_c) == 2:
-                    # If this is a simple line with two coords, split it
-                    reach_c.index = [0, 2]
-                    ipt = reach_geom.interpolate(0.5, normalized=True)
-                    with ignore_shapely_warnings_for_object_array():
-                        reach_c.loc[1] = pd.Series({"pt": ipt}, dtype=object)
-                    reach_c.sort_index(inplace=True)
-                    reach_geom = LineString(list(reach_c["pt"]))  # rebuild
-                # first match assumed to be touching the start of the line
-                if reach_c.at[0, "pt"].distance(matches[1][1]) < 1e-6:
-                    matches.reverse()
-                reach_c["d1"] = reach_c["pt"].apply(
-                                lambda p: p.distance(matches[0][1]))
-                reach_c["d2"] = reach_c["pt"].apply(
-                                lambda p: p.distance(matches[1][1]))
-                reach_c["dm"] = reach_c[["d1", "d2"]].min(1)
-                # try a simple split where distances switch
-                ds = reach_c["d1"] < reach_c["d2"]
-                cidx = ds[ds].index[-1]
-                # ensure it's not the index of either end
-                if cidx == 0:
-                    cidx = 1
-                elif cidx == len(reach_c) - 1:
-                    cidx = len(reach_c) - 2
-                i1, j1 = list(reach_df.loc[matches[0][0], ["i", "j"]])
-                reach_geom1 = LineString(reach_geom.coords[:(cidx + 1)])
-                i2, j2 = list(reach_df.loc[matches[1][0], ["i", "j"]])
-                reach_geom2 = LineString(reach_geom.coords[cidx:])
-                # update the first, append the second
-                reach_df.loc[idx, ["i", "j", "length", "moved"]] = \
-                    (i1, j1, reach_geom1.length, True)
-                reach_df.at[idx, "geometry"] = reach_geom1
-                append_reach_df(reach_df, i2, j2, reach_geom2, moved=True)
-                # self.logger.debug(
-                #   "split and moved short segment of %s from %s to %s and %s",
-                #   segnum, this_ij, (i1, j1), (i2, j2))
-            else:
-                obj.logger.critical(
-                    "unhandled assign_short_reach case with %d matches: %s\n"
-                    "%s\n%s", len(matches), matches, reach, grid_points.wkt)
-
-        def assign_remaining_reach(reach_df, segnum, rem):
-            if rem.geom_type == "LineString":
-                threshold = cell_size * 2.0
-                if rem.length > threshold:
-                    obj.logger.debug(
-                        "remaining line segment from %s too long to merge "
-                        "(%.1f > %.1f)", segnum, rem.length, threshold)
-                    return
-                # search full grid for other cells that could match
-                if grid_sindex:
-                    bbox_match = sorted(grid_sindex.intersection(rem.bounds))
-                    sub = grid_cells.geometry.iloc[bbox_match]
-                else:  # slow scan of all cells
-                    sub = grid_cells.geometry
-                assert len(sub) > 0, len(sub)
-                matches = []
-                for (i, j), grid_geom in sub.iteritems():
-                    if grid_geom.touches(rem):
-                        matches.append((i, j, grid_geom))
-                if len(matches) == 0:
-                    return
-                threshold = reach_include[segnum]
-                # Build a tiny DataFrame for just the remaining coordinates
-                pts = [Point(c) for c in rem.coords[:]]
-                with ignore_shapely_warnings_for_object_array():
-                    rem_c = pd.DataFrame({"pt": pts}, dtype=object)
-                if len(matches) == 1:  # merge it with adjacent cell
-                    i, j, grid_geom = matches[0]
-                    mdist = rem_c["pt"].apply(
-                                    lambda p: grid_geom.distance(p)).max()
-                    if mdist > threshold:
-                        obj.logger.debug(
-                            "remaining line segment from %s too far away to "
-                            "merge (%.1f > %.1f)", segnum, mdist, threshold)
-                        return
-                    append_reach_df(reach_df, i, j, rem, moved=True)
-                elif len(matches) == 2:  # complex: need to split it
-                    if len(rem_c) == 2:
-                        # If this is a simple line with two coords, split it
-                        rem_c.index = [0, 2]
-                        rem_c.loc[1] = pd.Series({
-                            "pt": rem.interpolate(0.5, normalized=True)})
-                        rem_c.sort_index(inplace=True)
-                        rem = LineString(list(rem_c["pt"]))  # rebuild
-                    # first match assumed to be touching the start of the line
-                    if rem_c.at[0, "pt"].touches(matches[1][2]):
-                        matches.reverse()
-                    rem_c["d1"] = rem_c["pt"].apply(
-                                    lambda p: p.distance(matches[0][2]))
-                    rem_c["d2"] = rem_c["pt"].apply(
-                                    lambda p: p.distance(matches[1][2]))
-                    rem_c["dm"] = rem_c[["d1", "d2"]].min(1)
-                    mdist = rem_c["dm"].max()
-                    if mdist > threshold:
-                        obj.logger.debug(
-                            "remaining line segment from %s too far away to "
-                            "merge (%.1f > %.1f)", segnum, mdist, threshold)
-                        return
-                    # try a simple split where distances switch
-                    ds = rem_c["d1"] < rem_c["d2"]
-                    cidx = ds[ds].index[-1]
-                    # ensure it's not the index of either end
-                    if cidx == 0:
-                        cidx = 1
-                    elif cidx == len(rem_c) - 1:
-                        cidx = len(rem_c) - 2
-                    i1, j1 = matches[0][0:2]
-                    rem1 = LineString(rem.coords[:(cidx + 1)])
-                    append_reach_df(reach_df, i1, j1, rem1, moved=True)
-                    i2, j2 = matches[1][0:2]
-                    rem2 = LineString(rem.coords[cidx:])
-                    append_reach_df(reach_df, i2, j2, rem2, moved=True)
-                else:
-                    obj.logger.critical(
-                        "how does this happen? Segments from %d touching %d "
-                        "grid cells", segnum, len(matches))
-            elif rem.geom_type.startswith("Multi"):
-                for sub_rem_geom in rem.geoms:  # recurse
-                    assign_remaining_reach(reach_df, segnum, sub_rem_geom)
-            else:
-                raise NotImplementedError(rem.geom_type)
-
-        def do_linemerge(ij, df, drop_reach_ids):
-            geom = linemerge(df["geometry"])
-            if geom.geom_type == "MultiLineString":
-                # workaround for odd floating point issue
-                geom = linemerge(
-                    [visible_wkt(g) for g in df["geometry"]])
-            if geom.geom_type == "LineString":
-                drop_reach_ids += list(df.index)
-                obj.logger.debug(
-                    "merging %d reaches for segnum %s at %s",
-                    len(df), segnum, ij)
-                i, j = ij
-                append_reach_df(reach_df, i, j, geom)
-            elif geom.geom_type == "MultiLineString":
-                for part in geom.geoms:
-                    part_covers = df.geometry.apply(part.covers)
-                    if part_covers.sum() > 1:  # recurse
-                        do_linemerge(ij, df[part_covers], drop_reach_ids)
-                    elif part_covers.sum() == 0:
-                        obj.logger.warning(
-                            "part %s does not cover any segnum %s at %s",
-                            part, segnum, ij)
-            else:
-                obj.logger.warning(
-                    "failed to merge segnum %s at %s: %s", segnum, ij, geom)
-
-        # Looping over each segment breaking down into reaches
-        for segnum, line in obj.segments.geometry.iteritems():
-            remaining_line = line
-            if grid_sindex:
-                bbox_match = sorted(grid_sindex.intersection(line.bounds))
-                if not bbox_match:
-                    continue
-                sub = grid_cells.geometry.iloc[bbox_match]
-            else:  # slow scan of all cells
-                sub = grid_cells.geometry
-            # Find all intersections between segment and grid cells
-            reach_df = empty_reach_df.copy()
-            for (i, j), grid_geom in sub.iteritems():
-                reach_geom = grid_geom.intersection(line)
-                if reach_geom.is_empty or reach_geom.geom_type == "Point":
-                    continue
-                # erase some odd floating point issues
-                reach_geom = visible_wkt(reach_geom)
-                remaining_line = remaining_line.difference(grid_geom)
-                append_reach_df(reach_df, i, j, reach_geom)
-            # Determine if any remaining portions of the line can be used
-            if line is not remaining_line and remaining_line.length > 0:
-                assign_remaining_reach(reach_df, segnum, remaining_line)
-            # Reassign short reaches to two or more adjacent grid cells
-            # starting with the shortest reach
-            reach_lengths = reach_df["length"].loc[
-                reach_df["length"] < reach_include[segnum]]
-            for idx in list(reach_lengths.sort_values().index):
-                assign_short_reach(reach_df, idx, segnum)
-            # Potentially merge a few reaches for each i,j of this segnum
-            drop_reach_ids = []
-            for ij, gb in reach_df.copy().groupby(["i", "j"]):
-                if len(gb) > 1:
-                    gb["geometry"] = gb["geometry"].apply(visible_wkt)
-                    do_linemerge(ij, gb, drop_reach_ids)
-            if drop_reach_ids:
-                reach_df.drop(drop_reach_ids, axis=0, inplace=True)
-            # TODO: Some reaches match multiple cells if they share a border
-            # Add all reaches for this segment
-            for reach in reach_df.itertuples():
-                i = reach.i
-                j = reach.j
-                reach_geom = reach.geometry
-                if line.has_z:
-                    # intersection(line) does not preserve Z coords,
-                    # but line.interpolate(d) works as expected
-                    reach_geom = LineString(line.interpolate(
-                        line.project(Point(c))) for c in reach_geom.coords)
-                # Get a point from the middle of the reach_geom
-                reach_mid_pt = reach_geom.interpolate(0.5, normalized=True)
-                reach_record = {
-                    "geometry": reach_geom,
-                    "segnum": segnum,
-                    "segndist": line.project(reach_mid_pt, normalized=True),
-                    "i": i,
-                    "j": j,
-                }
-                with ignore_shapely_warnings_for_object_array():
-                    obj.reaches.loc[len(obj.reaches.index)] = reach_record
-                if domain_action == "modify" and domain[i, j] == 0:
-                    num_domain_modified += 1
-                    domain[i, j] = 1
-
+        rules = obj._reach_rules(domain_action)
+        reach_include = \
+            swn.segments_series(reach_include_fraction) * rules.cell_size
+        col_edges, row_edges = rules.col_edges, rules.row_edges
+
+        reaches = None
+        if cache_dir is not None:
+            cache_path = obj._grid_reaches_cache_path(
+                cache_dir, domain_action, reach_include)
+            if cache_path.exists():
+                obj.logger.info("reading reaches from cache %s", cache_path)
+                with open(cache_path, "rb") as f:
+                    reaches = pickle.load(f)
+        if reaches is None:
+            reaches = obj._grid_reaches(
+                obj.segments.geometry, rules, reach_include, workers)
+            if cache_dir is not None:
+                obj.logger.info("writing reaches to cache %s", cache_path)
+                cache_path.parent.mkdir(parents=True, exist_ok=True)
+                with open(cache_path, "wb") as f:
+                    pickle.dump(reaches, f, protocol=4)
+        obj.reaches = reaches
+        # keep options to update reaches
+        obj._reach_options = {
+            "domain_action": domain_action,
+            "reach_include_fraction": reach_include_fraction,
+        }
         if domain_action == "modify":
-            if num_domain_modified:
-                obj.logger.debug(
-                    "updating %d cells from %s array for top layer",
-                    num_domain_modified, domain_label.upper())
-                if domain_label == "ibound":
-                    obj.model.bas6.ibound[0] = domain
-                elif domain_label == "idomain":
-                    obj.model.dis.idomain.set_data(domain, layer=0)
-                obj.reaches = obj.reaches.merge(
-                    grid_cells[[domain_label]],
-                    left_on=["i", "j"], right_index=True)
-                obj.reaches.rename(
-                    columns={domain_label: f"prev_{domain_label}"},
-                    inplace=True)
-            else:
-                obj.reaches[f"prev_{domain_label}"] = 1
+            obj._modify_domain(obj.reaches)
 
-        # Mark segments that are not used
-        obj.segments["in_model"] = True
-        outside_model = \
-            set(swn.segments.index).difference(obj.reaches["segnum"])
-        obj.segments.loc[list(outside_model), "in_model"] = False
-
-        # Evaluate inflow segments that potentially receive flow from outside
-        segnums_outside = set(obj.segments[~obj.segments["in_model"]].index)
-        if segnums_outside:
-            obj.logger.debug(
-                "evaluating inflow connections from outside network")
-            obj.segments["inflow_segnums"] = obj.segments.from_segnums.apply(
-                lambda x: x.intersection(segnums_outside))
+        obj._set_segments_in_model()
 
         # Consider diversions or SW takes, add more reaches
         has_diversions = swn.diversions is not None
@@ -726,19 +427,14 @@ class SwnModflowBase:
             obj.reaches["diversion"] = False
             obj.reaches["divid"] = obj.diversions.index.dtype.type()
             # Mark diversions that are not used / outside model
-            obj.diversions["in_model"] = True
-            outside_model = []
-            segnum_s = set(obj.reaches.segnum)
-            for divid, from_segnum in obj.diversions.from_segnum.iteritems():
-                if from_segnum not in segnum_s:
-                    # segnum does not exist -- segment is outside model
-                    outside_model.append(divid)
-            if outside_model:
-                obj.diversions.loc[list(outside_model), "in_model"] = False
+            obj.diversions["in_model"] = \
+                obj.diversions["from_segnum"].isin(obj.reaches["segnum"])
+            num_outside = (~obj.diversions["in_model"]).sum()
+            if num_outside:
                 obj.logger.debug(
                     "added %d diversions, ignoring %d that did not connect to "
                     "existing segments",
-                    obj.diversions["in_model"].sum(), len(outside_model))
+                    obj.diversions["in_model"].sum(), num_outside)
             else:
                 obj.logger.debug(
                     "added all %d diversions", len(obj.diversions))
@@ -751,44 +447,43 @@ class SwnModflowBase:
                 isinstance(obj.diversions, geopandas.GeoDataFrame) and
                 "geometry" in obj.diversions.columns and
                 (~diversions_in_model.is_empty).all())
-            for divn in diversions_in_model.itertuples():
-                # Use the last upstream reach as a template for a new reach
-                reach_d = dict(obj.reaches.loc[
-                    obj.reaches.segnum == divn.from_segnum].iloc[-1])
-                reach_d.update({
-                    "segnum": swn.END_SEGNUM,
-                    "segndist": 0.0,
-                    "diversion": True,
-                    "divid": divn.Index,
-                    "geometry": empty_geom,
-                })
-                # Assign one reach at grid cell
-                if is_spatial:
-                    # Find grid cell nearest to diversion
-                    grid_cells = obj.grid_cells
-                    grid_sindex = get_sindex(grid_cells)
-                    if grid_sindex:
-                        bbox_match = sorted(
-                            grid_sindex.nearest(divn.geometry.bounds))
-                        # more than one nearest can exist! just take one...
-                        num_found = len(bbox_match)
-                        grid_cell = grid_cells.iloc[bbox_match[0]]
-                    else:  # slow scan of all cells
-                        sel = grid_cells.intersects(divn.geometry)
-                        num_found = sel.sum()
-                        grid_cell = grid_cells.loc[sel].iloc[0]
-                    if num_found > 1:
-                        obj.logger.warning(
-                            "%d grid cells are nearest to diversion %r, "
-                            "but only taking the first %s",
-                            num_found, divn.Index, grid_cell)
-                    i, j = grid_cell.name
-                    reach_d.update({"i": i, "j": j})
-                    if not divn.geometry.is_empty:
-                        with ignore_shapely_warnings_for_object_array():
-                            reach_d["geometry"] = divn.geometry
-                with ignore_shapely_warnings_for_object_array():
-                    obj.reaches.loc[len(obj.reaches) + 1] = reach_d
+            # Use the last upstream reach as a template for new reaches
+            last_reaches = obj.reaches.drop_duplicates("segnum", keep="last")
+            rows = pd.Index(last_reaches["segnum"]).get_indexer(
+                diversions_in_model["from_segnum"])
+            if (rows < 0).any():
+                missing = diversions_in_model.index[rows < 0]
+                raise ValueError(
+                    "could not find reaches upstream of diversions: "
+                    f"{abbr_str(list(missing))}")
+            div_reaches = last_reaches.iloc[rows].copy()
+            div_reaches["segnum"] = swn.END_SEGNUM
+            div_reaches["segndist"] = 0.0
+            div_reaches["diversion"] = True
+            div_reaches["divid"] = diversions_in_model.index.values
+            div_geoms = np.empty(len(div_reaches), dtype=object)
+            if is_spatial:
+                # Find grid cell nearest to each diversion
+                i, j, num_found = nearest_cells(
+                    col_edges, row_edges, rules.grid_bounds(
+                        diversions_in_model.geometry.bounds.values))
+                # more than one nearest can exist! just take one...
+                for idx in np.flatnonzero(num_found > 1):
+                    obj.logger.warning(
+                        "%d grid cells are nearest to diversion %r, "
+                        "but only taking the first %s", num_found[idx],
+                        diversions_in_model.index[idx], (i[idx], j[idx]))
+                div_reaches["i"] = i
+                div_reaches["j"] = j
+                for idx, geom in enumerate(diversions_in_model.geometry):
+                    div_geoms[idx] = geom
+            else:
+                for idx in range(len(div_geoms)):
+                    div_geoms[idx] = empty_geom
+            with ignore_shapely_warnings_for_object_array():
+                div_reaches["geometry"] = div_geoms
+                obj.reaches = pd.concat(
+                    [obj.reaches, div_reaches], ignore_index=True)
         else:
             obj.diversions = None
 
@@ -800,36 +495,7 @@ class SwnModflowBase:
         obj.reaches = geopandas.GeoDataFrame(
                 obj.reaches, geometry="geometry", crs=obj.crs)
 
-        # Add information to reaches from segments
-        obj.reaches = obj.reaches.merge(
-            obj.segments[["sequence"]], "left",
-            left_on="segnum", right_index=True)
-        # TODO: how to sequence diversions (divid)?
-        obj.reaches.sort_values(["sequence", "segndist"], inplace=True)
-        del obj.reaches["sequence"]  # segment sequence not used anymore
-        # keep "segndist" for interpolation from segment data
-
-        # Add classic ISEG and IREACH, counting from 1
-        obj.reaches["iseg"] = 0
-        obj.reaches["ireach"] = 0
-        iseg = ireach = 0
-        prev_segnum = None
-        for idx, segnum in obj.reaches["segnum"].iteritems():
-            if has_diversions and obj.reaches.at[idx, "diversion"]:
-                # Each diversion gets a new segment/reach
-                iseg += 1
-                ireach = 0
-            elif segnum != prev_segnum:
-                # Start of a regular segment/reach
-                iseg += 1
-                ireach = 0
-            ireach += 1
-            obj.reaches.at[idx, "iseg"] = iseg
-            obj.reaches.at[idx, "ireach"] = ireach
-            prev_segnum = segnum
-
-        obj.reaches.reset_index(inplace=True, drop=True)
-        obj.reaches.index += 1  # flopy series starts at one
+        obj._number_reaches()
 
         if not hasattr(obj.reaches.geometry, "geom_type"):
             # workaround needed for reaches.to_file()
@@ -838,6 +504,373 @@ class SwnModflowBase:
         # each subclass should do more processing with returned object
         return obj
 
+    def _grid_reaches(self, geometry, rules, reach_include, workers=None):
+        """Return reaches from segments on the model grid.
+
+        Parameters
+        ----------
+        geometry : geopandas.GeoSeries
+            LineString geometries of segments, indexed by segnum.
+        rules : swn.modflow._reaches.ReachRules
+            Rules for segments that do not simply walk through the grid.
+        reach_include : pandas.Series
+            Threshold distance for each segment.
+        workers : int, optional
+            If more than 1, evaluate rules in a pool of workers.
+
+        Returns
+        -------
+        pandas.DataFrame
+            With geometry, segnum, segndist, i and j columns.
+
+        """
+        # Walk each segment through the structured grid to find pieces
+        # within each cell, with positions relative to the segment
+        segnums = geometry.index
+        coords, indptr = line_coords(geometry)
+        coords[:, 0], coords[:, 1] = rules.to_grid(coords[:, 0], coords[:, 1])
+        pieces = grid_pieces(
+            coords, indptr, rules.col_edges, rules.row_edges, rules.active)
+        pline = pieces["line"]
+        inside = pieces["inside"]
+        piece_length = pieces["end"] - pieces["start"]
+
+        # Segments with remaining, short, repeated or edge-following pieces,
+        # or that cross themselves, need the rules below; all others have
+        # one reach per piece
+        is_short = inside & (piece_length < reach_include.values[pline])
+        is_repeated = pd.DataFrame(
+            {"line": pline, "i": pieces["i"], "j": pieces["j"]}
+        ).duplicated().values & inside
+        num_lines = len(segnums)
+        has_reach = np.bincount(pline[inside], minlength=num_lines) > 0
+        needs_rules = has_reach & (np.bincount(
+            pline, ~inside | pieces["on_edge"] | is_short | is_repeated,
+            minlength=num_lines) > 0)
+        is_simple = np.ones(num_lines, dtype=bool)
+        sel = np.flatnonzero(has_reach)
+        is_simple[sel] = geometry.iloc[sel].is_simple.values
+        needs_rules |= has_reach & ~is_simple
+        self.logger.debug(
+            "found %d pieces from %d segments in grid, where %d segments "
+            "need further evaluation", inside.sum(), has_reach.sum(),
+            needs_rules.sum())
+
+        pcoords = pieces["coords"]
+        pcoords[:, 0], pcoords[:, 1] = rules.from_grid(
+            pcoords[:, 0], pcoords[:, 1])
+
+        # Simple reaches, ordered by row and column for each segment
+        sel = np.flatnonzero(inside & ~needs_rules[pline])
+        sel = sel[np.lexsort((pieces["j"][sel], pieces["i"][sel], pline[sel]))]
+        line_has_z = geometry.has_z.values
+        simple_reaches = pd.DataFrame({
+            "geometry": piece_lines(
+                pcoords, pieces["indptr"], sel, line_has_z[pline[sel]]),
+            "segnum": segnums.values[pline[sel]],
+            "segndist": (pieces["start"][sel] + pieces["end"][sel]) / 2.0 /
+            pieces["length"][pline[sel]],
+            "i": pieces["i"][sel],
+            "j": pieces["j"][sel],
+            "position": pline[sel],
+        })
+
+        # Evaluate other segments with rules for remaining or short reaches
+        sel = np.flatnonzero(needs_rules[pline])
+        rule_geoms = piece_lines(pcoords, pieces["indptr"], sel).tolist()
+        rule_i = pieces["i"][sel].tolist()
+        rule_j = pieces["j"][sel].tolist()
+        rule_length = piece_length[sel].tolist()
+        rule_inside = inside[sel]
+        bounds = np.searchsorted(pline[sel], np.arange(num_lines + 1))
+        tasks = []
+        for position in np.flatnonzero(needs_rules):
+            segnum = segnums[position]
+            line = geometry.iat[position]
+            pieces = None
+            if is_simple[position]:
+                # Pieces within cells, ordered by row and column
+                this = np.arange(bounds[position], bounds[position + 1])
+                this_inside = this[rule_inside[this]]
+                reaches = [{
+                    "geometry": rule_geoms[idx],
+                    "i": rule_i[idx],
+                    "j": rule_j[idx],
+                    "length": rule_length[idx],
+                    "moved": False,
+                } for idx in sorted(
+                    this_inside, key=lambda idx: (rule_i[idx], rule_j[idx]))]
+                remaining = [
+                    rule_geoms[idx] for idx in this[~rule_inside[this]]]
+                pieces = (reaches, remaining)
+            tasks.append(
+                (position, segnum, line, reach_include[segnum], pieces))
+        if workers is not None and workers > 1 and len(tasks) > 1:
+            # Segments are split into groups, each evaluated by a worker;
+            # results are combined in the same order as the groups
+            if SHAPELY_GE_20:  # releases the GIL
+                from concurrent.futures import ThreadPoolExecutor as Executor
+            else:
+                from concurrent.futures import ProcessPoolExecutor as Executor
+            groups = np.array_split(
+                np.arange(len(tasks)), min(workers, len(tasks)))
+            with Executor(max_workers=workers) as executor:
+                results = list(executor.map(rules, [
+                    [tasks[idx] for idx in group] for group in groups]))
+            records = [record for result in results for record in result]
+        else:
+            records = rules(tasks)
+
+        # Combine all reaches in order of segments
+        with ignore_shapely_warnings_for_object_array():
+            reaches = pd.concat(
+                [simple_reaches, pd.DataFrame.from_records(
+                    records, columns=simple_reaches.columns)],
+                ignore_index=True)
+        reaches.sort_values("position", kind="mergesort", inplace=True)
+        reaches.drop(columns="position", inplace=True)
+        reaches.reset_index(drop=True, inplace=True)
+        reaches = reaches.astype({
+            "segnum": segnums.dtype, "segndist": float, "i": int, "j": int})
+        return reaches
+
+    def _grid_reaches_cache_path(self, cache_dir, domain_action,
+                                 reach_include):
+        """Return path to reaches cache for segments and the model grid.
+
+        The file name is a hash of segment geometries, threshold distances
+        of ``reach_include``, ``domain_action`` and the model cache, as well
+        as the version of this package.
+        """
+        from hashlib import sha256
+        from pathlib import Path
+
+        from swn._version import version
+
+        digest = sha256()
+        digest.update(version.encode())
+        digest.update(self.__class__.__name__.encode())
+        digest.update(domain_action.encode())
+        digest.update(pd.util.hash_pandas_object(reach_include).values)
+        for geom in self.segments.geometry:
+            digest.update(geom.wkb)
+        for key in sorted(self._modelcache):
+            digest.update(key.encode())
+            value = self._modelcache[key]
+            digest.update(value if isinstance(value, bytes) else
+                          value.encode())
+        return Path(cache_dir) / f"reaches-{digest.hexdigest()}.pkl"
+
+    def _domain(self):
+        """Return domain label and a copy of the domain array, top layer."""
+        this_class = self.__class__.__name__
+        if this_class == "SwnModflow":
+            return "ibound", self.model.bas6.ibound[0].array.copy()
+        elif this_class == "SwnMf6":
+            return "idomain", self.model.dis.idomain.array[0].copy()
+        raise TypeError(f"unsupported subclass {self.__class__!r}")
+
+    def _reach_rules(self, domain_action):
+        """Return ReachRules for the model grid and domain action."""
+        _, domain = self._domain()
+        # Grid cells used for analysis
+        active = np.ones(domain.shape, dtype=bool)
+        if domain_action == "freeze" and (domain != 0).any():
+            # Remove any inactive grid cells from analysis
+            active = domain != 0
+
+        # Determine grid cell size
+        dis = self.model.dis
+        col_size = np.median(dis.delr.array)
+        if dis.delr.array.min() != dis.delr.array.max():
+            self.logger.warning(
+                "assuming constant column spacing %s", col_size)
+        row_size = np.median(dis.delc.array)
+        if dis.delc.array.min() != dis.delc.array.max():
+            self.logger.warning(
+                "assuming constant row spacing %s", row_size)
+        cell_size = (row_size + col_size) / 2.0
+
+        # Cells are found from column and row edges, and cell geometries are
+        # only built for cells near segments that need them
+        return ReachRules(self.model.modelgrid, active, cell_size, self.logger)
+
+    def _modify_domain(self, reaches):
+        """Modify domain to fit reaches, and add previous domain column."""
+        domain_label, domain = self._domain()
+        prev_domain = domain[reaches["i"], reaches["j"]]
+        cells = reaches[["i", "j"]].drop_duplicates()
+        cells = cells[domain[cells["i"], cells["j"]] == 0]
+        num_domain_modified = len(cells)
+        domain[cells["i"], cells["j"]] = 1
+        if num_domain_modified:
+            self.logger.debug(
+                "updating %d cells from %s array for top layer",
+                num_domain_modified, domain_label.upper())
+            if domain_label == "ibound":
+                self.model.bas6.ibound[0] = domain
+            elif domain_label == "idomain":
+                self.model.dis.idomain.set_data(domain, layer=0)
+            reaches[f"prev_{domain_label}"] = prev_domain
+        else:
+            reaches[f"prev_{domain_label}"] = 1
+
+    def _update_domain(self, kept, removed, added):
+        """Update modified domain for removed and added reaches.
+
+        Cells that were only activated for removed reaches are reverted,
+        then the domain is modified to fit added reaches. Previous domain
+        values of added reaches in cells of kept reaches are preserved.
+        """
+        domain_label, domain = self._domain()
+        prev_label = f"prev_{domain_label}"
+        kept_prev = kept.groupby(["i", "j"])[prev_label].min()
+        cells = removed.loc[removed[prev_label] == 0, ["i", "j"]]
+        cells = cells.drop_duplicates().set_index(["i", "j"]).index
+        cells = cells.difference(kept_prev.index)
+        if len(cells) > 0:
+            self.logger.debug(
+                "reverting %d cells from %s array for top layer",
+                len(cells), domain_label.upper())
+            domain[cells.get_level_values(0), cells.get_level_values(1)] = 0
+            if domain_label == "ibound":
+                self.model.bas6.ibound[0] = domain
+            elif domain_label == "idomain":
+                self.model.dis.idomain.set_data(domain, layer=0)
+        self._modify_domain(added)
+        prev = kept_prev.reindex(
+            pd.MultiIndex.from_arrays([added["i"], added["j"]])).values
+        added[prev_label] = np.where(
+            np.isnan(prev), added[prev_label], prev).astype(
+                kept[prev_label].dtype)
+
+    def _set_segments_in_model(self):
+        """Mark segments with reaches, and find inflow from outside."""
+        swn = self.swn
+        self.segments["in_model"] = True
+        outside_model = \
+            set(swn.segments.index).difference(self.reaches["segnum"])
+        self.segments.loc[list(outside_model), "in_model"] = False
+
+        # Evaluate inflow segments that potentially receive flow from outside
+        segnums_outside = set(self.segments[~self.segments["in_model"]].index)
+        if segnums_outside:
+            self.logger.debug(
+                "evaluating inflow connections from outside network")
+            indptr, from_segnums = swn.from_segnums_csr
+            rows = np.repeat(np.arange(len(self.segments)), np.diff(indptr))
+            is_outside = np.isin(from_segnums, list(segnums_outside))
+            inflow_indptr, _ = group_csr(
+                rows[is_outside], len(self.segments))
+            self.segments["inflow_segnums"] = csr_sets(
+                inflow_indptr, from_segnums[is_outside])
+        elif "inflow_segnums" in self.segments.columns:
+            del self.segments["inflow_segnums"]
+
+    def _number_reaches(self):
+        """Sort reaches along segments, then number iseg and ireach."""
+        # Sort by segment sequence, with diversions last
+        # TODO: how to sequence diversions (divid)?
+        sequence = self.segments["sequence"].reindex(self.reaches["segnum"])
+        order = np.lexsort(
+            (self.reaches["segndist"].values, sequence.values))
+        reaches = self.reaches.take(order)
+        # keep "segndist" for interpolation from segment data
+
+        # Add classic ISEG and IREACH, counting from 1, where each diversion
+        # gets a new segment
+        segnum = reaches["segnum"].values
+        is_first = np.ones(len(reaches), dtype=bool)
+        is_first[1:] = segnum[1:] != segnum[:-1]
+        if "diversion" in reaches.columns:
+            is_first |= reaches["diversion"].values.astype(bool)
+        iseg = np.cumsum(is_first)
+        first_pos = np.flatnonzero(is_first)
+        reaches["iseg"] = iseg
+        reaches["ireach"] = np.arange(len(reaches)) - first_pos[iseg - 1] + 1
+
+        reaches.reset_index(inplace=True, drop=True)
+        reaches.index += 1  # flopy series starts at one
+        reaches.index.name = self.reaches.index.name
+        self.reaches = reaches
+
+    def update_reaches(self, segnums, workers=None):
+        """Re-evaluate reaches for segments with changed geometries.
+
+        Only reaches of these segments are evaluated on the model grid,
+        with the same options used for :py:meth:`from_swn_flopy`, then all
+        reaches are sorted and numbered again.
+
+        Parameters
+        ----------
+        segnums : list
+            Segment numbers with changed geometries in ``swn.segments``.
+            Segments that were removed from ``swn.segments``, or with an
+            empty geometry, have their reaches removed.
+        workers : int, optional
+            If more than 1, segments that need rules for short or remaining
+            reaches are evaluated in a pool of processes, or threads with
+            Shapely 2.0 or later.
+
+        Notes
+        -----
+        Other reach data, such as from :py:meth:`set_reach_data_from_segments`,
+        is missing for new reaches and needs to be set again. Diversion
+        reaches are not changed.
+
+        """
+        options = getattr(self, "_reach_options", None)
+        if options is None or self.reaches is None:
+            raise ValueError(
+                "update_reaches requires an object from from_swn_flopy")
+        segnums = pd.Index(segnums).unique()
+        missing = segnums.difference(self.segments.index)
+        if len(missing) > 0:
+            raise ValueError(
+                f"{len(missing)} segnums not found: {list(missing)}")
+        geometry = self.swn.segments.geometry.reindex(segnums)
+        is_removed = (geometry.isna() | geometry.is_empty).values
+        geometry = geometry[~is_removed]
+        self.logger.debug(
+            "updating reaches for %d segments, removing %d",
+            len(geometry), is_removed.sum())
+        self.segments.loc[geometry.index, "geometry"] = geometry
+
+        rules = self._reach_rules(options["domain_action"])
+        reach_include = self.swn.segments_series(
+            options["reach_include_fraction"]).loc[geometry.index] \
+            * rules.cell_size
+        if len(geometry) > 0:
+            new_reaches = self._grid_reaches(
+                geometry, rules, reach_include, workers)
+            new_reaches.insert(
+                list(new_reaches.columns).index("i"), column="k", value=0)
+            if self.diversions is not None:
+                new_reaches["diversion"] = False
+                new_reaches["divid"] = self.diversions.index.dtype.type()
+        else:
+            new_reaches = self.reaches.iloc[:0].drop(
+                columns=["iseg", "ireach"])
+        keep = ~self.reaches["segnum"].isin(segnums)
+        if options["domain_action"] == "modify":
+            self._update_domain(self.reaches[keep], self.reaches[~keep],
+                                new_reaches)
+
+        # Splice new reaches into the other reaches
+        reaches = self.reaches
+        index_name = reaches.index.name
+        columns = reaches.columns
+        with ignore_shapely_warnings_for_object_array():
+            reaches = pd.concat(
+                [reaches[keep].drop(columns=["iseg", "ireach"]),
+                 new_reaches], ignore_index=True)
+        self.reaches = geopandas.GeoDataFrame(
+            reaches, geometry="geometry", crs=self.crs)
+        self.reaches.index.name = index_name
+        self._set_segments_in_model()
+        self._number_reaches()
+        self.reaches = self.reaches[columns]
+
     def set_reach_data_from_segments(
             self, name, value, value_out=None, method=None, log=False):
         """Set reach data based on segment series (or scalar).
@@ -908,14 +941,13 @@ class SwnModflowBase:
             interp.sum())
         if log:
             segdat = np.log10(segdat)
-        for item in segdat[interp].itertuples():
-            sel = self.reaches["segnum"] == item[0]
-            # interpolate to mid points of each reach from segment data
-            segndist = self.reaches.loc[sel, "segndist"]
-            value = (item[2] - item[1]) * segndist + item[1]
-            if log:
-                value = 10 ** value
-            self.reaches.loc[sel, name] = value
+        # interpolate to mid points of each reach from segment data
+        res = self.reaches[["segnum", "segndist"]].join(
+            segdat[interp], on="segnum", how="inner")
+        value = (res[c2] - res[c1]) * res["segndist"] + res[c1]
+        if log:
+            value = 10 ** value
+        self.reaches.loc[res.index, name] = value
 
     def set_reach_data_from_array(self, name, array):
         """Set reach data from an array that matches the model (nrow, ncol).
@@ -1003,39 +1035,39 @@ class SwnModflowBase:
             rchs.loc[sel, "min_slope"] = rchs.min_slope[~sel].min()
         rchs[grid_name] = 0.0
         if method == "zcoord_ab":
-            def get_zcoords(g):
-                if g.is_empty or not g.has_z:
-                    return []
-                elif g.geom_type == "LineString":
-                    return [c[2] for c in g.coords[:]]
-                elif g.geom_type == "Point":
-                    return [g.z]
-                elif g.geom_type.startswith("Multi"):
-                    # recurse and flatten
-                    t = [get_zcoords(sg) for sg in g.geoms]
-                    return [item for slist in t for item in slist]
-                else:
-                    return []
-
-            zcoords = rchs.geometry.apply(get_zcoords)
-            rchs["zcoord_count"] = zcoords.apply(len)
-            sel = rchs["zcoord_count"] > 0
+            # Z coordinates of all reaches, with offsets for each reach
+            coords, indptr = line_coords(rchs.geometry)
+            zcoords = coords[:, 2]
+            rows = np.repeat(np.arange(len(rchs)), np.diff(indptr))
+            has_z = ~np.isnan(zcoords)
+            zcoords = zcoords[has_z]
+            rows = rows[has_z]
+            count = np.bincount(rows, minlength=len(rchs))
+            rchs["zcoord_count"] = count
+            sel = count > 0
             if not sel.any():
                 self.logger.error(
                     "no reaches selected to determine slope, either because "
                     "they are not LineString or are EMPTY")
-            rchs.loc[sel, "zcoord_min"] = zcoords[sel].apply(min)
-            rchs.loc[sel, "zcoord_avg"] = \
-                zcoords[sel].apply(sum) / rchs.loc[sel, "zcoord_count"]
-            rchs.loc[sel, "zcoord_max"] = zcoords[sel].apply(max)
-            rchs.loc[sel, "zcoord_first"] = zcoords[sel].apply(lambda z: z[0])
-            rchs.loc[sel, "zcoord_last"] = zcoords[sel].apply(lambda z: z[-1])
-            # Calculate gradient based on first/last coordinate
-            rchs.loc[sel, grid_name] = (
-                (rchs.loc[sel, "zcoord_first"] -
-                 rchs.loc[sel, "zcoord_last"]) /
-                rchs.loc[sel, "geometry"].length
-            )
+            first = np.searchsorted(rows, np.flatnonzero(sel))
+            last = first + count[sel] - 1
+            stats = {
+                "zcoord_min": np.minimum.reduceat(zcoords, first),
+                "zcoord_avg":
+                    np.add.reduceat(zcoords, first) / count[sel],
+                "zcoord_max": np.maximum.reduceat(zcoords, first),
+                "zcoord_first": zcoords[first],
+                "zcoord_last": zcoords[last],
+            }
+            for name, values in stats.items():
+                rchs[name] = np.nan
+                rchs.loc[sel, name] = values
+            # Calculate gradient based on first/last coordinate, where
+            # zero-length reaches are NaN or inf
+            with np.errstate(divide="ignore", invalid="ignore"):
+                rchs.loc[sel, grid_name] = (
+                    (stats["zcoord_first"] - stats["zcoord_last"]) /
+                    rchs.geometry[sel].length.values)
         elif method in ("grid_top", "rch_len"):
             # Estimate slope from top and grid spacing
             dis = self.model.dis
@@ -1059,6 +1091,24 @@ class SwnModflowBase:
                 num, "" if num == 1 else "s", 100.0 * num / len(sel))
             rchs.loc[sel, grid_name] = rchs.loc[sel, "min_slope"]
 
+    def _inflow_incidence(self):
+        """Return pairs of in-model segments and upstream outside segments.
+
+        Returns
+        -------
+        rows : numpy.ndarray
+            Positions of in-model segments, in ascending order.
+        from_segnums : numpy.ndarray
+            Upstream segnum outside the model for each of ``rows``.
+        """
+        in_model = self.segments["in_model"]
+        from_segnums = self.segments.loc[in_model, "from_segnums"].explode()
+        from_segnums = from_segnums[
+            from_segnums.notna() &
+            ~from_segnums.isin(self.segments.index[in_model])]
+        rows = self.segments.index.get_indexer(from_segnums.index)
+        return rows, from_segnums.values
+
     def _get_segments_inflow(self, data):
         """Get inflow data by gathering external flow upstream of the model.
 
@@ -1092,29 +1142,29 @@ class SwnModflowBase:
         if len(data.columns) == 0:
             self.logger.debug("no data used to determine inflow")
             return return_inflow()
-        inflow_segnums_series = pd.Series(
-            [set() for _ in range(len(self.segments))], dtype=object,
-            index=self.segments.index)
-        segnum_s = set(self.segments[self.segments.in_model].index)
-        for segd in self.segments.loc[self.segments.in_model].itertuples():
-            if not segd.from_segnums:
-                continue
-            outside_segnums = segd.from_segnums.difference(segnum_s)
-            if not outside_segnums:
-                continue
-            inflow_series = pd.Series(0.0, index=time_index)
-            inflow_segnums = set()
-            for from_segnum in outside_segnums:
-                try:
-                    inflow_series += data[from_segnum]
-                    inflow_segnums.add(from_segnum)
-                except KeyError:
-                    self.logger.warning(
-                        "flow from segment %s not provided by inflow data "
-                        "(needed for segnum %s)", from_segnum, segd.Index)
-            if inflow_segnums:
-                inflow[segd.Index] = inflow_series
-                inflow_segnums_series.at[segd.Index] = inflow_segnums
+        # Incidence of outside segments to in-model segments, as pairs
+        # grouped by receiving segment, gathered from the data array
+        rows, from_segnums = self._inflow_incidence()
+        cols = data.columns.get_indexer(from_segnums)
+        for idx in np.flatnonzero(cols < 0):
+            self.logger.warning(
+                "flow from segment %s not provided by inflow data "
+                "(needed for segnum %s)",
+                from_segnums[idx], self.segments.index[rows[idx]])
+        found = cols >= 0
+        rows, cols = rows[found], cols[found]
+        from_segnums = from_segnums[found]
+        if len(rows) > 0:
+            starts = np.flatnonzero(np.diff(rows, prepend=-1))
+            # frame values are stored by column, so sum rows of transpose
+            inflow = pd.DataFrame(
+                np.add.reduceat(data.values.T[cols], starts, axis=0).T,
+                index=time_index,
+                columns=self.segments.index[rows[starts]].values)
+            indptr, indices = group_csr(rows, len(self.segments))
+            inflow_segnums_series = pd.Series(
+                csr_sets(indptr, from_segnums[indices]), dtype=object,
+                index=self.segments.index)
         num_found = len(inflow.columns)
         if num_found > 0:
             self.logger.info(
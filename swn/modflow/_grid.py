@@ -0,0 +1,387 @@
+"""Array-based intersection of lines with structured model grids.
+
+Lines are walked through the grid edge by edge, finding where each line edge
+crosses column and row boundaries, in the spirit of a DDA (Amanatides-Woo)
+traversal, but done for all line edges at once. Coordinates are expected in
+"grid space" of ``(u, v)``, where ``u`` increases with column number and
+``v`` increases with row number; see :func:`grid_space`.
+"""
+
+__all__ = [
+    "grid_space", "cell_polygons", "box_cells", "nearest_cells",
+    "grid_pieces", "piece_lines",
+]
+
+import numpy as np
+import pandas as pd
+
+from swn._topology import csr_gather, lines_from_coords
+from swn.compat import SHAPELY_GE_20
+
+
+def grid_space(modelgrid):
+    """Return column and row edges of a structured grid, and transforms.
+
+    Parameters
+    ----------
+    modelgrid : flopy.discretization.StructuredGrid
+        Structured model grid, which may be rotated.
+
+    Returns
+    -------
+    col_edges, row_edges : numpy.ndarray
+        Increasing edges of columns (size ``ncol + 1``) and rows
+        (size ``nrow + 1``) in grid space.
+    to_grid, from_grid : callable
+        Functions to transform ``(x, y)`` arrays to ``(u, v)`` grid space,
+        and back again.
+
+    """
+    xedge, yedge = modelgrid.xyedges
+    if not modelgrid.angrot:
+        # transform edges the same way as cell vertices, so these are exact
+        # for cell polygons, without evaluating vertices for all cells
+        col_edges, _ = modelgrid.get_coords(
+            xedge, np.full(len(xedge), yedge[0]))
+        _, row_edges = modelgrid.get_coords(
+            np.full(len(yedge), xedge[0]), yedge)
+        row_edges = -row_edges
+
+        def to_grid(x, y):
+            return np.asarray(x, dtype=float), -np.asarray(y, dtype=float)
+
+        def from_grid(u, v):
+            return u, -v
+
+    else:
+        col_edges = np.array(xedge, dtype=float)
+        row_edges = -np.array(yedge, dtype=float)
+
+        def to_grid(x, y):
+            lx, ly = modelgrid.get_local_coords(
+                np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+            return lx, -ly
+
+        def from_grid(u, v):
+            return modelgrid.get_coords(u, -v)
+
+    return col_edges, row_edges, to_grid, from_grid
+
+
+def cell_polygons(modelgrid, i, j):
+    """Return Polygon geometries for some cells of a structured grid.
+
+    Vertices are the same as ``modelgrid.xvertices`` and
+    ``modelgrid.yvertices``, but are only evaluated for the cells required.
+
+    Parameters
+    ----------
+    modelgrid : flopy.discretization.StructuredGrid
+        Structured model grid, which may be rotated.
+    i, j : array_like
+        Rows and columns of cells.
+
+    Returns
+    -------
+    numpy.ndarray
+        Polygon geometries, with vertices ordered from the upper left corner.
+
+    """
+    i = np.asarray(i, dtype=np.intp)
+    j = np.asarray(j, dtype=np.intp)
+    xedge, yedge = modelgrid.xyedges
+    x, y = modelgrid.get_coords(
+        np.stack([xedge[j], xedge[j + 1], xedge[j + 1], xedge[j]], axis=1),
+        np.stack([yedge[i], yedge[i], yedge[i + 1], yedge[i + 1]], axis=1))
+    rings = np.stack([x, y], axis=2)
+    if SHAPELY_GE_20:
+        import shapely
+        return shapely.polygons(rings)
+    from shapely.geometry import Polygon
+    polygons = np.empty(len(i), dtype=object)
+    for idx, ring in enumerate(rings.tolist()):  # faster than arrays
+        polygons[idx] = Polygon(ring)
+    return polygons
+
+
+def box_cells(col_edges, row_edges, bounds, nearest=False):
+    """Return cells that intersect or touch a box in grid space.
+
+    Parameters
+    ----------
+    col_edges, row_edges : numpy.ndarray
+        Increasing edges of columns and rows in grid space.
+    bounds : tuple
+        Box with ``(umin, vmin, umax, vmax)`` in grid space.
+    nearest : bool, default False
+        If True, return the nearest cells for boxes outside the grid.
+
+    Returns
+    -------
+    i, j : numpy.ndarray
+        Rows and columns of cells, ordered by row then column.
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> box_cells(np.arange(4.0), np.arange(3.0), (0.5, 1.0, 1.5, 1.5))
+    (array([0, 0, 1, 1]), array([0, 1, 0, 1]))
+    >>> box_cells(np.arange(4.0), np.arange(3.0), (5.0, 0.2, 6.0, 0.5), True)
+    (array([0]), array([2]))
+
+    """
+    umin, vmin, umax, vmax = bounds
+
+    def edge_range(edges, lower, upper):
+        num = len(edges) - 1
+        first = np.searchsorted(edges, lower, "left") - 1
+        last = np.searchsorted(edges, upper, "right") - 1
+        if nearest:
+            first, last = np.clip([first, last], 0, num - 1)
+        return np.arange(max(first, 0), min(last, num - 1) + 1)
+
+    rows = edge_range(row_edges, vmin, vmax)
+    cols = edge_range(col_edges, umin, umax)
+    return np.repeat(rows, len(cols)), np.tile(cols, len(rows))
+
+
+def nearest_cells(col_edges, row_edges, bounds):
+    """Return first nearest cell for each of several boxes in grid space.
+
+    This is the first cell from :func:`box_cells` with ``nearest=True``,
+    evaluated for all boxes at once.
+
+    Parameters
+    ----------
+    col_edges, row_edges : numpy.ndarray
+        Increasing edges of columns and rows in grid space.
+    bounds : numpy.ndarray
+        2D array with ``(umin, vmin, umax, vmax)`` for each box.
+
+    Returns
+    -------
+    i, j : numpy.ndarray
+        Row and column of the first nearest cell for each box.
+    count : numpy.ndarray
+        Number of cells that are equally near to each box.
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> nearest_cells(np.arange(4.0), np.arange(3.0),
+    ...               np.array([[0.5, 1.0, 1.5, 1.5], [5.0, 0.2, 6.0, 0.5]]))
+    (array([0, 0]), array([0, 2]), array([4, 1]))
+
+    """
+    umin, vmin, umax, vmax = np.asarray(bounds, dtype=float).T
+
+    def edge_range(edges, lower, upper):
+        num = len(edges) - 1
+        first = np.clip(np.searchsorted(edges, lower, "left") - 1, 0, num - 1)
+        last = np.clip(np.searchsorted(edges, upper, "right") - 1, 0, num - 1)
+        return first, last - first + 1
+
+    i, nrow = edge_range(row_edges, vmin, vmax)
+    j, ncol = edge_range(col_edges, umin, umax)
+    return i, j, nrow * ncol
+
+
+def _crossings(a, b, edges):
+    """Return positions of edges crossed strictly between ``a`` and ``b``."""
+    first = np.searchsorted(edges, np.minimum(a, b), "right")
+    last = np.searchsorted(edges, np.maximum(a, b), "left")
+    counts = np.maximum(last - first, 0)
+    total = int(counts.sum())
+    which = np.repeat(np.arange(len(a)), counts)
+    k = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    k += np.repeat(first, counts)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = (edges[k] - a[which]) / (b[which] - a[which])
+    return which, k, t
+
+
+def grid_pieces(coords, indptr, col_edges, row_edges, active=None):
+    """Split lines into pieces that are each within one grid cell.
+
+    Parameters
+    ----------
+    coords : numpy.ndarray
+        2D array with shape ``(num_coords, 3)`` for U, V and Z coordinates
+        in grid space. Z values may be NaN.
+    indptr : numpy.ndarray
+        Coordinates of line ``n`` are ``coords[indptr[n]:indptr[n + 1]]``.
+    col_edges, row_edges : numpy.ndarray
+        Increasing edges of columns and rows in grid space.
+    active : numpy.ndarray, optional
+        2D boolean array with shape ``(nrow, ncol)``. Pieces in cells that
+        are not active are treated as outside the grid. Default all active.
+
+    Returns
+    -------
+    dict
+        Arrays for each piece, in order along each line:
+
+        - ``line`` : position of the line.
+        - ``i``, ``j`` : row and column of the cell, or -1 if outside.
+        - ``inside`` : True if within an active cell.
+        - ``on_edge`` : True if part of the piece follows a cell boundary.
+        - ``start``, ``end`` : distances along the line, with 2D lengths.
+        - ``coords``, ``indptr`` : coordinates of each piece, with start and
+          end points on cell boundaries, and line vertices between.
+
+        Also ``length`` for the 2D length of each line.
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> coords = np.array([[0.5, 0.5, 1.0], [2.5, 0.5, 2.0]])
+    >>> res = grid_pieces(coords, np.array([0, 2]), np.arange(4.0),
+    ...                   np.arange(2.0))
+    >>> res["j"], res["start"], res["end"]
+    (array([0, 1, 2]), array([0. , 0.5, 1.5]), array([0.5, 1.5, 2. ]))
+    >>> res["coords"][res["indptr"][1]:res["indptr"][2]]
+    array([[1.  , 0.5 , 1.25],
+           [2.  , 0.5 , 1.75]])
+
+    """
+    coords = np.asarray(coords, dtype=float)
+    indptr = np.asarray(indptr, dtype=np.intp)
+    nrow, ncol = len(row_edges) - 1, len(col_edges) - 1
+    if active is None:
+        active = np.ones((nrow, ncol), dtype=bool)
+    num_lines = len(indptr) - 1
+    line_of = np.repeat(np.arange(num_lines), np.diff(indptr))
+
+    # Line edges, identified by positions of the first vertex
+    ea = np.flatnonzero(line_of[:-1] == line_of[1:])
+    eb = ea + 1
+    ua, va = coords[ea, 0], coords[ea, 1]
+    ub, vb = coords[eb, 0], coords[eb, 1]
+    elen = np.hypot(ub - ua, vb - va)
+    sel = elen > 0.0
+    ea, eb, ua, va, ub, vb, elen = \
+        ea[sel], eb[sel], ua[sel], va[sel], ub[sel], vb[sel], elen[sel]
+    eline = line_of[ea]
+    num_edges = len(ea)
+    length = np.bincount(eline, elen, minlength=num_lines)
+    echain = pd.Series(elen).groupby(eline).cumsum().values - elen
+
+    # Breaks along each edge: start vertex (kind 0), then crossings of
+    # column (kind 1) and row (kind 2) boundaries
+    cw, ck, ct = _crossings(ua, ub, col_edges)
+    rw, rk, rt = _crossings(va, vb, row_edges)
+    bedge = np.concatenate([np.arange(num_edges), cw, rw])
+    bt = np.concatenate([np.zeros(num_edges), ct, rt])
+    bkind = np.concatenate([
+        np.zeros(num_edges, dtype=np.int8),
+        np.ones(len(cw), dtype=np.int8),
+        np.full(len(rw), 2, dtype=np.int8)])
+    bk = np.concatenate([np.full(num_edges, -1), ck, rk])
+    order = np.lexsort((bt, bedge))
+    bedge, bt, bkind, bk = bedge[order], bt[order], bkind[order], bk[order]
+
+    # Parts between breaks, ending at the next break or the end of the edge
+    same = np.append(bedge[1:] == bedge[:-1], False)
+    nt = np.where(same, np.append(bt[1:], 1.0), 1.0)
+    nkind = np.where(same, np.append(bkind[1:], 0), 0)
+    nk = np.where(same, np.append(bk[1:], -1), -1)
+    sel = nt > bt
+    pedge, pt, pkind, pk = bedge[sel], bt[sel], bkind[sel], bk[sel]
+    nt, nkind, nk = nt[sel], nkind[sel], nk[sel]
+
+    # Find cell from the middle of each part
+    tm = (pt + nt) / 2.0
+    um = ua[pedge] + tm * (ub[pedge] - ua[pedge])
+    vm = va[pedge] + tm * (vb[pedge] - va[pedge])
+    pj = np.searchsorted(col_edges, um, "right") - 1
+    pi = np.searchsorted(row_edges, vm, "right") - 1
+    inside = (pi >= 0) & (pi < nrow) & (pj >= 0) & (pj < ncol)
+    ci, cj = np.clip(pi, 0, nrow - 1), np.clip(pj, 0, ncol - 1)
+    on_edge = (col_edges[cj] == um) | (row_edges[ci] == vm)
+    inside &= active[ci, cj]
+    cell = np.where(inside, ci * ncol + cj, -1)
+
+    # Merge consecutive parts along the same line in the same cell
+    pline = eline[pedge]
+    first = np.ones(len(pedge), dtype=bool)
+    first[1:] = (pline[1:] != pline[:-1]) | (cell[1:] != cell[:-1])
+    starts = np.flatnonzero(first)
+    ends = np.append(starts[1:], len(pedge)) - 1
+    e0, e1 = pedge[starts], pedge[ends]
+
+    res = {
+        "line": pline[starts],
+        "i": np.where(inside[starts], pi[starts], -1),
+        "j": np.where(inside[starts], pj[starts], -1),
+        "inside": inside[starts],
+        "on_edge": np.logical_or.reduceat(on_edge, starts)
+        if len(starts) else on_edge,
+        "start": echain[e0] + pt[starts] * elen[e0],
+        "end": echain[e1] + nt[ends] * elen[e1],
+        "length": length,
+    }
+
+    # Coordinates of each piece: start point, line vertices between, then
+    # end point, where crossed boundaries are exact
+    counts = e1 - e0 + 2
+    pindptr = np.zeros(len(starts) + 1, dtype=np.intp)
+    np.cumsum(counts, out=pindptr[1:])
+    pcoords = np.empty((pindptr[-1], 3))
+
+    def point(edge, t, kind, k):
+        pts = coords[ea[edge]] + t[:, np.newaxis] * (
+            coords[eb[edge]] - coords[ea[edge]])
+        pts[t == 1.0] = coords[eb[edge[t == 1.0]]]
+        pts[t == 0.0] = coords[ea[edge[t == 0.0]]]
+        sel = kind == 1
+        pts[sel, 0] = col_edges[k[sel]]
+        sel = kind == 2
+        pts[sel, 1] = row_edges[k[sel]]
+        return pts
+
+    pcoords[pindptr[:-1]] = point(e0, pt[starts], pkind[starts], pk[starts])
+    pcoords[pindptr[1:] - 1] = point(e1, nt[ends], nkind[ends], nk[ends])
+    num_between = counts - 2
+    pos = np.repeat(pindptr[:-1] + 1, num_between) + np.arange(
+        num_between.sum()) - np.repeat(
+            np.cumsum(num_between) - num_between, num_between)
+    edge = np.repeat(e0 + 1, num_between) + pos - np.repeat(
+        pindptr[:-1] + 1, num_between)
+    pcoords[pos] = coords[ea[edge]]
+    res["coords"] = pcoords
+    res["indptr"] = pindptr
+    return res
+
+
+def piece_lines(coords, indptr, rows, has_z=None):
+    """Return LineString geometries for some pieces.
+
+    Parameters
+    ----------
+    coords, indptr : numpy.ndarray
+        Coordinates of pieces, from :func:`grid_pieces`.
+    rows : numpy.ndarray
+        Positions of pieces.
+    has_z : numpy.ndarray, optional
+        Boolean array for each of ``rows`` to include Z coordinates.
+        Default is for 2D geometries.
+
+    Returns
+    -------
+    numpy.ndarray
+        LineString geometries.
+
+    """
+    rows = np.asarray(rows, dtype=np.intp)
+    if has_z is None:
+        has_z = np.zeros(len(rows), dtype=bool)
+    geoms = np.empty(len(rows), dtype=object)
+    for is_3d, ncoord in [(False, 2), (True, 3)]:
+        where = np.flatnonzero(has_z == is_3d)
+        if len(where) == 0:
+            continue
+        positions, starts, _ = csr_gather(
+            indptr, np.arange(len(coords)), rows[where])
+        geoms[where] = lines_from_coords(
+            coords[positions, :ncoord], np.append(starts, len(positions)))
+    return geoms
@@ -0,0 +1,456 @@
+"""Rules to assign reaches of segments to model grid cells.
+
+Each segment is evaluated independently, so groups of segments can be
+evaluated by other threads or processes.
+"""
+
+__all__ = ["ReachRules", "append_reach"]
+
+import numpy as np
+import pandas as pd
+from shapely.geometry import LineString, MultiLineString, Point
+from shapely.ops import linemerge
+
+from swn._topology import (
+    line_chainage, line_coords, lines_from_coords, project_coords)
+from swn.compat import ignore_shapely_warnings_for_object_array
+from swn.modflow._grid import box_cells, cell_polygons, grid_space
+from swn.spatial import visible_wkt
+
+
+def append_reach(reaches, i, j, reach_geom, moved=False):
+    """Append reach dicts with LineString geometries to a list.
+
+    Reaches are dicts with keys: geometry, i, j, length and moved.
+    Multi-part geometries are appended as several reaches.
+    """
+    if reach_geom.geom_type == "LineString":
+        reaches.append({
+            "geometry": reach_geom,
+            "i": i,
+            "j": j,
+            "length": reach_geom.length,
+            "moved": moved,
+        })
+    elif reach_geom.geom_type.startswith("Multi"):
+        for sub_reach_geom in reach_geom.geoms:  # recurse
+            append_reach(reaches, i, j, sub_reach_geom, moved)
+    else:
+        raise NotImplementedError(reach_geom.geom_type)
+
+
+class ReachRules:
+    """Assign reaches of segments to grid cells, using rules for short
+    reaches and remaining portions of segments outside the grid.
+
+    Parameters
+    ----------
+    modelgrid : flopy.discretization.StructuredGrid
+        Structured model grid, which may be rotated.
+    active : numpy.ndarray
+        2D boolean array of cells that can have reaches.
+    cell_size : float
+        Typical size of grid cells.
+    logger : logging.Logger
+        Logger to show messages.
+
+    """
+
+    def __init__(self, modelgrid, active, cell_size, logger):
+        """Initialise ReachRules."""
+        self.modelgrid = modelgrid
+        self.active = active
+        self.cell_size = cell_size
+        self.logger = logger
+        self._setup()
+
+    def _setup(self):
+        self.col_edges, self.row_edges, self.to_grid, self.from_grid = \
+            grid_space(self.modelgrid)
+        self._cell_geoms = {}
+
+    def __getstate__(self):
+        """Serialize attributes for other processes."""
+        return {
+            "modelgrid": self.modelgrid,
+            "active": self.active,
+            "cell_size": self.cell_size,
+            "logger": (self.logger.name, self.logger.level),
+        }
+
+    def __setstate__(self, state):
+        """Set attributes from another process."""
+        from swn.logger import get_logger
+
+        self.modelgrid = state["modelgrid"]
+        self.active = state["active"]
+        self.cell_size = state["cell_size"]
+        self.logger = get_logger(*state["logger"])
+        self._setup()
+
+    def grid_bounds(self, bounds):
+        """Return bounds of a box in grid space, or 2D array of boxes."""
+        minx, miny, maxx, maxy = np.asarray(bounds, dtype=float).T
+        x = np.array([minx, maxx, maxx, minx])
+        y = np.array([miny, miny, maxy, maxy])
+        u, v = self.to_grid(x.ravel(), y.ravel())
+        u, v = u.reshape(x.shape), v.reshape(y.shape)
+        if u.ndim == 1:
+            return u.min(), v.min(), u.max(), v.max()
+        return np.stack([u.min(0), v.min(0), u.max(0), v.max(0)], axis=1)
+
+    def cell_polygon(self, i, j):
+        """Return Polygon of a grid cell."""
+        geom = self._cell_geoms.get((i, j))
+        if geom is None:
+            geom = self._cell_geoms[i, j] = cell_polygons(
+                self.modelgrid, [i], [j])[0]
+        return geom
+
+    def cells_in_bounds(self, bounds):
+        """Return list of ``((i, j), polygon)`` for active cells in bounds."""
+        i, j = box_cells(
+            self.col_edges, self.row_edges, self.grid_bounds(bounds))
+        sel = self.active[i, j]
+        i, j = i[sel].tolist(), j[sel].tolist()
+        cell_geoms = self._cell_geoms
+        missing = [
+            idx for idx, ij in enumerate(zip(i, j)) if ij not in cell_geoms]
+        if missing:
+            geoms = cell_polygons(
+                self.modelgrid, np.take(i, missing), np.take(j, missing))
+            for idx, geom in zip(missing, geoms):
+                cell_geoms[i[idx], j[idx]] = geom
+        return [(ij, cell_geoms[ij]) for ij in zip(i, j)]
+
+    def assign_short_reach(self, reaches, idx, threshold):
+        """Reassign a short reach to one or two adjacent grid cells."""
+        reach = reaches[idx]
+        reach_geom = reach["geometry"]
+        if reach_geom.length > threshold:
+            return
+        cell_lengths = {}
+        for item in reaches:
+            ij = item["i"], item["j"]
+            cell_lengths[ij] = cell_lengths.get(ij, 0.0) + item["length"]
+        this_ij = reach["i"], reach["j"]
+        this_cell_length = cell_lengths[this_ij]
+        if this_cell_length > threshold:
+            return
+        grid_geom = self.cell_polygon(*this_ij)
+        # determine if it is crossing the grid once or twice
+        grid_points = reach_geom.intersection(grid_geom.exterior)
+        split_short = (
+            grid_points.geom_type == "Point" or
+            (grid_points.geom_type == "MultiPoint" and
+             len(grid_points.geoms) == 2))
+        if not split_short:
+            return
+        matches = []
+        # sequence scan on reaches
+        for other_idx, item in enumerate(reaches):
+            if other_idx == idx or item["moved"]:
+                continue
+            other_cell_length = cell_lengths[item["i"], item["j"]]
+            if (item["geometry"].distance(reach_geom) < 1e-6 and
+                    this_cell_length < other_cell_length):
+                matches.append((other_idx, item["geometry"]))
+        if len(matches) == 0:
+            # don't merge, e.g. reach does not connect to adjacent cell
+            pass
+        elif len(matches) == 1:
+            # short segment is in one other cell only
+            # update new i and j values, keep geometry as it is
+            other = reaches[matches[0][0]]
+            reach.update(i=other["i"], j=other["j"], moved=True)
+        elif len(matches) == 2:
+            assert grid_points.geom_type == "MultiPoint", grid_points.wkt
+            if len(grid_points.geoms) != 2:
+                self.logger.critical(
+                    "expected 2 points, found %s", len(grid_points.geoms))
+            # Get points of coordinates for this reach
+            pts = [Point(c) for c in reach_geom.coords[:]]
+            if len(pts) == 2:
+                # If this is a simple line with two coords, split it
+                pts.insert(1, reach_geom.interpolate(0.5, normalized=True))
+                reach_geom = LineString(pts)  # rebuild
+            # first match assumed to be touching the start of the line
+            if pts[0].distance(matches[1][1]) < 1e-6:
+                matches.reverse()
+            # try a simple split where distances switch
+            cidx = [
+                pidx for pidx, pt in enumerate(pts)
+                if pt.distance(matches[0][1]) < pt.distance(matches[1][1])
+            ][-1]
+            # ensure it's not the index of either end
+            if cidx == 0:
+                cidx = 1
+            elif cidx == len(pts) - 1:
+                cidx = len(pts) - 2
+            reach1 = reaches[matches[0][0]]
+            reach_geom1 = LineString(reach_geom.coords[:(cidx + 1)])
+            reach2 = reaches[matches[1][0]]
+            reach_geom2 = LineString(reach_geom.coords[cidx:])
+            # update the first, append the second
+            reach.update(
+                geometry=reach_geom1, i=reach1["i"], j=reach1["j"],
+                length=reach_geom1.length, moved=True)
+            append_reach(
+                reaches, reach2["i"], reach2["j"], reach_geom2, moved=True)
+        else:
+            self.logger.critical(
+                "unhandled assign_short_reach case with %d matches: %s\n"
+                "%s\n%s", len(matches), matches, reach, grid_points.wkt)
+
+    def assign_remaining_reach(self, reaches, segnum, rem, threshold):
+        """Assign remaining portions of a segment to adjacent grid cells."""
+        if rem.geom_type == "LineString":
+            max_length = self.cell_size * 2.0
+            if rem.length > max_length:
+                self.logger.debug(
+                    "remaining line segment from %s too long to merge "
+                    "(%.1f > %.1f)", segnum, rem.length, max_length)
+                return
+            # search nearby grid cells for others that could match
+            matches = []
+            for (i, j), grid_geom in self.cells_in_bounds(rem.bounds):
+                if grid_geom.touches(rem):
+                    matches.append((i, j, grid_geom))
+            if len(matches) == 0:
+                return
+            # Build a tiny DataFrame for just the remaining coordinates
+            pts = [Point(c) for c in rem.coords[:]]
+            with ignore_shapely_warnings_for_object_array():
+                rem_c = pd.DataFrame({"pt": pts}, dtype=object)
+            if len(matches) == 1:  # merge it with adjacent cell
+                i, j, grid_geom = matches[0]
+                mdist = rem_c["pt"].apply(
+                                lambda p: grid_geom.distance(p)).max()
+                if mdist > threshold:
+                    self.logger.debug(
+                        "remaining line segment from %s too far away to "
+                        "merge (%.1f > %.1f)", segnum, mdist, threshold)
+                    return
+                append_reach(reaches, i, j, rem, moved=True)
+            elif len(matches) == 2:  # complex: need to split it
+                if len(rem_c) == 2:
+                    # If this is a simple line with two coords, split it
+                    rem_c.index = [0, 2]
+                    rem_c.loc[1] = pd.Series({
+                        "pt": rem.interpolate(0.5, normalized=True)})
+                    rem_c.sort_index(inplace=True)
+                    rem = LineString(list(rem_c["pt"]))  # rebuild
+                # first match assumed to be touching the start of the line
+                if rem_c.at[0, "pt"].touches(matches[1][2]):
+                    matches.reverse()
+                rem_c["d1"] = rem_c["pt"].apply(
+                                lambda p: p.distance(matches[0][2]))
+                rem_c["d2"] = rem_c["pt"].apply(
+                                lambda p: p.distance(matches[1][2]))
+                rem_c["dm"] = rem_c[["d1", "d2"]].min(1)
+                mdist = rem_c["dm"].max()
+                if mdist > threshold:
+                    self.logger.debug(
+                        "remaining line segment from %s too far away to "
+                        "merge (%.1f > %.1f)", segnum, mdist, threshold)
+                    return
+                # try a simple split where distances switch
+                ds = rem_c["d1"] < rem_c["d2"]
+                cidx = ds[ds].index[-1]
+                # ensure it's not the index of either end
+                if cidx == 0:
+                    cidx = 1
+                elif cidx == len(rem_c) - 1:
+                    cidx = len(rem_c) - 2
+                i1, j1 = matches[0][0:2]
+                rem1 = LineString(rem.coords[:(cidx + 1)])
+                append_reach(reaches, i1, j1, rem1, moved=True)
+                i2, j2 = matches[1][0:2]
+                rem2 = LineString(rem.coords[cidx:])
+                append_reach(reaches, i2, j2, rem2, moved=True)
+            else:
+                self.logger.critical(
+                    "how does this happen? Segments from %d touching %d "
+                    "grid cells", segnum, len(matches))
+        elif rem.geom_type.startswith("Multi"):
+            for sub_rem_geom in rem.geoms:  # recurse
+                self.assign_remaining_reach(
+                    reaches, segnum, sub_rem_geom, threshold)
+        else:
+            raise NotImplementedError(rem.geom_type)
+
+    def do_linemerge(self, segnum, ij, group, drop_reach_ids, merged_reaches):
+        """Merge reaches of a segment in one grid cell, where possible."""
+        # group is a list of (idx, geometry) for reaches in one cell
+        geom = linemerge([g for _, g in group])
+        if geom.geom_type == "MultiLineString":
+            # workaround for odd floating point issue
+            geom = linemerge([visible_wkt(g) for _, g in group])
+        if geom.geom_type == "LineString":
+            drop_reach_ids.update(idx for idx, _ in group)
+            self.logger.debug(
+                "merging %d reaches for segnum %s at %s",
+                len(group), segnum, ij)
+            i, j = ij
+            append_reach(merged_reaches, i, j, geom)
+        elif geom.geom_type == "MultiLineString":
+            for part in geom.geoms:
+                part_group = [
+                    (idx, g) for idx, g in group if part.covers(g)]
+                if len(part_group) > 1:  # recurse
+                    self.do_linemerge(
+                        segnum, ij, part_group, drop_reach_ids,
+                        merged_reaches)
+                elif len(part_group) == 0:
+                    self.logger.warning(
+                        "part %s does not cover any segnum %s at %s",
+                        part, segnum, ij)
+        else:
+            self.logger.warning(
+                "failed to merge segnum %s at %s: %s", segnum, ij, geom)
+
+    def segment_reaches(self, segnum, line, threshold, pieces=None):
+        """Return reaches of a segment after applying rules.
+
+        Parameters
+        ----------
+        segnum : int
+            Segment number, used for messages.
+        line : LineString
+            Segment geometry.
+        threshold : float
+            Length of short reaches, also used as the furthest distance of
+            remaining portions of the segment from adjacent cells.
+        pieces : tuple, optional
+            Tuple of ``(reaches, remaining)``, where ``reaches`` is a list of
+            reach dicts within cells ordered by row and column, and
+            ``remaining`` is a list of LineString portions outside cells.
+            Default None will intersect the segment with grid cells, which
+            is needed for segments that cross themselves.
+
+        Returns
+        -------
+        list
+            Dicts with geometry, segndist, i and j.
+
+        """
+        if pieces is not None:
+            reaches, remaining = pieces
+            if len(remaining) == 0:
+                remaining_line = None
+            elif len(remaining) == 1:
+                remaining_line = remaining[0]
+            else:
+                remaining_line = MultiLineString(remaining)
+        else:
+            # Find all intersections between segment and grid cells,
+            # which are also split where the segment crosses itself
+            reaches = []
+            remaining_line = line
+            for (i, j), grid_geom in self.cells_in_bounds(line.bounds):
+                reach_geom = grid_geom.intersection(line)
+                if reach_geom.is_empty or reach_geom.geom_type == "Point":
+                    continue
+                # erase some odd floating point issues
+                reach_geom = visible_wkt(reach_geom)
+                remaining_line = remaining_line.difference(grid_geom)
+                append_reach(reaches, i, j, reach_geom)
+            if line is remaining_line or remaining_line.length == 0:
+                remaining_line = None
+        # Determine if any remaining portions of the line can be used
+        if remaining_line is not None:
+            self.assign_remaining_reach(
+                reaches, segnum, remaining_line, threshold)
+        # Reassign short reaches to two or more adjacent grid cells
+        # starting with the shortest reach
+        reach_lengths = np.array([reach["length"] for reach in reaches])
+        short_idx = np.flatnonzero(reach_lengths < threshold)
+        for idx in short_idx[np.argsort(reach_lengths[short_idx])]:
+            self.assign_short_reach(reaches, idx, threshold)
+        # Potentially merge a few reaches for each i,j of this segnum
+        cell_groups = {}
+        for idx, reach in enumerate(reaches):
+            cell_groups.setdefault((reach["i"], reach["j"]), []).append(
+                (idx, reach["geometry"]))
+        drop_reach_ids = set()
+        merged_reaches = []
+        for ij, group in sorted(cell_groups.items()):
+            if len(group) > 1:
+                group = [(idx, visible_wkt(g)) for idx, g in group]
+                self.do_linemerge(
+                    segnum, ij, group, drop_reach_ids, merged_reaches)
+        reaches = [
+            reach for idx, reach in enumerate(reaches)
+            if idx not in drop_reach_ids] + merged_reaches
+        # TODO: Some reaches match multiple cells if they share a border
+        if len(reaches) == 0:
+            return []
+        # Locate reach coordinates along the segment using chainage
+        line_xyz = np.asarray(line.coords)
+        chainage = line_chainage(line_xyz)
+        reach_geoms = np.empty(len(reaches), dtype=object)
+        for idx, reach in enumerate(reaches):
+            reach_geoms[idx] = reach["geometry"]
+        coords, indptr = line_coords(reach_geoms)
+        if line.has_z:
+            dist = project_coords(line_xyz, coords, chainage)
+            # intersection(line) does not preserve Z coords, so interpolate
+            # coordinates from the segment
+            for col in range(3):
+                coords[:, col] = np.interp(dist, chainage, line_xyz[:, col])
+            geoms = lines_from_coords(coords, indptr)
+        else:
+            geoms = reach_geoms
+        # Distance along the segment to the middle of each reach
+        step = np.hypot(*np.diff(coords[:, :2], axis=0).T)
+        step[indptr[1:-1] - 1] = 0.0  # between reaches
+        reach_chainage = np.zeros(len(coords))
+        np.cumsum(step, out=reach_chainage[1:])
+        start = indptr[:-1]
+        end = indptr[1:] - 1
+        half = (reach_chainage[start] + reach_chainage[end]) / 2.0
+        seg = np.clip(
+            np.searchsorted(reach_chainage, half, side="right") - 1,
+            start, end - 1)
+        seg_length = step[seg]
+        frac = np.divide(
+            half - reach_chainage[seg], seg_length,
+            out=np.zeros(len(seg)), where=seg_length > 0.0)[:, np.newaxis]
+        seg_xy = coords[seg, :2]
+        mid_xy = seg_xy + frac * (coords[seg + 1, :2] - seg_xy)
+        segndist = project_coords(line_xyz, mid_xy, chainage)
+        if chainage[-1] > 0.0:
+            segndist /= chainage[-1]
+        records = []
+        for reach, geom, reach_segndist in zip(reaches, geoms, segndist):
+            records.append({
+                "geometry": geom,
+                "segndist": float(reach_segndist),
+                "i": reach["i"],
+                "j": reach["j"],
+            })
+        return records
+
+    def __call__(self, tasks):
+        """Evaluate reaches for a sequence of segments.
+
+        Parameters
+        ----------
+        tasks : list
+            Tuples of ``(position, segnum, line, threshold, pieces)``, see
+            :meth:`segment_reaches`.
+
+        Returns
+        -------
+        list
+            Dicts with geometry, segnum, segndist, i, j and position, for
+            each segment in the same order as ``tasks``.
+
+        """
+        records = []
+        for position, segnum, line, threshold, pieces in tasks:
+            for record in self.segment_reaches(
+                    segnum, line, threshold, pieces):
+                record.update(segnum=segnum, position=position)
+                records.append(record)
+        return records
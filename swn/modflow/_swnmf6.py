@@ -8,6 +8,7 @@ from textwrap import dedent
 import numpy as np
 import pandas as pd
 
+from swn._topology import csr_sets, group_csr, next_reach
 from swn.modflow._base import SwnModflowBase
 from swn.util import abbr_str
 
@@ -56,7 +57,7 @@ class SwnMf6(SwnModflowBase):
     @classmethod
     def from_swn_flopy(
             cls, swn, model, idomain_action="freeze",
-            reach_include_fraction=0.2):
+            reach_include_fraction=0.2, workers=None, cache_dir=None):
         """Create a MODFLOW 6 SFR structure from a surface water network.
 
         Parameters
@@ -74,6 +75,16 @@ class SwnMf6(SwnModflowBase):
             reaches outside the active grid should be included to a cell.
             Based on the furthest distance of the line and cell geometries.
             Default 0.2 (e.g. for a 100 m grid cell, this is 20 m).
+        workers : int, optional
+            If more than 1, segments that need rules for short or remaining
+            reaches are evaluated in a pool of processes, or threads with
+            Shapely 2.0 or later.
+        cache_dir : str or pathlib.Path, optional
+            Directory to cache reaches evaluated from segments on the model
+            grid. Files are named with a hash of the segment geometries,
+            ``reach_include_fraction``, the domain action and model grid
+            properties, so repeated calls with the same inputs skip the
+            intersection. Default None does not use a cache.
 
         Returns
         -------
@@ -84,49 +95,14 @@ class SwnMf6(SwnModflowBase):
 
         obj = super().from_swn_flopy(
             swn=swn, model=model, domain_action=idomain_action,
-            reach_include_fraction=reach_include_fraction)
+            reach_include_fraction=reach_include_fraction, workers=workers,
+            cache_dir=cache_dir)
 
         # Add more information to reaches
         obj.reaches.index.name = "rno"
         obj.reaches["rlen"] = obj.reaches.geometry.length
 
-        # Evaluate connections
-        # Assume only converging network
-        to_segnums_d = swn.to_segnums.to_dict()
-        reaches_segnum_s = set(obj.reaches["segnum"])
-
-        def find_next_rno(segnum):
-            if segnum in to_segnums_d:
-                to_segnum = to_segnums_d[segnum]
-                if to_segnum in reaches_segnum_s:
-                    sel = obj.reaches["segnum"] == to_segnum
-                    return obj.reaches[sel].index[0]
-                else:  # recurse downstream
-                    return find_next_rno(to_segnum)
-            else:
-                return 0
-
-        def get_to_rno():
-            if segnum == next_segnum:
-                return next_rno
-            else:
-                return find_next_rno(segnum)
-
-        obj.reaches["to_rno"] = -1
-        segnum_iter = obj.reaches["segnum"].iteritems()
-        rno, segnum = next(segnum_iter)
-        for next_rno, next_segnum in segnum_iter:
-            obj.reaches.at[rno, "to_rno"] = get_to_rno()
-            rno, segnum = next_rno, next_segnum
-        next_segnum = swn.END_SEGNUM
-        obj.reaches.at[rno, "to_rno"] = get_to_rno()
-        assert obj.reaches.to_rno.min() >= 0
-
-        # Populate from_rnos set
-        obj.reaches["from_rnos"] = [set() for _ in range(len(obj.reaches))]
-        to_rnos = obj.reaches.loc[obj.reaches["to_rno"] != 0, "to_rno"]
-        for k, v in to_rnos.items():
-            obj.reaches.at[v, "from_rnos"].add(k)
+        obj._connect_reaches()
 
         # TODO: Diversions not handled (yet)
         obj.reaches["to_div"] = 0
@@ -134,6 +110,32 @@ class SwnMf6(SwnModflowBase):
 
         return obj
 
+    def _connect_reaches(self):
+        """Evaluate to_rno and from_rnos connections between reaches.
+
+        Assumes only a converging network, so diversions are not connected.
+        """
+        line = self._swn.segments.index.get_indexer(self.reaches["segnum"])
+        next_pos = next_reach(line, self._swn._get_topology("to_idx"))
+        rnos = self.reaches.index.values
+        self.reaches["to_rno"] = np.where(next_pos >= 0, rnos[next_pos], 0)
+        indptr, indices = group_csr(next_pos, len(rnos))
+        self.reaches["from_rnos"] = csr_sets(indptr, rnos[indices])
+
+    def update_reaches(self, segnums, workers=None):
+        """Re-evaluate reaches for changed or removed segments.
+
+        See :py:meth:`SwnModflowBase.update_reaches`. Connections between
+        reaches are re-evaluated, and reaches from changed segments get
+        ``rlen``, ``to_div`` and ``ustrf`` values.
+        """
+        super().update_reaches(segnums, workers=workers)
+        sel = self.reaches["rlen"].isna()
+        self.reaches.loc[sel, "rlen"] = self.reaches.geometry[sel].length
+        self.reaches["to_div"] = self.reaches["to_div"].fillna(0).astype(int)
+        self.reaches["ustrf"] = self.reaches["ustrf"].fillna(1.)
+        self._connect_reaches()
+
     def __repr__(self):
         """Return string representation of SwnModflow object."""
         model = self.model
@@ -64,7 +64,7 @@ class SwnModflow(SwnModflowBase):
     @classmethod
     def from_swn_flopy(
             cls, swn, model, ibound_action="freeze",
-            reach_include_fraction=0.2):
+            reach_include_fraction=0.2, workers=None, cache_dir=None):
         """Create a MODFLOW SFR structure from a surface water network.
 
         Parameters
@@ -82,6 +82,16 @@ class SwnModflow(SwnModflowBase):
             reaches outside the active grid should be included to a cell.
             Based on the furthest distance of the line and cell geometries.
             Default 0.2 (e.g. for a 100 m grid cell, this is 20 m).
+        workers : int, optional
+            If more than 1, segments that need rules for short or remaining
+            reaches are evaluated in a pool of processes, or threads with
+            Shapely 2.0 or later.
+        cache_dir : str or pathlib.Path, optional
+            Directory to cache reaches evaluated from segments on the model
+            grid. Files are named with a hash of the segment geometries,
+            ``reach_include_fraction``, the domain action and model grid
+            properties, so repeated calls with the same inputs skip the
+            intersection. Default None does not use a cache.
 
         Returns
         -------
@@ -92,7 +102,8 @@ class SwnModflow(SwnModflowBase):
 
         obj = super().from_swn_flopy(
             swn=swn, model=model, domain_action=ibound_action,
-            reach_include_fraction=reach_include_fraction)
+            reach_include_fraction=reach_include_fraction, workers=workers,
+            cache_dir=cache_dir)
 
         # Add more information to reaches
         obj.reaches.index.name = "reachID"
@@ -104,6 +115,27 @@ class SwnModflow(SwnModflowBase):
 
         return obj
 
+    def update_reaches(self, segnums, workers=None):
+        """Re-evaluate reaches for changed or removed segments.
+
+        See :py:meth:`SwnModflowBase.update_reaches`. Reaches from changed
+        segments get ``rchlen`` values. If segments are numbered differently,
+        :py:meth:`new_segment_data` needs to be called again.
+        """
+        if self.segment_data is not None:
+            prev_segnums = self.reaches.groupby("iseg")["segnum"].first()
+        super().update_reaches(segnums, workers=workers)
+        sel = self.reaches["rchlen"].isna()
+        rchlen = self.reaches.geometry[sel].length
+        rchlen[rchlen == 0] = 1.0  # zero lengths not permitted
+        self.reaches.loc[sel, "rchlen"] = rchlen
+        if self.segment_data is not None:
+            segnums = self.reaches.groupby("iseg")["segnum"].first()
+            if not segnums.equals(prev_segnums):
+                self.logger.warning(
+                    "segment numbers changed; segment_data needs to be reset "
+                    "with new_segment_data")
+
     def __repr__(self):
         """Return string representation of SwnModflow object."""
         model = self.model
@@ -422,6 +454,56 @@ class SwnModflow(SwnModflowBase):
         reach_data = pd.DataFrame(self.reaches[reach_data_names])
         return reach_data.to_records(index=True)
 
+    def _segment_data_periods(self, iper):
+        """Return segment_data for several stress periods as one array.
+
+        Parameters
+        ----------
+        iper : slice
+            Stress periods to evaluate, as positions in time_index.
+
+        Returns
+        -------
+        numpy.ndarray
+            Structured array with shape (nper, nseg), and fields "nseg"
+            followed by flopy's segment_data names.
+        """
+        from flopy.modflow.mfsfr2 import ModflowSfr2
+        seg_dtype = ModflowSfr2.get_default_segment_dtype()
+        seg_names = list(seg_dtype.names[1:])  # everything except nseg
+        seg_df = self.segment_data
+        time_index = self.time_index[iper]
+        shape = (len(time_index), len(seg_df))
+        data = np.empty(shape, np.dtype(
+            [("nseg", seg_df.index.dtype)] +
+            [(name, seg_df[name].dtype) for name in seg_names]))
+        data["nseg"] = seg_df.index.values
+        for name in seg_names:
+            data[name] = seg_df[name].values
+        # Terms combined for FLOW
+        flow_terms = {}
+        if self.diversions is not None:
+            flow_terms["abstraction"] = None
+        flow_terms["inflow"] = None
+        for key in flow_terms.keys():
+            flow_terms[key] = np.broadcast_to(
+                seg_df[key].values, shape).copy()
+        # Update any time-varying components
+        for key, df in self.segment_data_ts.items():
+            if key in seg_names:
+                values = data[key]
+            elif key in flow_terms:
+                values = flow_terms[key]
+            else:
+                continue
+            cols = seg_df.index.get_indexer(df.columns)
+            values[:, cols] = df.loc[time_index].values
+        for key, values in flow_terms.items():
+            # Add to FLOW term for stress periods with any non-zero values
+            sel = (np.nan_to_num(values) != 0.0).any(axis=1)
+            data["flow"][sel] += values[sel]
+        return data
+
     def flopy_segment_data(self):
         """Return dict of numpy.recarray for flopy's ModflowSfr2 segment_data.
 
@@ -440,35 +522,52 @@ class SwnModflow(SwnModflowBase):
         -------
         dict
 
+        See Also
+        --------
+        SwnModflow.iter_flopy_segment_data : Generate one stress period at a
+            time, without holding all stress periods in memory.
+
         """
-        from flopy.modflow.mfsfr2 import ModflowSfr2
         if self.segment_data is None:
             self.logger.warning(
                 "'segment_data' was not set; using default values")
             self.new_segment_data()
-        seg_dtype = ModflowSfr2.get_default_segment_dtype()
-        seg_names = list(seg_dtype.names[1:])  # everything except nseg
+        # Assemble all stress periods in one array, with iper keys for flopy
+        data = self._segment_data_periods(slice(None)).view(np.recarray)
+        return {iper: data[iper] for iper in range(len(data))}
 
-        has_diversions = self.diversions is not None
-        # Re-assmble stress period dict for flopy, with iper keys
-        segment_data = {}
-        for iper, tidx in enumerate(self.time_index):
-            # Store data for each stress period
-            seg_df = self.segment_data.copy()
-            # Update any time-varying components
-            for key, df in self.segment_data_ts.items():
-                ts = df.loc[tidx]
-                seg_df.loc[ts.index, key] = ts
-            # Combine terms for FLOW
-            if has_diversions:
-                if seg_df.abstraction.any():
-                    # Add abstraction to FLOW term
-                    seg_df.flow += seg_df.abstraction
-            if seg_df.inflow.any():
-                # Add external inflow to FLOW term
-                seg_df.flow += seg_df.inflow
-            segment_data[iper] = seg_df[seg_names].to_records(index=True)
-        return segment_data
+    def iter_flopy_segment_data(self, chunk_size=100):
+        """Generate numpy.recarray for each stress period of segment_data.
+
+        This is similar to :py:meth:`SwnModflow.flopy_segment_data`, but
+        only ``chunk_size`` stress periods are assembled at a time, so
+        memory use does not grow with the number of stress periods.
+
+        Parameters
+        ----------
+        chunk_size : int, default 100
+            Number of stress periods assembled together.
+
+        Yields
+        ------
+        iper : int
+            Stress period, starting from 0.
+        numpy.recarray
+            Segment data for the stress period.
+
+        """
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1")
+        if self.segment_data is None:
+            self.logger.warning(
+                "'segment_data' was not set; using default values")
+            self.new_segment_data()
+        nper = len(self.time_index)
+        for start in range(0, nper, chunk_size):
+            data = self._segment_data_periods(
+                slice(start, start + chunk_size)).view(np.recarray)
+            for iper in range(len(data)):
+                yield start + iper, data[iper]
 
     def default_segment_data(
             self, hyd_cond1=1., hyd_cond_out=None,
@@ -7,6 +7,8 @@ __all__ = [
     "find_segnum_in_swn"
 ]
 
+import logging
+
 import geopandas
 import numpy as np
 import pandas as pd
@@ -197,6 +199,8 @@ def find_segnum_in_swn(n, geom):
 
     If a catchment polygon is provided, this is used to find if the point
     is contained in the catchment, otherwise the closest segment is found.
+    All geometries are evaluated together, and if there is more than one
+    match the first segnum (by position) is taken and a warning is logged.
 
     Parameters
     ----------
@@ -226,62 +230,122 @@ def find_segnum_in_swn(n, geom):
     elif isinstance(geom, list):
         geom = geopandas.GeoSeries([Point(v) for v in geom])
 
+    geoms = geom.values
+    num = len(geoms)
+    segnum_idx = np.full(num, -1, dtype=np.int64)
+
     has_catchments = n.catchments is not None
     if has_catchments:
-        catchments_sindex = get_sindex(n.catchments)
-    segments_sindex = False  # get this, only if needed
-
-    # test disabling sindex:
-    # segments_sindex = None
-    # catchments_sindex = None
-
-    num_results = 9
-    segnums = []
-    is_within_catchments = []
-    dist_to_segnums = []
-    for _, g in geom.iteritems():
-        segnum = None
-        if has_catchments:
-            if catchments_sindex:
-                subsel = sorted(catchments_sindex.intersection(g.bounds))
-                contains = [n.catchments.index[idx] for idx in subsel
-                            if n.catchments.iloc[idx].contains(g)]
-            else:
-                contains = [idx for (idx, p) in n.catchments.iteritems()
-                            if p.contains(g)]
-            if len(contains) == 0:
-                n.logger.debug('geom %s not contained any catchment', g.wkt)
-                is_within_catchment = False
-            elif len(contains) > 1:
-                n.logger.warning('geom %s contained in more than one of %s',
-                                 g.wkt, contains)
-                segnum = contains[0]  # take the first
-                is_within_catchment = True
-            else:
-                segnum = contains[0]
-                is_within_catchment = True
-            is_within_catchments.append(is_within_catchment)
-        if segnum is None:
-            # Find nearest segment
-            if segments_sindex is False:
-                segments_sindex = get_sindex(n.segments)
-            if segments_sindex:
-                nearest = n.segments.iloc[
-                    sorted(segments_sindex.nearest(g.bounds, num_results))]\
-                    .distance(g).sort_values()
-            else:
-                nearest = n.segments.distance(g).sort_values()[:num_results]
-            nearest_sel = nearest.iloc[0] == nearest
-            segnum = nearest[nearest_sel].index[0]  # take the first
-            if nearest_sel.sum() > 1:
-                n.logger.warning('geom %s is nearest to more than one of %s',
-                                 g.wkt, nearest[nearest_sel].index.to_list())
-        segnums.append(segnum)
-        dist_to_segnums.append(g.distance(n.segments.loc[segnum, "geometry"]))
+        # one predicate query for all geometries within catchments
+        geom_idx, cat_idx = n.catchments.sindex.query_bulk(
+            geoms, predicate="within").astype(np.intp)
+        # sort by geometry, then by catchment position; take the first
+        order = np.lexsort((cat_idx, geom_idx))
+        geom_idx = geom_idx[order]
+        cat_idx = cat_idx[order]
+        counts = np.bincount(geom_idx, minlength=num)
+        first = np.unique(geom_idx, return_index=True)[1]
+        segnum_idx[geom_idx[first]] = cat_idx[first]
+        is_within_catchments = counts > 0
+        for idx in np.flatnonzero(counts > 1):
+            contains = n.catchments.index[cat_idx[geom_idx == idx]].to_list()
+            n.logger.warning('geom %s contained in more than one of %s',
+                             geoms[idx].wkt, contains)
+        if n.logger.isEnabledFor(logging.DEBUG):
+            for idx in np.flatnonzero(counts == 0):
+                n.logger.debug(
+                    'geom %s not contained any catchment', geoms[idx].wkt)
+
+    # one nearest query for remaining geometries
+    sel = segnum_idx == -1
+    if sel.any():
+        geom_idx, seg_idx = _nearest_pairs(n.segments.geometry, geoms[sel])
+        geom_idx = np.flatnonzero(sel)[geom_idx]
+        first = np.unique(geom_idx, return_index=True)[1]
+        segnum_idx[geom_idx[first]] = seg_idx[first]
+        counts = np.bincount(geom_idx, minlength=num)
+        for idx in np.flatnonzero(counts > 1):
+            nearest = n.segments.index[seg_idx[geom_idx == idx]].to_list()
+            n.logger.warning('geom %s is nearest to more than one of %s',
+                             geoms[idx].wkt, nearest)
 
     # Assemble results
-    ret = pd.DataFrame({'segnum': segnums}, index=geom.index)
-    ret['dist_to_segnum'] = dist_to_segnums
+    segments_geom = n.segments.geometry.values
+    ret = pd.DataFrame(
+        {'segnum': n.segments.index.values[segnum_idx]}, index=geom.index)
+    ret['dist_to_segnum'] = geoms.distance(segments_geom[segnum_idx])
     if has_catchments:
         ret['is_within_catchment'] = is_within_catchments
     return ret
+
+
+def _nearest_pairs(gs, geoms):
+    """Return positions of geometries nearest to each of geoms.
+
+    Candidates are found with bounding box queries using the spatial index
+    of gs, expanded until at least one candidate is found, then expanded
+    again by the shortest candidate distance so that the result is exact.
+
+    Parameters
+    ----------
+    gs : geopandas.GeoSeries
+        Geometries to search, with a spatial index.
+    geoms : geopandas.array.GeometryArray
+        Geometries to find nearest geometries from gs.
+
+    Returns
+    -------
+    geom_idx, gs_idx : numpy.ndarray
+        Pairs of positions sorted by geom_idx then gs_idx, with more than one
+        pair for a geometry if distances are equal.
+
+    """
+    from shapely.geometry import box
+
+    sindex = gs.sindex
+    values = gs.values
+    bounds = geoms.bounds
+    num = len(geoms)
+    # initial search distance from typical size of geometries in gs
+    gs_bounds = values.bounds
+    dist = np.full(num, max(np.median(np.maximum(
+        gs_bounds[:, 2] - gs_bounds[:, 0],
+        gs_bounds[:, 3] - gs_bounds[:, 1])), 1.0) if len(gs) else 1.0)
+
+    def query(idx, dist):
+        b = bounds[idx]
+        boxes = geopandas.array.from_shapely([
+            box(*v) for v in zip(
+                b[:, 0] - dist, b[:, 1] - dist,
+                b[:, 2] + dist, b[:, 3] + dist)])
+        in_idx, tree_idx = sindex.query_bulk(boxes).astype(np.intp)
+        return idx[in_idx], tree_idx
+
+    # expand search until each geometry has at least one candidate
+    geom_idx = []
+    gs_idx = []
+    todo = np.arange(num)
+    while len(todo) > 0 and len(gs) > 0:
+        in_idx, tree_idx = query(todo, dist[todo])
+        geom_idx.append(in_idx)
+        gs_idx.append(tree_idx)
+        dist[todo] *= 2.0
+        todo = np.setdiff1d(todo, in_idx)
+    if len(geom_idx) == 0:
+        raise ValueError("no geometries to search")
+    geom_idx = np.concatenate(geom_idx)
+    gs_idx = np.concatenate(gs_idx)
+    # nearest distance of any candidate is an upper bound
+    cand_dist = geoms[geom_idx].distance(values[gs_idx])
+    upper = np.full(num, np.inf)
+    np.minimum.at(upper, geom_idx, cand_dist)
+    # final search with all geometries within upper bound
+    geom_idx, gs_idx = query(np.arange(num), upper)
+    cand_dist = geoms[geom_idx].distance(values[gs_idx])
+    mindist = np.full(num, np.inf)
+    np.minimum.at(mindist, geom_idx, cand_dist)
+    sel = cand_dist == mindist[geom_idx]
+    geom_idx = geom_idx[sel]
+    gs_idx = gs_idx[sel]
+    order = np.lexsort((gs_idx, geom_idx))
+    return geom_idx[order], gs_idx[order]
@@ -1,3 +1,4 @@
+import sys
 from textwrap import dedent
 
 import geopandas
@@ -321,6 +322,63 @@ def test_init_line_connects_to_middle():
         plt.close()
 
 
+def test_init_snap_tolerance():
+    pytest.importorskip("scipy")
+    # same as valid_lines, but with small gaps between line ends
+    lines = wkt_to_geoseries([
+        'LINESTRING Z (60 100 14, 60  80 12)',
+        'LINESTRING Z (40 130 15, 60.01 100 14)',
+        'LINESTRING Z (70 130 15, 60 100.02 14)',
+    ])
+    n = swn.SurfaceWaterNetwork.from_lines(lines)
+    assert list(n.segments['to_segnum']) == [-1, -1, -1]
+    assert len(n.errors) == 0
+    n = swn.SurfaceWaterNetwork.from_lines(lines, snap_tolerance=0.1)
+    assert len(n.warnings) == 0
+    assert len(n.errors) == 0
+    assert list(n.segments['to_segnum']) == [-1, 0, 0]
+    assert list(n.segments['from_segnums']) == [{1, 2}, set(), set()]
+    assert list(n.segments['sequence']) == [3, 1, 2]
+    assert list(n.segments['stream_order']) == [2, 1, 1]
+    assert list(n.headwater) == [1, 2]
+    assert list(n.outlets) == [0]
+    # outlets that end near each other
+    lines = wkt_to_geoseries([
+        'LINESTRING (40 130, 60 100)',
+        'LINESTRING (70 130, 60.01 100)',
+        'LINESTRING (60 80, 60 99.98)',
+    ])
+    n = swn.SurfaceWaterNetwork.from_lines(lines, snap_tolerance=0.1)
+    assert list(n.segments['to_segnum']) == [-1, -1, -1]
+    assert len(n.warnings) == 3
+    assert n.warnings[0] == \
+        'ending coordinate (60.0, 99.98) matches end segments: {0, 1, 2}'
+    assert len(n.errors) == 0
+
+
+def test_init_long_main_stem():
+    # Longer than default recursion limit
+    num = 3000
+    lines = geopandas.GeoSeries(
+        [LineString([(0, i + 1), (0, i)]) for i in range(num)])
+    lines.index += 1
+    n = swn.SurfaceWaterNetwork.from_lines(lines)
+    assert len(n.warnings) == 0
+    assert len(n.errors) == 0
+    assert list(n.headwater) == [num]
+    assert list(n.outlets) == [1]
+    assert (n.segments['cat_group'] == 1).all()
+    np.testing.assert_array_equal(
+        n.segments['num_to_outlet'], np.arange(num) + 1)
+    np.testing.assert_allclose(
+        n.segments['dist_to_outlet'], np.arange(num) + 1.0)
+    np.testing.assert_array_equal(
+        n.segments['sequence'], np.arange(num, 0, -1))
+    assert (n.segments['stream_order'] == 1).all()
+    np.testing.assert_allclose(
+        n.segments['upstream_length'], np.arange(num, 0, -1.0))
+
+
 def test_to_segnums(valid_n):
     # check series in propery method
     pd.testing.assert_series_equal(
@@ -354,6 +412,10 @@ def test_from_segnums(valid_n):
     pd.testing.assert_series_equal(
         valid_n.segments["from_segnums"],
         pd.Series([{1, 2}, set(), set()], name="from_segnums"))
+    # check compact form
+    indptr, segnums = valid_n.from_segnums_csr
+    np.testing.assert_array_equal(indptr, [0, 2, 2, 2])
+    np.testing.assert_array_equal(segnums, [1, 2])
 
     # Rebuild network using named index
     lines = valid_lines.copy()
@@ -466,6 +528,30 @@ def test_accumulate_values_expected(valid_n):
     assert a.name is None
 
 
+def test_accumulate_values_frame(valid_n):
+    v = pd.DataFrame({"a": [2.0, 3.0, 4.0], "b": [1.0, 0.0, 1.0]})
+    a = valid_n.accumulate_values(v)
+    expected = pd.DataFrame({"a": [9.0, 3.0, 4.0], "b": [2.0, 0.0, 1.0]})
+    pd.testing.assert_frame_equal(a, expected)
+    # check that input is not modified
+    assert list(v["a"]) == [2.0, 3.0, 4.0]
+    # indexes overlap, but have a different sequence
+    with pytest.raises(ValueError, match='index is different'):
+        valid_n.accumulate_values(v.sort_values("a", ascending=False))
+
+
+def test_accumulate_values_array(valid_n):
+    v = np.array([[2.0, 1.0], [3.0, 0.0], [4.0, 1.0]])
+    a = valid_n.accumulate_values(v)
+    np.testing.assert_array_equal(a, [[9.0, 2.0], [3.0, 0.0], [4.0, 1.0]])
+    np.testing.assert_array_equal(
+        valid_n.accumulate_values(v[:, 0]), [9.0, 3.0, 4.0])
+    with pytest.raises(ValueError, match='first dimension of values array'):
+        valid_n.accumulate_values(v.T)
+    with pytest.raises(ValueError, match='values array must be 1D or 2D'):
+        valid_n.accumulate_values(v.reshape((3, 2, 1)))
+
+
 def test_init_polygons():
     expected_area = [800.0, 875.0, 525.0]
     expected_upstream_area = [2200.0, 875.0, 525.0]
@@ -573,9 +659,13 @@ def test_set_diversions_geodataframe():
         n.diversions['from_segnum'], [1, 2, 0, 0])
     np.testing.assert_array_equal(
         n.segments['diversions'], [{2, 3}, {0}, {1}])
+    indptr, divids = n.diversions_csr
+    np.testing.assert_array_equal(indptr, [0, 2, 3, 4])
+    np.testing.assert_array_equal(divids, [2, 3, 0, 1])
     # Unset
     n.set_diversions(None)
     assert n.diversions is None
+    assert n.diversions_csr is None
     assert 'diversions' not in n.segments.columns
     # Try again with min_stream_order option
     n.set_diversions(diversions, min_stream_order=2)
@@ -612,6 +702,18 @@ def test_set_diversions_geodataframe():
         plt.close()
 
 
+def test_set_diversions_without_scipy(monkeypatch):
+    diversions = geopandas.GeoDataFrame(geometry=[
+        Point(58, 97), Point(62, 97), Point(61, 89), Point(59, 89)])
+    n1 = swn.SurfaceWaterNetwork.from_lines(valid_lines)
+    n1.set_diversions(diversions)
+    # compare with slower method that finds nearest segments one at a time
+    monkeypatch.setitem(sys.modules, "scipy.spatial", None)
+    n2 = swn.SurfaceWaterNetwork.from_lines(valid_lines)
+    n2.set_diversions(diversions)
+    pd.testing.assert_frame_equal(n1.diversions, n2.diversions)
+
+
 def test_set_diversions_dataframe():
     n = swn.SurfaceWaterNetwork.from_lines(valid_lines)
     diversions = pd.DataFrame({'from_segnum': [0, 2]})
@@ -886,6 +988,11 @@ def test_remove_segnums():
     assert len(n.segments) == 2
     assert list(n.segments.index) == [0, 2]
     assert n.segments.at[0, 'from_segnums'] == {1, 2}
+    # property is from to_segnum, so it only has segnums in the index
+    assert n.from_segnums.to_dict() == {0: {2}}
+    indptr, segnums = n.from_segnums_csr
+    np.testing.assert_array_equal(indptr, [0, 1, 1])
+    np.testing.assert_array_equal(segnums, [2])
     # repeats are ok
     n = swn.SurfaceWaterNetwork.from_lines(valid_lines)
     n.remove(segnums=[1, 2, 1])
@@ -895,6 +1002,45 @@ def test_remove_segnums():
     assert n.segments.at[0, 'from_segnums'] == {1, 2}
 
 
+def test_remove_cached_topology():
+    n = swn.SurfaceWaterNetwork.from_lines(valid_lines)
+    assert n.headwater is n.headwater
+    assert list(n.headwater) == [1, 2]
+    assert list(n.outlets) == [0]
+    assert list(n.from_segnums.index) == [0]
+    n.remove(segnums=[0])
+    assert list(n.headwater) == [1, 2]
+    assert list(n.outlets) == []
+    assert len(n.to_segnums) == 2
+    n.remove(segnums=[1])
+    assert list(n.headwater) == [2]
+    assert list(n.to_segnums.index) == [2]
+
+
+def test_topology_changed(valid_n):
+    n = valid_n
+    np.testing.assert_almost_equal(
+        n.segments["upstream_length"], [87.67828936, 36.05551275, 31.6227766])
+    # geometry modified in place
+    n.segments.loc[1, "geometry"] = wkt.loads(
+        "LINESTRING Z (40 230 15, 60 100 14)")
+    n.evaluate_upstream_length()
+    np.testing.assert_almost_equal(
+        n.segments["upstream_length"], [183.15224, 131.52946, 31.6227766],
+        decimal=5)
+    # to_segnum modified in place
+    n.segments.loc[2, "to_segnum"] = n.END_SEGNUM
+    assert list(n.outlets) == [0]
+    n.topology_changed()
+    assert list(n.outlets) == [0, 2]
+    assert list(n.from_segnums.index) == [0]
+    assert n.from_segnums[0] == {1}
+    n.evaluate_upstream_length()
+    np.testing.assert_almost_equal(
+        n.segments["upstream_length"], [151.52946, 131.52946, 31.6227766],
+        decimal=5)
+
+
 def test_remove_errors(valid_n):
     n = valid_n
     assert len(n) == 3
@@ -912,6 +1058,69 @@ def test_remove_errors(valid_n):
         n.remove(segnums=[0, 1, 2])
 
 
+def test_remove_update():
+    n = swn.SurfaceWaterNetwork.from_lines(valid_lines, valid_polygons)
+    n.remove(segnums=[1], update=True)
+    assert list(n.segments.index) == [0, 2]
+    assert list(n.outlets) == [0]
+    assert n.segments.at[0, 'from_segnums'] == {2}
+    assert list(n.segments['sequence']) == [2, 1]
+    assert list(n.segments['stream_order']) == [1, 1]
+    np.testing.assert_almost_equal(
+        n.segments['upstream_length'], [51.6227766, 31.6227766])
+    np.testing.assert_almost_equal(
+        n.segments['upstream_area'], [1325.0, 525.0])
+    n2 = swn.SurfaceWaterNetwork.from_lines(
+        valid_lines.drop(1), valid_polygons.drop(1))
+    np.testing.assert_almost_equal(
+        n.segments['width'].values, n2.segments['width'].values)
+    # remove segment in the middle, upstream segment becomes an outlet
+    n = swn.SurfaceWaterNetwork.from_lines(valid_lines, valid_polygons)
+    n.remove(segnums=[0], update=True)
+    assert list(n.outlets) == [1, 2]
+    assert list(n.segments['to_segnum']) == [-1, -1]
+    assert list(n.segments['cat_group']) == [1, 2]
+    assert list(n.segments['num_to_outlet']) == [1, 1]
+    np.testing.assert_almost_equal(
+        n.segments['dist_to_outlet'], [36.0555128, 31.6227766])
+
+
+def test_add_segments_errors(valid_n):
+    n = valid_n
+    with pytest.raises(ValueError, match='lines must be a GeoSeries'):
+        n.add_segments(valid_df)
+    with pytest.raises(IndexError, match=r'1 segnums already found'):
+        n.add_segments(valid_lines.iloc[[1]])
+    with pytest.raises(ValueError, match='without catchments'):
+        n.add_segments(valid_lines.iloc[[1]].rename({1: 3}),
+                       valid_polygons.iloc[[1]])
+
+
+def test_add_segments_polygons():
+    n = swn.SurfaceWaterNetwork.from_lines(
+        valid_lines.iloc[:2], valid_polygons.iloc[:2])
+    n.add_segments(valid_lines.iloc[2:], valid_polygons.iloc[2:])
+    n2 = swn.SurfaceWaterNetwork.from_lines(valid_lines, valid_polygons)
+    for name in ["upstream_area", "width"]:
+        np.testing.assert_almost_equal(
+            n.segments[name].values, n2.segments[name].values)
+
+
+def test_replace_geometry(valid_n):
+    n = valid_n
+    geometry = wkt_to_geoseries([
+        'LINESTRING Z (40 130 15, 50 110 14.5, 60 100 14)'])
+    geometry.index += 1
+    n.replace_geometry(geometry)
+    assert n.segments.geometry[1].equals(geometry[1])
+    np.testing.assert_almost_equal(
+        n.segments['dist_to_outlet'], [20.0, 56.5028154, 51.6227766])
+    np.testing.assert_almost_equal(
+        n.segments['upstream_length'], [88.125592, 36.5028154, 31.6227766])
+    with pytest.raises(IndexError, match=r'1 geometry segment not found'):
+        n.replace_geometry(geometry.rename({1: 3}))
+
+
 # https://commons.wikimedia.org/wiki/File:Flussordnung_(Strahler).svg
 fluss_gs = geopandas.GeoSeries(wkt.loads('''\
 MULTILINESTRING(
@@ -964,6 +1173,27 @@ def test_fluss_n(fluss_n):
         plt.close()
 
 
+def test_add_segments(fluss_n):
+    n = swn.SurfaceWaterNetwork.from_lines(fluss_gs.iloc[[0, 1, 2, 4, 5]])
+    assert len(n.outlets) == 2
+    n.add_segments(fluss_gs.drop([0, 1, 2, 4, 5]))
+    assert len(n) == len(fluss_n)
+    segments = n.segments.loc[fluss_n.segments.index]
+    for name in ["to_segnum", "from_segnums", "cat_group", "num_to_outlet",
+                 "stream_order"]:
+        pd.testing.assert_series_equal(
+            segments[name], fluss_n.segments[name])
+    for name in ["dist_to_outlet", "upstream_length"]:
+        pd.testing.assert_series_equal(
+            segments[name], fluss_n.segments[name], check_exact=False)
+    # sequence is unique and downstream
+    sequence = n.segments['sequence']
+    assert sorted(sequence) == list(range(1, len(n) + 1))
+    to_segnums = n.to_segnums
+    assert (sequence[to_segnums.index].values <
+            sequence[to_segnums].values).all()
+
+
 def test_fluss_n_query_upstream(fluss_n):
     n = fluss_n
     assert set(n.query(upstream=0)) == {0}
@@ -1020,6 +1250,114 @@ def test_fluss_n_query_downstream(fluss_n):
         n.query(downstream=-1)
 
 
+def test_fluss_n_is_upstream(fluss_n):
+    n = fluss_n
+    assert n.is_upstream(0, 0) is True
+    assert n.is_upstream(0, 2) is True
+    assert n.is_upstream(0, 18) is True
+    assert n.is_upstream(2, 0) is False
+    assert n.is_upstream(9, 8) is False
+    np.testing.assert_array_equal(
+        n.is_upstream([0, 10, 15, 17, 7], [8, 8, 9, 16, 8]),
+        [True, False, True, False, True])
+    # broadcast to check all segnums upstream of 9
+    np.testing.assert_array_equal(
+        np.flatnonzero(n.is_upstream(n.segments.index, 9)),
+        sorted(n.query(upstream=9)))
+    with pytest.raises(
+            IndexError,
+            match=r'1 upstream segment not found in segments\.index: \[19\]'):
+        n.is_upstream([18, 19], 18)
+    with pytest.raises(
+            IndexError,
+            match=r'1 downstream segment not found in segments\.index: '):
+        n.is_upstream(0, -1)
+
+
+def test_fluss_n_is_downstream(fluss_n):
+    n = fluss_n
+    assert n.is_downstream(0, 0) is True
+    assert n.is_downstream(2, 0) is True
+    assert n.is_downstream(18, 0) is True
+    assert n.is_downstream(0, 2) is False
+    assert n.is_downstream(8, 9) is False
+    np.testing.assert_array_equal(
+        n.is_downstream([8, 8, 9, 16, 8], [0, 10, 15, 17, 7]),
+        [True, False, True, False, True])
+    # broadcast to check all segnums downstream of 0
+    np.testing.assert_array_equal(
+        np.flatnonzero(n.is_downstream(n.segments.index, 0)),
+        [0] + n.query(downstream=0))
+    with pytest.raises(
+            IndexError,
+            match=r'1 downstream segment not found in segments\.index: '):
+        n.is_downstream(-1, 0)
+
+
+def test_fluss_n_confluence(fluss_n):
+    n = fluss_n
+    assert n.confluence(0, 1) == 2
+    assert n.confluence(0, 2) == 2
+    assert n.confluence(2, 0) == 2
+    assert n.confluence(0, 0) == 0
+    assert n.confluence(0, 15) == 16
+    np.testing.assert_array_equal(
+        n.confluence([0, 3, 12, 17], [4, 7, 14, 0]), [6, 8, 9, 18])
+    np.testing.assert_array_equal(n.confluence(n.headwater, 18), [18] * 10)
+    with pytest.raises(
+            IndexError,
+            match=r'1 segnums2 segment not found in segments\.index: '):
+        n.confluence(0, [1, 19])
+
+
+def test_confluence_disconnected():
+    lines = wkt_to_geoseries([
+        'LINESTRING (60 100, 60  80)',
+        'LINESTRING (40 130, 60 100)',
+        'LINESTRING (70 130, 90 100)',
+    ])
+    n = swn.SurfaceWaterNetwork.from_lines(lines)
+    assert n.confluence(0, 1) == 0
+    assert n.confluence(1, 2) == n.END_SEGNUM
+    np.testing.assert_array_equal(
+        n.is_downstream([0, 2], [1, 1]), [True, False])
+    assert np.isnan(n.path_length(1, 2))
+
+
+def test_fluss_n_path_length(fluss_n):
+    n = fluss_n
+    dist = n.segments["dist_to_outlet"]
+    length = n.segments.length
+    assert n.path_length(0, 0) == 0.0
+    assert n.path_length(0, 2) == pytest.approx(length[0])
+    assert n.path_length(2, 0) == pytest.approx(length[0])
+    assert n.path_length(0, 1) == pytest.approx(length[0] + length[1])
+    np.testing.assert_allclose(
+        n.path_length([0, 12, 4], [18, 18, 3]),
+        [dist[0] - dist[18], dist[12] - dist[18], length[3] + length[4]])
+    assert n.path_length(0, 15) == \
+        pytest.approx(dist[0] + dist[15] - 2 * dist[16])
+
+
+def test_fluss_n_upstream_segnums(fluss_n):
+    n = fluss_n
+    up = n.upstream_segnums([0, 2, 9, 18])
+    assert list(up.index) == [0, 2, 9, 18]
+    assert up.name == "upstream_segnums"
+    assert up[0] == [0]
+    assert up[2][0] == 2
+    assert set(up[2]) == {0, 1, 2}
+    assert set(up[9]) == {9, 10, 11, 12, 13, 14, 15}
+    assert len(up[18]) == 19
+    for segnum in n.segments.index:
+        assert n.upstream_segnums(segnum)[segnum] == \
+            n.query(upstream=segnum)
+    with pytest.raises(
+            IndexError,
+            match=r'2 upstream segments not found in segments\.index: '):
+        n.upstream_segnums([18, 19, 20])
+
+
 def test_aggregate_fluss_headwater(fluss_n):
     n = fluss_n
     assert len(n) == 19
@@ -1064,6 +1402,9 @@ def test_aggregate_fluss_two_middle(fluss_n):
     assert list(na.outlets) == [8, 9]
     assert [set(x) for x in na.segments['agg_patch']] == \
         [{0, 1, 2, 3, 4, 5, 6, 7, 8}, {9, 10, 11, 12, 13, 14, 15}]
+    # ordered depth-first from each junction
+    assert list(na.segments['agg_patch']) == \
+        [[8, 6, 2, 0, 1, 5, 3, 4, 7], [9, 10, 14, 15, 11, 12, 13]]
     assert list(na.segments['agg_path']) == [[8, 6, 5, 4], [9, 11, 13]]
     assert list(na.segments['agg_unpath']) == [[7, 2, 3], [10, 12]]
 
@@ -1143,6 +1484,32 @@ def test_adjust_elevation_profile_no_change():
     assert (n.profiles == expected_profiles).all()
 
 
+def test_adjust_elevation_profile_junction():
+    lines = wkt_to_geoseries([
+        'LINESTRING Z (0 10 10, 5 5 9)',
+        'LINESTRING Z (10 10 10, 5 5 8.5)',
+        'LINESTRING Z (5 5 8.5, 5 0 9, 5 -5 7)'])
+    n = swn.SurfaceWaterNetwork.from_lines(lines)
+    n.adjust_elevation_profile(0.01)
+    assert n.messages == [
+        'segment 0: adjusted 1 coordinate elevation by 0.500',
+        'segment 2: adjusted 1 coordinate elevation by 0.550']
+    expected = wkt_to_geoseries([
+        'LINESTRING Z (0 10 10, 5 5 8.5)',
+        'LINESTRING Z (10 10 10, 5 5 8.5)',
+        'LINESTRING Z (5 5 8.5, 5 0 8.45, 5 -5 7)'])
+    assert (expected == round_coords(n.segments.geometry)).all()
+    expected_profiles = wkt_to_geoseries([
+        'LINESTRING (0 10, 7.071 8.5)',
+        'LINESTRING (0 10, 7.071 8.5)',
+        'LINESTRING (0 8.5, 5 8.45, 10 7)'])
+    assert (expected_profiles == round_coords(n.profiles)).all()
+    # cached line ends are from adjusted geometries
+    start, end = n._get_topology("line_ends")
+    np.testing.assert_array_almost_equal(
+        end, [g.coords[-1] for g in n.segments.geometry])
+
+
 def test_adjust_elevation_profile_use_min_slope():
     lines = wkt_to_geoseries(['LINESTRING Z (0 0 8, 1 0 9)'])
     n = swn.SurfaceWaterNetwork.from_lines(lines)
@@ -1,6 +1,7 @@
 from textwrap import dedent
 
 import numpy as np
+import pandas as pd
 
 import swn
 
@@ -97,6 +98,19 @@ def test_accumulate_values(coastal_swn, coastal_lines_gdf):
     assert catarea.name == 'accumulated_CATAREA'
 
 
+def test_accumulate_values_frame(coastal_swn, coastal_flow_ts):
+    n = coastal_swn
+    flow = coastal_flow_ts.T.reindex(index=n.segments.index, fill_value=0.0)
+    accum = n.accumulate_values(flow)
+    assert accum.shape == flow.shape
+    pd.testing.assert_index_equal(accum.columns, flow.columns)
+    for col in flow.columns[:3]:
+        pd.testing.assert_series_equal(
+            accum[col], n.accumulate_values(flow[col]).rename(col))
+    np.testing.assert_array_equal(
+        n.accumulate_values(flow.values), accum.values)
+
+
 def test_catchment_polygons(coastal_lines_gdf, coastal_polygons_gdf):
     lines = coastal_lines_gdf.geometry
     polygons = coastal_polygons_gdf.geometry
@@ -127,3 +141,24 @@ def test_catchment_polygons(coastal_lines_gdf, coastal_polygons_gdf):
     if matplotlib:
         _ = n.plot()
         plt.close()
+
+
+def test_aggregate_catchments(coastal_lines_gdf, coastal_polygons_gdf):
+    lines = coastal_lines_gdf.geometry
+    polygons = coastal_polygons_gdf.geometry
+    n = swn.SurfaceWaterNetwork.from_lines(lines, polygons)
+    junctions = list(n.outlets[:3]) + [3047927]
+    na = n.aggregate(junctions)
+    assert list(na.segments.index[:4]) == junctions
+    assert len(na.errors) == 0
+    cat_areas = n.catchments.area
+    for segnum, agg_patch in na.segments["agg_patch"].items():
+        assert agg_patch[0] == segnum
+        # a few filled-in polygons overlap
+        np.testing.assert_allclose(
+            na.catchments[segnum].area, cat_areas[agg_patch].sum(),
+            rtol=1e-4)
+    # all segments upstream of junctions are in one patch
+    patches = na.segments["agg_patch"].sum()
+    assert len(patches) == len(set(patches))
+    assert set(patches) == set(n.query(upstream=junctions))
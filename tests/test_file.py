@@ -72,6 +72,17 @@ def test_pickle_lines_diversions():
     assert n1 == n2
 
 
+def test_pickle_set_columns():
+    n1 = swn.SurfaceWaterNetwork.from_lines(n3d_lines)
+    n1.set_diversions(diversions)
+    state = n1.__getstate__()
+    assert "from_segnums" not in state["segments"].columns
+    assert "diversions" not in state["segments"].columns
+    n2 = pickle.loads(pickle.dumps(n1))
+    assert list(n2.segments.columns) == list(n1.segments.columns)
+    assert list(n2.segments.from_segnums) == [{1, 2}, set(), set()]
+
+
 def test_pickle_file_methods(tmp_path):
     # use to_pickle / from_pickle methods
     n1 = swn.SurfaceWaterNetwork.from_lines(n3d_lines, valid_polygons)
@@ -79,3 +90,13 @@ def test_pickle_file_methods(tmp_path):
     n1.to_pickle(tmp_path / "n2.pickle")
     n2 = swn.SurfaceWaterNetwork.from_pickle(tmp_path / "n2.pickle")
     assert n1 == n2
+
+
+def test_pickle_after_remove(tmp_path):
+    # from_segnums can refer to removed segments
+    n1 = swn.SurfaceWaterNetwork.from_lines(n3d_lines)
+    n1.remove(segnums=[1])
+    n1.to_pickle(tmp_path / "n2.pickle")
+    n2 = swn.SurfaceWaterNetwork.from_pickle(tmp_path / "n2.pickle")
+    assert n1 == n2
+    assert list(n2.segments.from_segnums) == [{1, 2}, set()]
@@ -516,6 +516,44 @@ def test_set_segment_data_inflow(nper, inflow, expected):
         plt.close()
 
 
+def test_flopy_segment_data():
+    n = get_basic_swn(has_diversions=True)
+    m = get_basic_modflow(nper=3)
+    nm = swn.SwnModflow.from_swn_flopy(n, m)
+    nm.new_segment_data()
+    nm.set_segment_data_from_segments("flow", {1: 2.0, 2: 3.0})
+    nm.set_segment_data_from_segments(
+        "runoff", pd.DataFrame({0: [0.1, 0.2, 0.3]}, index=nm.time_index))
+    nm.set_segment_data_from_segments(
+        "inflow", pd.DataFrame({1: [0.0, 1.5, 0.0]}, index=nm.time_index))
+    nm.set_segment_data_from_diversions(
+        "abstraction",
+        pd.DataFrame({1: [1.1, 0.0, 0.0]}, index=nm.time_index))
+    seg_data = nm.flopy_segment_data()
+    assert list(seg_data.keys()) == [0, 1, 2]
+    assert isinstance(seg_data[0], np.recarray)
+    assert seg_data[0].dtype.names[0] == "nseg"
+    np.testing.assert_array_equal(seg_data[0].nseg, [1, 2, 3, 4, 5, 6, 7])
+    np.testing.assert_array_almost_equal(
+        seg_data[0].flow, [2.0, 3.0, 0.0, 0.0, 1.1, 0.0, 0.0])
+    np.testing.assert_array_almost_equal(
+        seg_data[1].flow, [3.5, 3.0, 0.0, 0.0, 0.0, 0.0, 0.0])
+    np.testing.assert_array_almost_equal(
+        seg_data[2].flow, [2.0, 3.0, 0.0, 0.0, 0.0, 0.0, 0.0])
+    np.testing.assert_array_almost_equal(
+        [sd.runoff[2] for sd in seg_data.values()], [0.1, 0.2, 0.3])
+    # stationary data is not modified
+    assert list(nm.segment_data.flow) == [2.0, 3.0, 0.0, 0.0, 0.0, 0.0, 0.0]
+    # generate each stress period, in chunks smaller than nper
+    for chunk_size in [1, 2, 3, 10]:
+        seg_data_iter = list(nm.iter_flopy_segment_data(chunk_size))
+        assert [iper for iper, _ in seg_data_iter] == [0, 1, 2]
+        for iper, sd in seg_data_iter:
+            np.testing.assert_array_equal(sd, seg_data[iper])
+    with pytest.raises(ValueError, match="chunk_size must be at least 1"):
+        next(nm.iter_flopy_segment_data(0))
+
+
 @pytest.mark.parametrize(
     "has_z", [False, True], ids=["n2d", "n3d"])
 def test_default_segment_data(has_z):
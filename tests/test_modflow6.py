@@ -8,10 +8,11 @@ import numpy as np
 import pandas as pd
 import pytest
 from shapely import wkt
-from shapely.geometry import Point
+from shapely.geometry import LineString, Point
 
 import swn
 import swn.modflow
+from swn._topology import csr_sets, next_reach
 from swn.file import gdf_to_shapefile
 from swn.spatial import force_2d, interp_2d_to_3d, wkt_to_geoseries
 
@@ -512,6 +513,35 @@ def test_connectiondata(tmp_path):
     nm.write_connectiondata(tmp_path / "connectiondata.dat")
 
 
+def test_update_reaches(tmp_path):
+    n = get_basic_swn()
+    sim, m = get_basic_modflow(tmp_path)
+    nm = swn.SwnMf6.from_swn_flopy(n, m)
+    assert len(nm.reaches) == 7
+    # re-route one segment and remove another
+    n.segments.loc[1, "geometry"] = wkt.loads(
+        "LINESTRING Z (40 130 15, 35 105 14.5, 60 100 14)")
+    n.segments.loc[2, "geometry"] = LineString()
+    nm.update_reaches([1, 2])
+    assert list(nm.reaches.index) == [1, 2, 3, 4, 5]
+    assert list(nm.reaches.segnum) == [1, 1, 1, 0, 0]
+    assert list(nm.reaches.to_rno) == [2, 3, 4, 5, 0]
+    assert list(nm.reaches.from_rnos) == [set(), {1}, {2}, {3}, {4}]
+    assert list(nm.segments.in_model) == [True, True, False]
+    # same as new object from modified lines
+    lines = n3d_lines.copy()
+    lines[1] = n.segments.geometry[1]
+    sim, m = get_basic_modflow(tmp_path)
+    nm2 = swn.SwnMf6.from_swn_flopy(
+        swn.SurfaceWaterNetwork.from_lines(lines.drop(2)), m)
+    pd.testing.assert_frame_equal(
+        nm.reaches.drop(columns="geometry"),
+        nm2.reaches.drop(columns="geometry"))
+    assert nm.reaches.geom_equals(nm2.reaches).all()
+    with pytest.raises(ValueError, match="1 segnums not found"):
+        nm.update_reaches([3])
+
+
 def check_number_sum_hex(a, n, h):
     a = np.ceil(a).astype(np.int64)
     assert a.sum() == n
@@ -765,6 +795,48 @@ def test_diversions(tmp_path):
     # TODO: diversions not yet supported
 
 
+def test_diversions_connections(tmp_path):
+    n = get_basic_swn(has_diversions=True)
+    sim, m = get_basic_modflow(tmp_path)
+    nm = swn.SwnMf6.from_swn_flopy(n, m)
+    assert list(nm.reaches.index) == list(range(1, 12))
+    assert list(nm.reaches.segnum) == [1, 1, 1, 2, 2, 0, 0, -1, -1, -1, -1]
+    assert list(nm.reaches.divid) == [0, 0, 0, 0, 0, 0, 0, 0, 1, 2, 3]
+    # diversion reaches are not connected to other reaches
+    assert list(nm.reaches.to_rno) == [2, 3, 6, 5, 6, 7, 0, 0, 0, 0, 0]
+    assert list(nm.reaches.from_rnos) == [
+        set(), {1}, {2}, set(), {4}, {3, 5}, {6},
+        set(), set(), set(), set()]
+
+
+def test_next_reach():
+    # reaches are grouped by segment
+    np.testing.assert_array_equal(
+        next_reach([2, 2, 0, 0], [-1, 0, 1]), [1, 2, 3, -1])
+    # skip downstream segment 1 without reaches
+    np.testing.assert_array_equal(
+        next_reach([2, 2, 0], [-1, 0, 1]), [1, 2, -1])
+    # no downstream segments with reaches
+    np.testing.assert_array_equal(
+        next_reach([2, 2, 3], [-1, 0, 1, -1]), [1, -1, -1])
+    # other reaches, e.g. diversions, are not connected
+    np.testing.assert_array_equal(
+        next_reach([1, 1, 0, -1, -1], [-1, 0]), [1, 2, -1, -1, -1])
+    # a single reach for each segment, not ordered by segment
+    np.testing.assert_array_equal(
+        next_reach([0, 2, 1], [-1, 0, 0]), [-1, 0, 0])
+    assert len(next_reach([], [-1])) == 0
+
+
+def test_csr_sets():
+    assert csr_sets([0, 0, 1, 3], np.array([4, 5, 6])) == [
+        set(), {4}, {5, 6}]
+    # separate sets are returned for each row
+    res = csr_sets([0, 0, 0], [])
+    assert res == [set(), set()]
+    assert res[0] is not res[1]
+
+
 def test_pickle(tmp_path):
     sim, m = get_basic_modflow(tmp_path, with_top=True)
     gt = swn.modflow.geotransform_from_flopy(m)
@@ -5,6 +5,8 @@ Also check functionality in modflow._misc too.
 MODFLOW models are not run. See test_modflow.py and test_modflow6.py
 for similar, but running models.
 """
+import logging
+import pickle
 from hashlib import md5
 from textwrap import dedent
 
@@ -13,10 +15,11 @@ import numpy as np
 import pandas as pd
 import pytest
 from shapely import wkt
-from shapely.geometry import Point
+from shapely.geometry import LineString, Point
 
 import swn
 import swn.modflow
+from swn._topology import line_chainage, project_coords
 from swn.spatial import force_2d, interp_2d_to_3d, wkt_to_geoseries
 
 from .conftest import datadir, matplotlib, plt
@@ -134,6 +137,44 @@ def test_from_swn_flopy_defaults(has_z):
         plt.close()
 
 
+def test_from_swn_flopy_rotated():
+    # same as basic network and model, but rotated about top left corner
+    m = flopy.modflow.Modflow()
+    _ = flopy.modflow.ModflowDis(
+        m, nlay=1, nrow=3, ncol=2, delr=20.0, delc=20.0,
+        xul=30.0, yul=130.0, rotation=30.0)
+    _ = flopy.modflow.ModflowBas(m)
+    mg = m.modelgrid
+    lines = []
+    for line in n3d_lines:
+        x, y, z = np.array(line.coords).T
+        lines.append(wkt.loads("LINESTRING Z ({})".format(", ".join(
+            f"{x} {y} {z}" for x, y, z in zip(
+                *mg.get_coords(x - 30.0, y - 70.0), z)))))
+    n = swn.SurfaceWaterNetwork.from_lines(geopandas.GeoSeries(lines))
+    nm = swn.SwnModflow.from_swn_flopy(n, m)
+    assert list(nm.reaches.segnum) == [1, 1, 1, 2, 2, 0, 0]
+    assert list(nm.reaches.i) == [0, 0, 1, 0, 1, 1, 2]
+    assert list(nm.reaches.j) == [0, 1, 1, 1, 1, 1, 1]
+    np.testing.assert_array_almost_equal(
+        nm.reaches.segndist,
+        [0.25, 0.58333333, 0.8333333333, 0.333333333, 0.833333333, 0.25, 0.75])
+    np.testing.assert_array_almost_equal(
+        nm.reaches.geometry.length,
+        [18.027756, 6.009252, 12.018504, 21.081851, 10.540926, 10.0, 10.0])
+    # grid cells have the same vertices as the model grid
+    for (i, j), cell in nm.grid_cells.geometry.items():
+        assert cell.exterior.coords[:] == mg.get_cell_vertices(i, j) + \
+            [mg.get_cell_vertices(i, j)[0]]
+    # reach geometries are within their grid cells
+    for reach in nm.reaches.itertuples():
+        cell = nm.grid_cells.geometry[reach.i, reach.j]
+        assert cell.buffer(1e-6).contains(reach.geometry)
+    np.testing.assert_array_almost_equal(
+        [g.coords[-1][2] for g in nm.reaches.geometry],
+        [14.5, 14.3333333, 14.0, 14.3333333, 14.0, 13.0, 12.0])
+
+
 def test_set_reach_data_from_segments():
     n = get_basic_swn()
     m = get_basic_modflow(with_top=False)
@@ -219,6 +260,31 @@ def test_set_reach_data_from_segments():
         nm.set_reach_data_from_segments("width", n.segments.width, "10")
 
 
+def test_set_reach_data_from_segments_diversions():
+    n = get_basic_swn(has_diversions=True)
+    m = get_basic_modflow()
+    nm = swn.SwnModflow.from_swn_flopy(n, m)
+    reach_idx = pd.RangeIndex(11, name="reachID") + 1
+    value = pd.Series([4.0, 3.0, 5.0])
+    pd.testing.assert_frame_equal(
+        n.pair_segments_frame(value, {0: 6.0}, name="w", method="additive"),
+        pd.DataFrame({"w1": [4.0, 3.0, 5.0], "w2": [6.0, 1.5, 2.5]}))
+    # diversion reaches are not from segments
+    nm.set_reach_data_from_segments(
+        "width", value, {0: 6.0}, method="additive")
+    pd.testing.assert_series_equal(
+        nm.reaches["width"],
+        pd.Series([
+            2.625, 2.125, 1.75, 4.16666667, 2.91666667, 4.5, 5.5,
+            np.nan, np.nan, np.nan, np.nan], name="width", index=reach_idx))
+    nm.set_reach_data_from_segments("var", value, {0: 6.0})
+    pd.testing.assert_series_equal(
+        nm.reaches["var"],
+        pd.Series([
+            3.25, 3.58333333, 3.83333333, 4.66666667, 4.16666667, 4.5, 5.5,
+            np.nan, np.nan, np.nan, np.nan], name="var", index=reach_idx))
+
+
 @pytest.mark.parametrize(
     "has_diversions", [False, True], ids=["nodiv", "div"])
 def test_set_reach_slope_n3d(has_diversions):
@@ -245,6 +311,37 @@ def test_set_reach_slope_n3d(has_diversions):
     np.testing.assert_array_almost_equal(nm.reaches.slope, expected)
 
 
+def test_set_reach_slope_zcoord_ab_zero_length():
+    n = get_basic_swn(has_z=True, has_diversions=True)
+    m = get_basic_modflow(with_top=False)
+    nm = swn.SwnModflow.from_swn_flopy(n, m)
+    # vertical and flat reaches with zero length
+    nm.reaches.loc[2, "geometry"] = wkt.loads(
+        "LINESTRING Z (50 110 15, 50 110 14.5)")
+    nm.reaches.loc[4, "geometry"] = wkt.loads(
+        "LINESTRING Z (60 110 14, 60 110 14)")
+    nm.set_reach_slope("zcoord_ab", 0.001)
+    # compare with per-reach evaluation
+    expected = []
+    for geom in nm.reaches.geometry:
+        zcoords = [c[2] for c in geom.coords] if geom.has_z else []
+        if zcoords:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                slope = np.float64(zcoords[0] - zcoords[-1]) / geom.length
+        else:
+            slope = np.nan
+        if np.isnan(slope) or slope < 0.001:
+            slope = 0.001
+        expected.append(slope)
+    np.testing.assert_array_almost_equal(nm.reaches.slope, expected)
+    assert list(nm.reaches.zcoord_count) == [2] * 7 + [0] * 4
+    assert nm.reaches.at[2, "slope"] == np.inf
+    assert nm.reaches.at[4, "slope"] == 0.001
+    np.testing.assert_array_almost_equal(
+        nm.reaches.zcoord_avg,
+        [14.75, 14.75, 14.166667, 14.0, 14.166667, 13.5, 12.5] + [np.nan] * 4)
+
+
 @pytest.mark.parametrize(
     "has_diversions", [False, True], ids=["nodiv", "div"])
 def test_set_reach_slope_n2d(has_diversions):
@@ -324,6 +421,55 @@ def test_reach_barely_outside_ibound():
         plt.close()
 
 
+def test_project_coords():
+    # self-crossing line at (5 5), with a zero-length segment
+    line = wkt.loads(
+        "LINESTRING Z (0 0 10, 10 10 8, 10 10 8, 10 0 6, 0 10 4)")
+    line_xyz = np.array(line.coords)
+    chainage = line_chainage(line_xyz)
+    np.testing.assert_array_almost_equal(
+        chainage, [0.0, 14.142136, 14.142136, 24.142136, 38.284271])
+    xy = np.array([
+        [5.0, 5.0], [2.0, 3.0], [9.0, 5.0], [0.0, 10.5], [-1.0, -1.0],
+        [10.0, 10.0], [7.0, 4.0], [3.0, 6.0]])
+    dist = project_coords(line_xyz, xy)
+    expected = [line.project(Point(pt)) for pt in xy]
+    np.testing.assert_array_almost_equal(dist, expected)
+    np.testing.assert_array_almost_equal(
+        project_coords(line_xyz, xy, chainage, chunk_size=4), expected)
+    # interpolate Z coordinates from chainage
+    np.testing.assert_array_almost_equal(
+        np.interp(dist, chainage, line_xyz[:, 2]),
+        [line.interpolate(d).z for d in expected])
+
+
+def test_self_crossing_reaches():
+    n = swn.SurfaceWaterNetwork.from_lines(wkt_to_geoseries([
+        "LINESTRING Z (10 10 20, 190 190 15, 190 10 12, 10 190 10)"]))
+    m = flopy.modflow.Modflow()
+    _ = flopy.modflow.ModflowDis(
+        m, nrow=2, ncol=2, delr=100.0, delc=100.0, xul=0.0, yul=200.0)
+    _ = flopy.modflow.ModflowBas(m)
+    nm = swn.SwnModflow.from_swn_flopy(n, m)
+    # crossing at (100 100) is on a cell corner
+    assert list(nm.reaches.i) == [1, 0, 1, 0]
+    assert list(nm.reaches.j) == [0, 1, 1, 0]
+    line = n.segments.geometry[0]
+    for reach in nm.reaches.itertuples():
+        # reach coordinates with Z interpolated along the segment
+        expected = LineString(
+            line.interpolate(line.project(Point(c)))
+            for c in reach.geometry.coords)
+        assert reach.geometry.has_z
+        np.testing.assert_array_almost_equal(
+            reach.geometry.coords, expected.coords)
+        # normalized distance along the segment to the middle of the reach
+        mid_pt = reach.geometry.interpolate(0.5, normalized=True)
+        np.testing.assert_almost_equal(
+            reach.segndist, line.project(mid_pt, normalized=True))
+    assert nm.reaches.segndist.is_monotonic_increasing
+
+
 def test_linemerge_reaches():
     n = swn.SurfaceWaterNetwork.from_lines(wkt_to_geoseries([
         "LINESTRING (30 180, 80 170, 120 210, 140 210, 190 110, "
@@ -482,6 +628,17 @@ def test_coastal(coastal_lines_gdf):
         plt.close()
 
 
+def test_coastal_workers(coastal_swn):
+    m = flopy.modflow.Modflow.load(
+        "h.nam", version="mfnwt", model_ws=datadir, check=False)
+    nm1 = swn.SwnModflow.from_swn_flopy(coastal_swn, m)
+    nm2 = swn.SwnModflow.from_swn_flopy(coastal_swn, m, workers=2)
+    pd.testing.assert_frame_equal(
+        nm1.reaches.drop(columns="geometry"),
+        nm2.reaches.drop(columns="geometry"))
+    assert nm1.reaches.geom_equals(nm2.reaches).all()
+
+
 @pytest.mark.xfail
 def test_coastal_elevations(coastal_swn):
     # Load a MODFLOW model
@@ -605,6 +762,60 @@ def test_coastal_ibound_modify(coastal_swn):
         plt.close()
 
 
+def test_coastal_ibound_modify_cache(coastal_swn, tmp_path):
+    m1 = flopy.modflow.Modflow.load(
+        "h.nam", version="mfnwt", model_ws=datadir, check=False)
+    nm1 = swn.SwnModflow.from_swn_flopy(
+        coastal_swn, m1, ibound_action="modify", cache_dir=tmp_path)
+    assert len(list(tmp_path.glob("reaches-*.pkl"))) == 1
+    # second model reads reaches from cache, and modifies IBOUND the same
+    m2 = flopy.modflow.Modflow.load(
+        "h.nam", version="mfnwt", model_ws=datadir, check=False)
+    nm2 = swn.SwnModflow.from_swn_flopy(
+        coastal_swn, m2, ibound_action="modify", cache_dir=tmp_path)
+    assert len(list(tmp_path.glob("reaches-*.pkl"))) == 1
+    pd.testing.assert_frame_equal(nm1.reaches, nm2.reaches)
+    np.testing.assert_array_equal(m1.bas6.ibound.array, m2.bas6.ibound.array)
+    # other options use another cache file
+    m3 = flopy.modflow.Modflow.load(
+        "h.nam", version="mfnwt", model_ws=datadir, check=False)
+    swn.SwnModflow.from_swn_flopy(coastal_swn, m3, cache_dir=tmp_path)
+    assert len(list(tmp_path.glob("reaches-*.pkl"))) == 2
+
+
+@pytest.mark.parametrize("ibound_action", ["freeze", "modify"])
+def test_coastal_update_reaches(coastal_lines_gdf, ibound_action):
+    from shapely.geometry import LineString
+    lines = coastal_lines_gdf.geometry
+    n = swn.SurfaceWaterNetwork.from_lines(lines)
+    m1 = flopy.modflow.Modflow.load(
+        "h.nam", version="mfnwt", model_ws=datadir, check=False)
+    nm1 = swn.SwnModflow.from_swn_flopy(n, m1, ibound_action=ibound_action)
+    # simplify one segment and remove a few headwater segments
+    new_lines = lines.copy()
+    new_lines[3047735] = lines[3047735].simplify(200)
+    n.segments.loc[3047735, "geometry"] = new_lines[3047735]
+    removed = [3046409, 3046542, 3046605, 3046604, 3046700]
+    for segnum in removed:
+        n.segments.loc[segnum, "geometry"] = LineString()
+    nm1.update_reaches([3047735] + removed)
+    assert not nm1.segments.loc[removed, "in_model"].any()
+    # compare with new object, which may be sequenced differently
+    m2 = flopy.modflow.Modflow.load(
+        "h.nam", version="mfnwt", model_ws=datadir, check=False)
+    nm2 = swn.SwnModflow.from_swn_flopy(
+        swn.SurfaceWaterNetwork.from_lines(new_lines.drop(removed)), m2,
+        ibound_action=ibound_action)
+    cols = ["segnum", "segndist"]
+    r1 = nm1.reaches.sort_values(cols).reset_index(drop=True)
+    r2 = nm2.reaches.sort_values(cols).reset_index(drop=True)
+    pd.testing.assert_frame_equal(
+        r1.drop(columns=["geometry", "iseg", "ireach"]),
+        r2.drop(columns=["geometry", "iseg", "ireach"]))
+    assert r1.geom_equals(r2).all()
+    np.testing.assert_array_equal(m1.bas6.ibound.array, m2.bas6.ibound.array)
+
+
 @pytest.mark.xfail
 def test_lines_on_boundaries():
     m = flopy.modflow.Modflow()
@@ -691,6 +902,44 @@ def test_diversions():
         plt.close()
 
 
+def test_diversions_nearest_cells(caplog):
+    n = get_basic_swn()
+    # first diversion is on a corner of four grid cells
+    n.set_diversions(geopandas.GeoDataFrame(geometry=[
+        Point(50, 110), Point(62, 97)]))
+    m = get_basic_modflow()
+    with caplog.at_level(logging.WARNING):
+        nm = swn.SwnModflow.from_swn_flopy(n, m)
+    assert caplog.messages == [
+        "4 grid cells are nearest to diversion 0, "
+        "but only taking the first (0, 0)"]
+    assert list(nm.reaches.divid) == [0, 0, 0, 0, 0, 0, 0, 0, 1]
+    assert list(nm.reaches.i) == [0, 0, 1, 0, 1, 1, 2, 0, 1]
+    assert list(nm.reaches.j) == [0, 1, 1, 1, 1, 1, 1, 0, 1]
+    assert list(nm.reaches.geometry.iloc[-2:].to_wkt()) == [
+        "POINT (50 110)", "POINT (62 97)"]
+
+
+def test_diversions_non_spatial_outside():
+    lines = pd.concat([
+        n3d_lines,
+        wkt_to_geoseries(["LINESTRING Z (200 200 20, 210 210 18)"]),
+    ], ignore_index=True)
+    n = swn.SurfaceWaterNetwork.from_lines(lines)
+    n.set_diversions(
+        pd.DataFrame({"from_segnum": [1, 3, 0]}, index=[10, 11, 12]))
+    m = get_basic_modflow()
+    nm = swn.SwnModflow.from_swn_flopy(n, m)
+    assert list(nm.diversions.in_model) == [True, False, True]
+    assert list(nm.reaches.segnum) == [1, 1, 1, 2, 2, 0, 0, -1, -1]
+    assert list(nm.reaches.divid) == [0, 0, 0, 0, 0, 0, 0, 10, 12]
+    # copied from the last reach of segments 1 and 0
+    assert list(nm.reaches.i) == [0, 0, 1, 0, 1, 1, 2, 1, 2]
+    assert list(nm.reaches.j) == [0, 1, 1, 1, 1, 1, 1, 1, 1]
+    assert list(nm.reaches.iseg) == [1, 1, 1, 2, 2, 3, 3, 4, 5]
+    assert nm.reaches.geometry.iloc[-2:].is_empty.all()
+
+
 def test_transform_data_from_dict():
     from swn.modflow._misc import transform_data_to_series_or_frame as f
     time_index = pd.DatetimeIndex(["2000-07-01", "2000-07-02"])
@@ -1017,3 +1266,23 @@ def test_get_segments_inflow():
     pd.testing.assert_frame_equal(
         nm._get_segments_inflow({5: [2.2, 2.3], 4: [1.1, 1.2]}),
         pd.DataFrame({1: [3.3, 3.5]}, index=nm.time_index))
+
+    # flow from segment 5 not provided
+    pd.testing.assert_frame_equal(
+        nm._get_segments_inflow({4: [1.1, 1.2]}),
+        pd.DataFrame({1: [1.1, 1.2]}, index=nm.time_index))
+    assert nm.segments.inflow_segnums.at[1] == {4}
+
+
+def test_get_segments_inflow_pickle_after_remove():
+    n1 = get_basic_swn()
+    n1.remove(segnums=[1])
+    assert list(n1.segments.from_segnums) == [{1, 2}, set()]
+    n2 = pickle.loads(pickle.dumps(n1))
+    assert n1 == n2
+    assert list(n2.segments.from_segnums) == [{1, 2}, set()]
+    m = get_basic_modflow()
+    nm = swn.SwnModflow.from_swn_flopy(n2, m)
+    pd.testing.assert_series_equal(
+        nm._get_segments_inflow({1: 5.0, 2: 1.0}),
+        pd.Series({0: 5.0}))
@@ -1,3 +1,5 @@
+import logging
+
 import geopandas
 import numpy as np
 import pytest
@@ -142,3 +144,26 @@ def test_find_segnum_in_swn_with_catchments(
     assert list(r.segnum) == [3048690, 3048482]
     assert list(r.dist_to_segnum.round(1)) == [73.4, 989.2]
     assert list(r.is_within_catchment) == [True, True]
+
+
+def test_find_segnum_in_swn_many(caplog, coastal_swn):
+    n = coastal_swn
+    b = n.segments.total_bounds
+    x, y = np.meshgrid(
+        np.linspace(b[0], b[2], 8), np.linspace(b[1], b[3], 6))
+    # also add a point at a confluence
+    x = list(x.ravel()) + [1816822.307]
+    y = list(y.ravel()) + [5877513.0574]
+    gs = geopandas.GeoSeries(geopandas.points_from_xy(x, y))
+    with caplog.at_level(logging.WARNING):
+        r = spatial.find_segnum_in_swn(n, gs)
+        assert len(caplog.messages) == 1
+        assert caplog.messages[0].endswith(
+            "is nearest to more than one of [3046456, 3046605, 3046604]")
+    assert len(r) == 49
+    assert r.segnum.iloc[-1] == 3046456
+    assert r.dist_to_segnum.iloc[-1] == 0.0
+    # same as nearest segments found one at a time
+    dist = n.segments.geometry.apply(lambda g: gs.distance(g)).T
+    np.testing.assert_array_equal(r.dist_to_segnum, dist.min(1))
+    assert (r.segnum.iloc[:-1] == dist.idxmin(1).iloc[:-1]).all()